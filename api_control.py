@@ -1,11 +1,16 @@
+import ast
+import json
 from functools import wraps
 
-from flask import request
+from flask import request, g
 from flask_restful import Api
 from werkzeug.exceptions import HTTPException
 
 _api = None
 
+# Authorization的最大长度，api_key只有数十个字符，超长的header不解析
+MAX_AUTHORIZATION_LENGTH = 4096
+
 
 def init(app):
     global _api
@@ -23,25 +28,56 @@ def get_api():
     return _api
 
 
-def get_apikey():
-    if not request.headers.get('Authorization'):
+def parse_authorization(header):
+    '''
+    解析请求header中的Authorization
+    :param header: Authorization的值，格式为{"api_key": "..."}
+    :return: api_key，格式不正确时返回None
+    '''
+    if not header or len(header) > MAX_AUTHORIZATION_LENGTH:
         return None
     try:
-        auth = eval(request.headers.get('Authorization'))
-        if not auth.get('api_key'):
+        auth = json.loads(header)
+    except Exception:
+        # 兼容以Python字面量格式(单引号)发送的header，literal_eval不会执行任何代码
+        # 深层嵌套等异常格式会引发RecursionError、MemoryError等，均视为格式不正确
+        try:
+            auth = ast.literal_eval(header)
+        except Exception:
             return None
-        from common.apikey import APIKey
-        return APIKey.find_by_key(auth.get('api_key'))
-    except:
+    if not isinstance(auth, dict) or not isinstance(auth.get('api_key'), str):
         return None
+    return auth.get('api_key') or None
+
+
+def get_apikey():
+    '''
+    :return: 当前请求中合法的api_key，不合法时返回None
+    '''
+    return get_auth()[0]
 
 
 def get_bot():
-    key = get_apikey()
-    if key:
-        return key.botid
-    else:
-        return None
+    '''
+    :return: 当前请求的api_key所属的机器人ID，api_key不合法时返回None
+    '''
+    return get_auth()[1]
+
+
+def get_auth():
+    '''
+    校验当前请求的api_key，结果在请求内保存于flask.g，进程内由APIKey.key_cache缓存
+    :return: (api_key, botid)，不合法时均为None
+    '''
+    auth = getattr(g, '_api_auth', None)
+    if auth is None:
+        key = parse_authorization(request.headers.get('Authorization'))
+        botid = None
+        if key is not None:
+            from common.apikey import APIKey
+            botid = APIKey.get_botid(key)
+        auth = g._api_auth = (key if botid is not None else None, botid)
+    return auth
 
 
 def require_apikey(func):
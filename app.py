@@ -2,7 +2,7 @@ from flask import Flask
 
 import api_control as api
 import db_control as db
-from env import get_env_host, get_env_port
+from env import get_env_host, get_env_port, get_config as config
 import common.oauth as oauth
 
 app = Flask(__name__)
@@ -10,16 +10,58 @@ db.init(app)
 api.init(app)
 oauth.init(app)
 
+_created = False
+
+
+def create_app():
+    '''
+    加载插件并初始化用户及管理界面，返回可直接提供服务的app
+    插件在导入时注册到全局的数据库及API对象上，一个进程中只有一个app，重复调用返回同一个app
+    :return: flask app
+    '''
+    global _created
+    if _created:
+        return app
+
+    import sys
 
-if __name__ == '__main__':
     import plugin
     import app_view as view
     import common.user as user
 
-    plugin.load_plugins('common', app)
-    plugin.load_plugins('plugins', app)
+    startup_config = config().get('startup', {})
+
+    mods = plugin.import_plugins('common') + plugin.import_plugins('plugins')
+    # 插件的init可能读写数据库，须在全部数据模型加载并完成迁移后执行
+    with plugin.timed('schema'):
+        db.ensure_schema(app)
+    for mod in mods:
+        plugin.init_plugin(mod, app)
+
+    with plugin.timed('init users'):
+        user.init()
+    with plugin.timed('init views'):
+        view.init(app, lazy = startup_config.get('lazy_views', False))
+
+    if startup_config.get('report', False):
+        print(plugin.startup_report(), file = sys.stderr)
+
+    _created = True
+    return app
+
+
+if __name__ == '__main__':
+    create_app()
+
+    if config().get('server', {}).get('mode') == 'production':
+        import server
+
+        server.run(app)
+    else:
+        import signal
+        import sys
 
-    user.init()
-    view.init(app)
+        # 收到SIGTERM时正常退出，以执行atexit注册的缓冲提交等清理工作
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-    app.run(host = get_env_host(), port = get_env_port())
\ No newline at end of file
+        app.run(host = get_env_host(), port = get_env_port())
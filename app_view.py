@@ -1,4 +1,5 @@
 import os
+import threading
 import warnings
 
 import flask_login as login
@@ -17,6 +18,8 @@ from env import get_db_dir
 
 
 admin = None
+_views_lock = threading.Lock()
+_views_loaded = False
 
 
 class CVAdminModelView(ModelView):
@@ -144,16 +147,52 @@ class CVAdminIndexView(AdminIndexView):
 
     @expose('/statistics/', methods = ('GET', 'POST'))
     def statistics_service(self):
-        from flask import json
-        from common.statistics import get_statistics_data
-
-        return json.dumps(get_statistics_data(request))
-
+        from flask import Response
+        from common.statistics import get_statistics_response
+
+        (body, etag) = get_statistics_response(request)
+        response = Response(body)
+        response.set_etag(etag)
+        # 浏览器每次都带If-None-Match重新验证，数据未变化的GET请求返回304
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
+
+    @expose('/statistics/stream/')
+    def statistics_stream(self):
+        from flask import Response
+        from common.dashboard_stream import delta_hub, stream
+        from common.statistics import get_today_counts
+        from plugins.setting import TargetRule
 
-def init(app):
+        if not login.current_user.is_authenticated:
+            abort(401)
+        if not delta_hub.enabled:
+            abort(404)
+
+        username = login.current_user.username
+        targets = {(r.botid, r.target) for r in TargetRule.find_allow_by_user(username)}
+        # 汇总数据包含水位之前的全部增量，连接只推送水位之后的增量
+        watermark = delta_hub.snapshot()
+        summary = get_today_counts(username)
+        summary['watermark'] = watermark
+        subscriber = delta_hub.subscribe(watermark)
+        if subscriber is None:
+            # 连接数已达上限，仪表板改为定时刷新
+            abort(503)
+
+        response = Response(stream(subscriber, targets, summary), mimetype = 'text/event-stream')
+        response.call_on_close(lambda: delta_hub.unsubscribe(subscriber))
+        response.headers['Cache-Control'] = 'no-cache'
+        # 禁止反向代理缓冲推送内容
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+
+def init(app, lazy = False):
     '''
     初始化
     :param app:flask app 
+    :param lazy: 是否在首次访问/admin时才创建数据模型视图
     :return: 
     '''
     global admin
@@ -207,9 +246,44 @@ def init(app):
         '系统设置': 'fa fa-cogs'
     }
 
+    if lazy:
+        _load_views_on_demand(app)
+    else:
+        load_views()
+
+
+def _load_views_on_demand(app):
+    # 视图的URL规则须在请求匹配URL之前注册，所以在WSGI入口而不是before_request中创建
+    wsgi_app = app.wsgi_app
+
+    def lazy_wsgi_app(environ, start_response):
+        if not _views_loaded and environ.get('PATH_INFO', '').startswith('/admin'):
+            load_views()
+        return wsgi_app(environ, start_response)
+
+    app.wsgi_app = lazy_wsgi_app
+
+
+def load_views():
+    '''
+    按插件中注册的数据模型创建管理界面视图，只执行一次
+    '''
+    global _views_loaded
+    with _views_lock:
+        if _views_loaded:
+            return
+        import plugin
+
+        with plugin.timed('admin views'):
+            _add_views()
+        _views_loaded = True
+
+
+def _add_views():
     from plugin import hub
     views = {}
     models = {}
+    pages = {}
 
     # 从插件中加载已注册的模型类和视图类
     for (hub_k, hub_v) in hub.registry_map.items():
@@ -217,6 +291,8 @@ def init(app):
             models[model_k] = model_v
         for (view_k, view_v) in hub_v.view_map.items():
             views[view_k] = view_v
+        for (page_k, page_v) in hub_v.page_map.items():
+            pages[page_k] = page_v
 
     # 按注册的排序顺序创建数据模型视图
     models_list = [models[k] for k in sorted(models.keys())]
@@ -229,4 +305,8 @@ def init(app):
             admin.add_view(view_class(model_class, db_control.get_db().session))
 
     # 创建文件视图
-    admin.add_view(CVAdminFileView(get_db_dir(), '', name = '数据库文件', category = '系统设置'))
\ No newline at end of file
+    admin.add_view(CVAdminFileView(get_db_dir(), '', name = '数据库文件', category = '系统设置'))
+
+    # 创建插件中注册的其他视图
+    for page_k in sorted(pages.keys()):
+        admin.add_view(pages[page_k]())
\ No newline at end of file
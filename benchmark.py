@@ -0,0 +1,423 @@
+'''
+    性能基准测试
+
+    在新建的临时数据目录中创建独立的数据库运行，不使用环境变量中的DATA_DIR，不会影响正式数据；
+    --data-dir可指定数据目录，须为空目录
+    先为--bots个机器人生成--days天内的发言、签到、报点及积分流水数据，再测试写入、查询、统计、重新清洗及仪表板
+    用法：python benchmark.py [--speak-rows 50000] [--rounds 20] [--data-dir DIR] [--output result.json] [--compare base.json]
+    结果为JSON，以--output保存后可用--compare对比不同提交的结果，指标变差超过--tolerance时以非0状态退出
+    对比SQLite调优前后的数据时，以SQLITE_TUNING=0 SQLITE_POOL_SIZE=0运行即为调优前的设置
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+BOTID = 'bench'
+
+MESSAGES = [
+    '大家好',
+    '今天签到了吗[CQ:face,id=14]',
+    '[CQ:image,file=8A3C5E0F1B2D4E6F.jpg]',
+    '哈哈哈哈哈哈哈哈',
+    '[CQ:at,qq=10001] 晚上一起打本',
+    '收到[CQ:emoji,id=128077]',
+    '这周的活动安排已经发到群文件了，大家记得看一下',
+    '[CQ:bface,p=10278,id=4A2E8C][CQ:face,id=178]',
+]
+
+TARGETS = [str(10000 + i) for i in range(5)]
+
+WASH_RULES = [
+    ('wash_cq', 'CQ码', r'\[CQ:[^\]]*\]'),
+    ('wash_repeat', '重复字符', r'(.)\1{3,}'),
+    ('wash_space', '空白字符', r'\s+'),
+]
+
+SCORE_INCOME = 'bench_income'
+SCORE_OUTGO = 'bench_outgo'
+
+
+def create_test_app(data_dir = None):
+    '''
+    在临时数据目录中创建完整加载插件的app
+    环境变量中已有的DATA_DIR可能指向正式数据，不使用，测试数据只写入新建或指定的空目录
+    :param data_dir: 数据目录，须为空目录，为空时新建临时目录
+    :return: flask app
+    '''
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix = 'biz-bench-')
+    elif os.path.isdir(data_dir) and len(os.listdir(data_dir)) > 0:
+        raise RuntimeError('数据目录不是空目录：' + data_dir)
+    os.environ['DATA_DIR'] = data_dir
+    sys.path.insert(0, os.path.split(os.path.realpath(__file__))[0])
+
+    from app import create_app
+
+    return create_app()
+
+
+def prepare_bot(botid = BOTID):
+    '''
+    创建测试机器人、API Key及清洗规则
+    :param botid: 机器人ID
+    :return: 请求header
+    '''
+    import db_control
+    from common.apikey import APIKey
+    from common.basedata import Basedata
+    from common.bot import Bot, BotAssign
+    from plugins.setting import TargetRule
+    from plugins.speak import SpeakWash
+
+    db = db_control.get_db()
+    db.session.add(Bot(id = botid, name = botid, active = 1))
+    db.session.add(BotAssign(botid = botid, username = 'admin'))
+    for (code, name, value) in WASH_RULES:
+        if Basedata.find_by_code(code) is None:
+            db.session.add(Basedata(code = code, name = name, value = value, type = 2))
+    key = APIKey(botid = botid)
+    db.session.add(key)
+    db.session.commit()
+
+    for (code, name, value) in WASH_RULES:
+        SpeakWash.create(botid, code, 0, name)
+    for target in TARGETS:
+        TargetRule.create(botid, 'allow', 'g#' + target)
+
+    return {'Authorization': json.dumps({'api_key': key.key})}
+
+
+def make_speak(i, members = 50):
+    return {'target_type': 'group',
+            'target_account': TARGETS[i % len(TARGETS)],
+            'sender_id': str(20000 + i % members),
+            'sender_name': '成员' + str(i % members),
+            'message': random.choice(MESSAGES)}
+
+
+def generate(botids, members, speak_rows, days, sign_rows, point_rows, score_rows, batch_size = 5000):
+    '''
+    为各机器人批量生成days天内的发言、签到、报点及积分流水数据，发言统计同步累加
+    :param botids: 已由prepare_bot创建的机器人ID列表
+    :param members: 每个目标的成员数
+    :return: 各类数据的行数及生成耗时
+    '''
+    from datetime import timedelta
+
+    import db_control
+    from common.util import get_now
+    from plugins.point import Point
+    from plugins.score import ScoreAccount, ScoreMember, ScoreRecord, ScoreRule
+    from plugins.sign import Sign
+    from plugins.speak import Speak, SpeakWash
+
+    db = db_control.get_db()
+    engine = db.get_engine(bind = 'score')
+    now = get_now().replace(tzinfo = None)
+    start = time.perf_counter()
+
+    def day(i):
+        return now - timedelta(days = i % days, seconds = i % 3600)
+
+    for botid in botids:
+        rules = SpeakWash.get_rules(botid)
+        for offset in range(0, speak_rows, batch_size):
+            Speak.insert_rows([Speak.make_row(botid, rules, day(i), make_speak(i, members))
+                               for i in range(offset, min(speak_rows, offset + batch_size))])
+
+        with engine.begin() as conn:
+            conn.execute(Sign.__table__.insert(),
+                         [{'botid': botid, 'target': 'g#' + TARGETS[i % len(TARGETS)],
+                           'member_id': str(20000 + i % members), 'member_name': '成员' + str(i % members),
+                           'date': day(i).date(), 'time': day(i).time(), 'create_at': day(i), 'message': '签到'}
+                          for i in range(sign_rows)])
+            conn.execute(Point.__table__.insert(),
+                         [{'botid': botid, 'target': 'g#' + TARGETS[i % len(TARGETS)],
+                           'member_id': str(20000 + i % members), 'member_name': '成员' + str(i % members),
+                           'reporter_id': str(20000 + (i + 1) % members),
+                           'reporter_name': '成员' + str((i + 1) % members),
+                           'point': 1, 'has_confirmed': i % 2, 'is_newbie': 0,
+                           'date': day(i).date(), 'time': day(i).time(), 'create_at': day(i), 'update_at': day(i),
+                           'message': '报点'}
+                          for i in range(point_rows)])
+
+        account = botid + '_score'
+        db.session.add(ScoreAccount(botid = botid, name = account, is_default = 1, target = 'g#' + TARGETS[0],
+                                    income = 0, outgo = 0, balance = 0))
+        db.session.add(ScoreRule(account = account, code = SCORE_INCOME, type = 'income', amount = 10))
+        db.session.add(ScoreRule(account = account, code = SCORE_OUTGO, type = 'outgo', amount = 5))
+        for m in range(members):
+            db.session.add(ScoreMember(account = account, member_id = str(20000 + m), member_name = '成员' + str(m),
+                                       income = 0, outgo = 0, balance = 0))
+        db.session.commit()
+        with engine.begin() as conn:
+            conn.execute(ScoreRecord.__table__.insert(),
+                         [{'account': account, 'biz_type': SCORE_INCOME if i % 3 else SCORE_OUTGO,
+                           'trans_type': 'income' if i % 3 else 'outgo',
+                           'member_id': str(20000 + i % members), 'member_name': '成员' + str(i % members),
+                           'amount': 10 if i % 3 else 5, 'before': 0, 'after': 0,
+                           'date': day(i).date(), 'time': day(i).time(), 'create_at': day(i), 'remark': ''}
+                          for i in range(score_rows)])
+
+    return {'bots': len(botids),
+            'members': members,
+            'days': days,
+            'speak_rows': speak_rows * len(botids),
+            'sign_rows': sign_rows * len(botids),
+            'point_rows': point_rows * len(botids),
+            'score_rows': score_rows * len(botids),
+            'seconds': round(time.perf_counter() - start, 3)}
+
+
+def _result(rows, seconds):
+    return {'rows': rows,
+            'seconds': round(seconds, 3),
+            'rows_per_sec': round(rows / seconds, 1) if seconds > 0 else None}
+
+
+def _timing(samples):
+    '''
+    :param samples: 每次调用的耗时(秒)列表
+    '''
+    samples = sorted(samples)
+    return {'requests': len(samples),
+            'ms_avg': round(sum(samples) * 1000 / len(samples), 3),
+            'ms_p50': round(samples[len(samples) // 2] * 1000, 3),
+            'ms_p95': round(samples[min(int(len(samples) * 0.95), len(samples) - 1)] * 1000, 3)}
+
+
+def _date_range(days):
+    from datetime import timedelta
+
+    from common.util import get_now
+
+    today = get_now().date()
+    return ((today - timedelta(days = days - 1)).strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d'))
+
+
+def bench_api(client, headers, method, url, params, rounds):
+    '''
+    按params中的各组参数轮流调用API，每组参数调用rounds次
+    :param params: 参数列表，GET请求作为查询参数，POST请求作为表单
+    '''
+    samples = []
+    for i in range(rounds):
+        for param in params:
+            start = time.perf_counter()
+            if method == 'GET':
+                resp = client.get(url, headers = headers, query_string = param)
+            else:
+                resp = client.post(url, headers = headers, data = param)
+            samples.append(time.perf_counter() - start)
+            assert resp.status_code == 200 and json.loads(resp.data)['success'] == 1, resp.data
+    return _timing(samples)
+
+
+def bench_speakcount_do(botid, days, rounds):
+    '''
+    对各目标全量重新计算days天内的发言统计
+    '''
+    from plugins.speak import SpeakCount
+
+    (date_from, date_to) = _date_range(days)
+    samples = []
+    for i in range(rounds):
+        for target in TARGETS:
+            start = time.perf_counter()
+            SpeakCount.do(botid, 'group', target, date_from, date_to)
+            samples.append(time.perf_counter() - start)
+    return _timing(samples)
+
+
+def bench_speakrecord(client, headers, rows):
+    '''
+    逐条调用/speakrecord写入
+    '''
+    start = time.perf_counter()
+    for i in range(rows):
+        resp = client.post('/speakrecord', headers = headers, data = make_speak(i))
+        assert resp.status_code == 200, resp.data
+    return _result(rows, time.perf_counter() - start)
+
+
+def bench_speakrecords(client, headers, rows, batch_size):
+    '''
+    按批调用/speakrecords写入
+    '''
+    start = time.perf_counter()
+    for offset in range(0, rows, batch_size):
+        records = [make_speak(i) for i in range(offset, min(offset + batch_size, rows))]
+        resp = client.post('/speakrecords', headers = headers, json = {'records': records})
+        assert resp.status_code == 200, resp.data
+    return _result(rows, time.perf_counter() - start)
+
+
+def bench_dashboard(client, rounds):
+    '''
+    以admin登录后按仪表板的方式请求统计数据，每轮包括汇总数据及各目标的发言统计、排行榜
+    '''
+    resp = client.post('/admin/login/', data = {'username': 'admin', 'password': 'admin'})
+    assert resp.status_code == 302, resp.data
+
+    queries = [{'type': 1, 'botid': BOTID}]
+    for target in TARGETS:
+        queries.append({'type': 2, 'botid': BOTID, 'target': 'g#' + target, 'days': 30})
+        queries.append({'type': 4, 'botid': BOTID, 'target': 'g#' + target, 'days': 7})
+
+    start = time.perf_counter()
+    for i in range(rounds):
+        for query in queries:
+            resp = client.get('/admin/statistics/', query_string = query)
+            assert resp.status_code == 200 and json.loads(resp.data)['success'] == 1, resp.data
+    seconds = time.perf_counter() - start
+    return {'rounds': rounds,
+            'requests': rounds * len(queries),
+            'seconds': round(seconds, 3),
+            'ms_per_round': round(seconds * 1000 / rounds, 2) if rounds > 0 else None}
+
+
+def bench_rewash(rows, workers):
+    '''
+    对同一目标下的rows条发言记录分别以单进程和workers个进程重新清洗，进程数不受rewash.workers配置限制
+    '''
+    from common.util import get_now, get_target_composevalue
+    from plugins.speak import Speak, SpeakWash, wash_progress
+
+    rules = SpeakWash.get_rules(BOTID)
+    now = get_now()
+    records = [dict(make_speak(i), target_account = 'rewash') for i in range(rows)]
+    Speak.insert_rows([Speak.make_row(BOTID, rules, now, record) for record in records])
+    date = now.strftime('%Y-%m-%d')
+
+    results = {}
+    for (name, count) in (('serial', 1), ('parallel', workers)):
+        start = time.perf_counter()
+        Speak.updatewash(BOTID, 'group', 'rewash', date, date, workers = count)
+        results[name] = _result(rows, time.perf_counter() - start)
+        # 报告实际使用的进程数
+        results[name]['workers'] = wash_progress[(BOTID, get_target_composevalue('group', 'rewash'))].workers
+    results['speedup'] = round(results['serial']['seconds'] / results['parallel']['seconds'], 2)
+    return results
+
+
+def run(args):
+    '''
+    生成数据并执行全部测试
+    :return: 测试结果
+    '''
+    random.seed(args.seed)
+    app = create_test_app(args.data_dir)
+    botids = [BOTID] + [BOTID + str(i) for i in range(2, args.bots + 1)]
+    bot_headers = [prepare_bot(botid) for botid in botids]
+    headers = bot_headers[0]
+    client = app.test_client()
+
+    results = {'generate': generate(botids, args.members, args.speak_rows, args.days,
+                                    args.sign_rows, args.point_rows, args.score_rows)}
+
+    results['speakrecord'] = bench_speakrecord(client, headers, args.rows)
+    results['speakrecords'] = bench_speakrecords(client, headers, args.rows, args.batch_size)
+    results['speakrecords']['batch_size'] = args.batch_size
+
+    (date_from, date_to) = _date_range(args.days)
+    target_params = [{'target_type': 'group', 'target_account': target, 'date_from': date_from, 'date_to': date_to}
+                     for target in TARGETS]
+    results['speaktop'] = bench_api(client, headers, 'GET', '/speaktop', target_params, args.rounds)
+    results['speakcount'] = bench_api(client, headers, 'GET', '/speakcount',
+                                      [dict(p, sender = str(20000 + i)) for (i, p) in enumerate(target_params)],
+                                      args.rounds)
+    results['speaktatistics'] = bench_api(client, headers, 'GET', '/speaktatistics', target_params, args.rounds)
+    results['speakcount_do'] = bench_speakcount_do(BOTID, args.days, args.rounds)
+    results['score_change'] = bench_api(client, headers, 'POST', '/score_change',
+                                        [{'biz_type': SCORE_INCOME, 'member_id': str(20000 + i)} for i in range(10)],
+                                        args.rounds)
+    results['dashboard'] = bench_dashboard(client, args.rounds)
+    results['rewash'] = bench_rewash(args.rewash_rows, args.workers)
+    return results
+
+
+def get_meta(args):
+    import platform
+    import sqlite3
+    import subprocess
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr = subprocess.DEVNULL,
+                                         cwd = os.path.split(os.path.realpath(__file__))[0]).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'cpus': os.cpu_count(),
+            'args': vars(args)}
+
+
+# 越大越好的指标，其他指标越小越好
+HIGHER_IS_BETTER = ('rows_per_sec',)
+COMPARED_METRICS = ('rows_per_sec', 'ms_avg', 'ms_p95', 'ms_per_round')
+
+
+def compare(base, current, tolerance, path = ''):
+    '''
+    对比两次测试结果
+    :param tolerance: 允许的变差比例
+    :return: (指标, 对比前, 对比后, 变化比例, 是否变差超出允许范围)列表
+    '''
+    rows = []
+    for (key, value) in current.items():
+        name = path + '.' + key if path else key
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            rows.extend(compare(base[key], value, tolerance, name))
+        elif key in COMPARED_METRICS and isinstance(base.get(key), (int, float)) and base.get(key) and value:
+            change = (value - base[key]) / base[key]
+            worse = -change if key in HIGHER_IS_BETTER else change
+            rows.append((name, base[key], value, round(change, 3), worse > tolerance))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description = '性能基准测试')
+    parser.add_argument('--bots', type = int, default = 2, help = '生成数据的机器人数')
+    parser.add_argument('--members', type = int, default = 200, help = '每个目标的成员数')
+    parser.add_argument('--days', type = int, default = 30, help = '生成数据的天数')
+    parser.add_argument('--speak-rows', type = int, default = 50000, help = '每个机器人生成的发言记录数')
+    parser.add_argument('--sign-rows', type = int, default = 5000, help = '每个机器人生成的签到记录数')
+    parser.add_argument('--point-rows', type = int, default = 5000, help = '每个机器人生成的报点记录数')
+    parser.add_argument('--score-rows', type = int, default = 20000, help = '每个机器人生成的积分流水数')
+    parser.add_argument('--rows', type = int, default = 2000, help = '写入测试的发言记录数')
+    parser.add_argument('--batch-size', type = int, default = 100, help = '/speakrecords每批的记录数')
+    parser.add_argument('--rounds', type = int, default = 20, help = '查询类测试的轮数')
+    parser.add_argument('--rewash-rows', type = int, default = 50000, help = '重新清洗测试的发言记录数')
+    parser.add_argument('--workers', type = int, default = os.cpu_count(), help = '并行重新清洗的进程数')
+    parser.add_argument('--seed', type = int, default = 1, help = '随机数种子')
+    parser.add_argument('--data-dir', help = '数据目录，须为空目录，默认新建临时目录')
+    parser.add_argument('--output', help = '结果JSON文件')
+    parser.add_argument('--compare', help = '对比的基准结果JSON文件，有指标变差超出允许范围时以非0状态退出')
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = '对比时允许的变差比例')
+    args = parser.parse_args()
+
+    output = {'meta': get_meta(args), 'results': run(args)}
+    text = json.dumps(output, indent = 2, ensure_ascii = False, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w', encoding = 'utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+
+    if args.compare:
+        with open(args.compare, encoding = 'utf-8') as f:
+            base = json.load(f)
+        rows = compare(base.get('results', {}), output['results'], args.tolerance)
+        for (name, old, new, change, regressed) in rows:
+            print('%-40s %12s %12s %+8.1f%%%s' % (name, old, new, change * 100, '  REGRESSION' if regressed else ''),
+                  file = sys.stderr)
+        if any(row[4] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,9 @@ from wtforms import validators, StringField
 import db_control
 from app_view import CVAdminModelView
 from common.bot import Bot
+from common.cache import Cache
 from common.util import get_now, display_datetime, generate_key, get_botname
+from env import get_config as config
 from plugin import PluginsRegistry
 
 __registry__ = pr = PluginsRegistry()
@@ -31,10 +33,31 @@ class APIKey(db.Model):
     create_at = db.Column(db.DateTime, nullable = False, default = lambda: get_now())
     update_at = db.Column(db.DateTime, nullable = False, default = lambda: get_now(), onupdate = lambda: get_now())
 
+    key_cache = Cache('apikey',
+                      maxsize = config().get('cache_size', {}).get('apikey'),
+                      ttl = config().get('cache_ttl', {}).get('apikey'))
+
     @staticmethod
     def find_by_key(key):
         return APIKey.query.filter_by(key = key).first()
 
+    @staticmethod
+    def get_botid(key):
+        '''
+        获取api_key所属的机器人ID，命中缓存时不访问数据库
+        :param key: api_key
+        :return: 机器人ID，api_key不存在时返回None
+        '''
+        botid = APIKey.key_cache.get(key)
+        if botid is None:
+            generation = APIKey.key_cache.generation()
+            record = APIKey.find_by_key(key)
+            if record is None:
+                return None
+            botid = record.botid
+            APIKey.key_cache.set(key, botid, generation)
+        return botid
+
     @staticmethod
     def find_by_bot(botid):
         return APIKey.query.filter_by(bitid = botid).first()
@@ -48,9 +71,11 @@ class APIKey(db.Model):
         '''
         APIKey.query.filter_by(botid = botid).delete()
         APIKey.query.session.commit()
+        APIKey.key_cache.clear()
         return True
 
     def refresh(self):
+        APIKey.key_cache.invalidate(self.key)
         self.key = generate_key(32, True, False, True)
         self.secret = generate_key(12, False, True, True)
         self.query.session.commit()
@@ -124,9 +149,13 @@ class APIKeyView(CVAdminModelView):
     def on_model_change(self, form, model, is_created):
         if not is_created:
             if form.new_key.data:
+                APIKey.key_cache.invalidate(model.key)
                 model.key = form.new_key.data
                 model.secret = form.new_secret.data
 
+    def after_model_delete(self, model):
+        APIKey.key_cache.invalidate(model.key)
+
     @expose('/refresh/', methods = ('GET', 'POST'))
     def refresh_view(self):
         """
@@ -139,6 +168,3 @@ class APIKeyView(CVAdminModelView):
             self.get_one(id).refresh()
 
         return redirect(return_url)
-
-
-db.create_all()
\ No newline at end of file
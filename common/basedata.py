@@ -10,6 +10,25 @@ __registry__ = pr = PluginsRegistry()
 db = db_control.get_db()
 
 
+class BasedataRegistry():
+    def __init__(self):
+        self.change_map = {}
+
+    def register_change(self):
+        def decorator(func):
+            self.change_map[func.__qualname__] = func
+            return func
+
+        return decorator
+
+
+basedatahub = BasedataRegistry()
+
+
+def basedata_registry():
+    return basedatahub
+
+
 @pr.register_model(91)
 class Basedata(db.Model):
     __bind_key__ = 'default'
@@ -40,6 +59,18 @@ class Basedata(db.Model):
     def find(id):
         return Basedata.query.get(id)
 
+    @staticmethod
+    def notify_change(basedata):
+        '''
+        通知已注册的监听函数基础数据发生了变化
+        :param basedata: 变化的基础数据
+        :return: 是否成功
+        '''
+        for (func_k, func_v) in basedatahub.change_map.items():
+            func_v(basedata)
+        return True
+
+
 @pr.register_view()
 class BasedataView(CVAdminModelView):
     can_create = True
@@ -65,6 +96,12 @@ class BasedataView(CVAdminModelView):
         else:
             return False
 
+    def after_model_change(self, form, model, is_created):
+        Basedata.notify_change(model)
+
+    def after_model_delete(self, model):
+        Basedata.notify_change(model)
+
             # def get_create_form(self):
             #     form = self.scaffold_form()
             #     form.id = StringField('机器人ID', [validators.required(message = '机器人ID是必填字段')])
@@ -76,6 +113,3 @@ class BasedataView(CVAdminModelView):
             #     form.id = StringField('机器人ID', render_kw = {'readonly': True})
             #     form.active = fields.BooleanField('启用状态', [validators.required(message = '启用状态是必填字段')])
             #     return form
-
-
-db.create_all()
\ No newline at end of file
@@ -242,6 +242,3 @@ class BotAssignView(CVAdminModelView):
 
     def after_model_delete(self, model):
         BotAssign.destroy(model.botid)
-
-
-db.create_all()
\ No newline at end of file
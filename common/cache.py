@@ -0,0 +1,134 @@
+'''
+    进程内缓存
+'''
+import threading
+import time
+from collections import OrderedDict
+
+
+class Cache:
+    def __init__(self, name, maxsize = None, ttl = None):
+        '''
+        :param name: 缓存名称
+        :param maxsize: 最大条目数，超出时淘汰最久未使用的条目，None表示不限制
+        :param ttl: 条目有效期(秒)，None表示不过期
+        '''
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._coalesced = 0
+        self._generation = 0
+        # 键 -> 正在执行的加载
+        self._loading = {}
+
+    def get(self, key, loader = None):
+        '''
+        读取缓存
+        :param key: 键
+        :param loader: 未命中时加载值的函数，参数为key，返回值写入缓存；
+                       同一个键同时只执行一次加载，其间读取该键的线程等待并共用加载结果
+        :return: 未命中且没有loader时返回None
+        '''
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (item[1] is None or item[1] > time.monotonic()):
+                self._data.move_to_end(key)
+                self._hits += 1
+                return item[0]
+            self._misses += 1
+            generation = self._generation
+            if loader is None:
+                return None
+            flight = self._loading.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._loading[key] = _Flight()
+            else:
+                self._coalesced += 1
+        if not leader:
+            return flight.wait()
+        try:
+            flight.value = loader(key)
+            # 加载期间缓存被失效时，加载到的可能是旧数据，不写入缓存
+            self.set(key, flight.value, generation)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            flight.done.set()
+        return flight.value
+
+    def generation(self):
+        '''
+        :return: 当前的失效代数，先取代数再加载数据，写入时传入set可避免写入加载期间已失效的数据
+        '''
+        with self._lock:
+            return self._generation
+
+    def set(self, key, value, generation = None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else None)
+            self._data.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last = False)
+
+    def values(self):
+        '''
+        :return: 未过期的缓存值列表
+        '''
+        now = time.monotonic()
+        with self._lock:
+            return [item[0] for item in self._data.values() if item[1] is None or item[1] > now]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._invalidations += 1
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += 1
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self):
+        '''
+        :return: 缓存条目数及命中统计
+        '''
+        with self._lock:
+            total = self._hits + self._misses
+            return {'name': self.name,
+                    'size': len(self._data),
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'hit_rate': round(self._hits / total, 4) if total > 0 else 0.0,
+                    'coalesced': self._coalesced,
+                    'invalidations': self._invalidations}
+
+
+class _Flight:
+    '''
+    一次正在执行的加载
+    '''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
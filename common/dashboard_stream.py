@@ -0,0 +1,313 @@
+'''
+    仪表板推送
+
+    写入发言、签到、确认报点及积分变动时按(机器人, 目标, 日期)累加增量，
+    由后台线程每隔interval秒合并写入scheduler数据库的dashboard_delta表，多进程部署时各工作进程的增量都写入该表。
+    仪表板以Server-Sent Events连接/admin/statistics/stream/，连接时先收到汇总数据，之后收到所属目标的增量；
+    汇总数据在记下dashboard_delta的最大ID(水位)之后计算，连接只收到ID大于水位的增量，避免重复累加或遗漏；
+    每个进程只有一个线程轮询dashboard_delta表并分发给本进程的全部连接，查询次数与打开的仪表板数无关。
+    每个连接占用一个工作线程，超出max_streams时返回503，仪表板改为定时刷新汇总数据。
+    各目标在dashboard_delta表中的最大ID与本进程发布增量的次数组成该目标的写入水位，用于判断统计数据的缓存是否有效。
+'''
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+import db_control
+import plugin
+from common.util import get_now
+from env import get_config as config
+
+db = db_control.get_db()
+
+# 增量的统计项，与汇总数据中的speak_today_count、sign_today_count、point_today_total、score_today_total对应
+FIELDS = ('speak', 'sign', 'point', 'score')
+
+
+# 只用于进程间传递增量，不在管理界面中显示
+class DashboardDelta(db.Model):
+    __bind_key__ = 'scheduler'
+    __tablename__ = 'dashboard_delta'
+    id = db.Column(db.Integer, primary_key = True, autoincrement = True)
+    botid = db.Column(db.String(20), nullable = False)
+    target = db.Column(db.String(20), nullable = False)
+    date = db.Column(db.Date, nullable = False)
+    speak = db.Column(db.Integer, nullable = False, default = 0)
+    sign = db.Column(db.Integer, nullable = False, default = 0)
+    point = db.Column(db.Integer, nullable = False, default = 0)
+    score = db.Column(db.Integer, nullable = False, default = 0)
+    create_at = db.Column(db.DateTime, nullable = False, default = lambda: get_now())
+
+    # 查询目标的写入水位时在索引上定位最大ID
+    __table_args__ = (db.Index('ix_dashboard_delta_botid_target', 'botid', 'target', 'id'),)
+
+
+class DeltaHub:
+    def __init__(self, enabled = True, interval = 1, max_streams = 4, keep_rows = 10000):
+        '''
+        :param enabled: 是否记录及推送增量
+        :param interval: 增量写入及轮询的间隔(秒)
+        :param max_streams: 每个进程同时推送的最大连接数
+        :param keep_rows: dashboard_delta表中保留的最大记录数
+        '''
+        self.enabled = enabled
+        self.interval = interval
+        self.keep_rows = keep_rows
+        self._streams = threading.BoundedSemaphore(max_streams)
+        self._lock = threading.Condition()
+        # (botid, target, date) -> [speak, sign, point, score]
+        self._pending = {}
+        # (botid, target) -> 本进程发布增量的次数，尚未写入dashboard_delta的增量也使写入水位改变
+        self._versions = {}
+        # 接收增量的队列 -> 该连接的水位，只分发ID大于水位的增量
+        self._subscribers = {}
+        # 轮询线程已分发的最大增量ID，没有连接时为None
+        self._last_id = None
+        self._writer_pid = None
+        self._poller_pid = None
+
+    def publish(self, botid, target, date, **deltas):
+        '''
+        累加增量，不访问数据库
+        :param date: 数据所属日期
+        :param deltas: speak、sign、point、score的增量
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self._ensure_writer()
+            item = self._pending.get((botid, target, date))
+            if item is None:
+                item = self._pending[(botid, target, date)] = [0] * len(FIELDS)
+            for (i, field) in enumerate(FIELDS):
+                item[i] += deltas.get(field, 0)
+            self._versions[(botid, target)] = self._versions.get((botid, target), 0) + 1
+
+    def touch(self, botid, target):
+        '''
+        立即写入一条为0的增量，使各进程中该目标的写入水位改变，用于重新计算发言统计等不产生增量的修改
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self._versions[(botid, target)] = self._versions.get((botid, target), 0) + 1
+        try:
+            self._write({(botid, target, get_now().date()): [0] * len(FIELDS)})
+        except Exception as e:
+            print('Failed to write dashboard deltas: ' + str(e), file = sys.stderr)
+
+    def watermark(self, targets):
+        '''
+        :param targets: (机器人ID, 目标)列表
+        :return: 各目标的写入水位，目标有新的增量后改变；未开启时返回None
+        '''
+        if not self.enabled:
+            return None
+        ids = {}
+        if len(targets) > 0:
+            # 按目标分组一次查出，查询次数与目标数无关
+            table = DashboardDelta.__table__
+            query = db.select([table.c.botid, table.c.target, db.func.max(table.c.id)]).where(
+                db.and_(table.c.botid.in_({botid for (botid, target) in targets}),
+                        table.c.target.in_({target for (botid, target) in targets}))
+            ).group_by(table.c.botid, table.c.target)
+            with db.get_engine(bind = 'scheduler').connect() as conn:
+                ids = {(r[0], r[1]): r[2] for r in conn.execute(query)}
+        with self._lock:
+            return tuple((ids.get(key), self._versions.get(key, 0)) for key in targets)
+
+    def snapshot(self):
+        '''
+        先写入本进程尚未写入的增量，再读取dashboard_delta的最大ID，须在计算汇总数据之前调用
+        :return: 水位，汇总数据已包含ID不大于水位的增量
+        '''
+        self.flush()
+        table = DashboardDelta.__table__
+        with db.get_engine(bind = 'scheduler').connect() as conn:
+            return conn.execute(db.select([db.func.max(table.c.id)])).scalar() or 0
+
+    def get_changed_targets(self, after_id, field = 'speak'):
+        '''
+        :param after_id: 上次读取到的增量ID
+        :param field: 统计项
+        :return: (after_id之后该统计项有增量或由touch写入增量的(机器人ID, 目标)集合, 读取到的最大ID)，
+                 after_id之后的增量已被清理时集合为None
+        '''
+        table = DashboardDelta.__table__
+        with db.get_engine(bind = 'scheduler').connect() as conn:
+            (min_id, max_id) = conn.execute(db.select([db.func.min(table.c.id), db.func.max(table.c.id)])).first()
+            if max_id is None or max_id <= after_id:
+                return (set(), after_id)
+            if min_id > after_id + 1:
+                return (None, max_id)
+            records = conn.execute(
+                db.select([table.c.botid, table.c.target]).distinct().where(
+                    db.and_(table.c.id > after_id, table.c.id <= max_id,
+                            db.or_(table.c[field] != 0, db.and_(*[table.c[f] == 0 for f in FIELDS]))))).fetchall()
+        return ({(r.botid, r.target) for r in records}, max_id)
+
+    def subscribe(self, watermark):
+        '''
+        :param watermark: snapshot返回的水位
+        :return: 接收增量列表的队列，连接数已达上限时返回None
+        '''
+        if not self._streams.acquire(blocking = False):
+            return None
+        subscriber = queue.Queue()
+        with self._lock:
+            self._ensure_poller()
+            if self._last_id is None:
+                self._last_id = watermark
+            last_id = self._last_id
+            self._subscribers[subscriber] = watermark
+            self._lock.notify_all()
+        if last_id > watermark:
+            # 轮询线程已分发了水位之后的部分增量，为本连接补读
+            try:
+                message = self._aggregate(self._read(watermark, last_id))
+                if len(message) > 0:
+                    subscriber.put(message)
+            except Exception as e:
+                print('Failed to read dashboard deltas: ' + str(e), file = sys.stderr)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.pop(subscriber, None)
+        self._streams.release()
+
+    def flush(self):
+        '''
+        写入本进程尚未写入的增量
+        '''
+        with self._lock:
+            (pending, self._pending) = (self._pending, {})
+        if len(pending) > 0:
+            self._write(pending)
+
+    def _ensure_writer(self):
+        # fork后的子进程不继承后台线程，按进程号重新启动
+        if self._writer_pid != os.getpid():
+            self._writer_pid = os.getpid()
+            self._pending = {}
+            threading.Thread(target = self._run_writer, name = 'dashboard-delta-writer', daemon = True).start()
+
+    def _ensure_poller(self):
+        if self._poller_pid != os.getpid():
+            self._poller_pid = os.getpid()
+            self._subscribers = {}
+            self._last_id = None
+            threading.Thread(target = self._run_poller, name = 'dashboard-delta-poller', daemon = True).start()
+
+    def _run_writer(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print('Failed to write dashboard deltas: ' + str(e), file = sys.stderr)
+
+    def _write(self, pending):
+        table = DashboardDelta.__table__
+        now = get_now().replace(tzinfo = None)
+        rows = [dict(zip(FIELDS, values), botid = botid, target = target, date = date, create_at = now)
+                for ((botid, target, date), values) in pending.items()]
+        with db.get_engine(bind = 'scheduler').begin() as conn:
+            conn.execute(table.insert(), rows)
+            last_id = conn.execute(db.select([db.func.max(table.c.id)])).scalar() or 0
+            conn.execute(table.delete().where(table.c.id <= last_id - self.keep_rows))
+
+    def _read(self, after_id, to_id = None):
+        '''
+        :return: ID大于after_id且不大于to_id的增量记录
+        '''
+        table = DashboardDelta.__table__
+        condition = table.c.id > after_id
+        if to_id is not None:
+            condition = db.and_(condition, table.c.id <= to_id)
+        with db.get_engine(bind = 'scheduler').connect() as conn:
+            return conn.execute(table.select().where(condition).order_by(table.c.id)).fetchall()
+
+    @staticmethod
+    def _aggregate(records):
+        '''
+        按(机器人, 目标, 日期)合并增量记录
+        :return: 推送给连接的增量列表
+        '''
+        deltas = {}
+        for r in records:
+            key = (r.botid, r.target, r.date.strftime('%Y-%m-%d'))
+            item = deltas.setdefault(key, [0] * len(FIELDS))
+            for (i, field) in enumerate(FIELDS):
+                item[i] += r[field]
+        return [dict(zip(FIELDS, values), botid = botid, target = target, date = date)
+                for ((botid, target, date), values) in deltas.items()]
+
+    def _run_poller(self):
+        while True:
+            with self._lock:
+                while len(self._subscribers) == 0:
+                    # 没有连接时不轮询，恢复后从新连接的水位开始
+                    self._last_id = None
+                    self._lock.wait()
+                last_id = self._last_id
+            try:
+                records = self._read(last_id)
+            except Exception as e:
+                print('Failed to read dashboard deltas: ' + str(e), file = sys.stderr)
+                records = []
+            if len(records) > 0:
+                message = self._aggregate(records)
+                with self._lock:
+                    self._last_id = records[-1].id
+                    for (subscriber, watermark) in self._subscribers.items():
+                        if watermark < records[0].id:
+                            subscriber.put(message)
+                        else:
+                            # 连接的水位之前的增量已包含在其汇总数据中
+                            partial = self._aggregate([r for r in records if r.id > watermark])
+                            if len(partial) > 0:
+                                subscriber.put(partial)
+            time.sleep(self.interval)
+
+
+_stream_config = config().get('dashboard_stream', {})
+
+delta_hub = DeltaHub(enabled = _stream_config.get('enabled', True),
+                     interval = _stream_config.get('interval', 1),
+                     max_streams = _stream_config.get('max_streams', 4),
+                     keep_rows = _stream_config.get('keep_rows', 10000))
+
+
+def _event(name, data):
+    return 'event: %s\ndata: %s\n\n' % (name, json.dumps(data, ensure_ascii = False))
+
+
+def stream(subscriber, targets, summary):
+    '''
+    生成推送给一个仪表板的事件，连接达到timeout秒或进程退出时结束，由浏览器自动重连
+    :param subscriber: delta_hub.subscribe返回的队列，由调用方在响应关闭时取消订阅
+    :param targets: 仪表板所属的(机器人ID, 目标)集合
+    :param summary: 连接时的汇总数据
+    '''
+    deadline = time.time() + _stream_config.get('timeout', 300)
+    heartbeat = _stream_config.get('heartbeat', 15)
+    yield 'retry: %d\n\n' % (_stream_config.get('retry', 3) * 1000)
+    yield _event('summary', summary)
+    last_sent = time.time()
+    while time.time() < deadline and not plugin.stopping.is_set():
+        try:
+            message = subscriber.get(timeout = 1)
+        except queue.Empty:
+            if time.time() - last_sent >= heartbeat:
+                # 注释行用于尽早发现已断开的连接
+                last_sent = time.time()
+                yield ': ping\n\n'
+            continue
+        for delta in message:
+            if (delta['botid'], delta['target']) in targets:
+                last_sent = time.time()
+                yield _event('delta', delta)
@@ -0,0 +1,226 @@
+'''
+    请求及SQL指标
+
+    按endpoint统计请求数及延迟直方图，按endpoint及数据库绑定统计SQL语句数及耗时，
+    按数据库绑定统计SQLite锁等待及锁超时次数，以Prometheus文本格式从/metrics输出。
+    指标保存在进程内，多进程部署时每个工作进程分别统计，每条指标带有进程号(pid)标签，
+    每次抓取可能由不同的工作进程响应，按pid区分各进程的计数器，汇总时用sum without(pid)。
+'''
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import request, g, has_request_context, Response, abort
+from sqlalchemy import event
+
+import db_control
+from env import get_config as config
+
+# 延迟直方图的桶上限(秒)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 请求之外(后台线程、启动过程)执行的SQL计入的endpoint
+BACKGROUND = 'background'
+
+# 写语句首先要取得数据库的写锁，被其他连接占用时在busy_timeout内等待，耗时超过阈值的写语句计为一次锁等待
+WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+class Histogram:
+    def __init__(self, buckets = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        # (endpoint, method, status) -> 请求数
+        self.requests = {}
+        # (endpoint, method) -> 延迟直方图
+        self.latency = {}
+        # (endpoint, bind) -> [语句数, 耗时]
+        self.sql = {}
+        # bind -> 锁等待次数
+        self.lock_waits = {}
+        # bind -> busy_timeout内未取得锁(database is locked)的次数
+        self.lock_errors = {}
+
+    def observe_request(self, endpoint, method, status, seconds):
+        with self._lock:
+            key = (endpoint, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get((endpoint, method))
+            if histogram is None:
+                histogram = self.latency[(endpoint, method)] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_sql(self, endpoint, bind, seconds):
+        with self._lock:
+            item = self.sql.get((endpoint, bind))
+            if item is None:
+                item = self.sql[(endpoint, bind)] = [0, 0.0]
+            item[0] += 1
+            item[1] += seconds
+
+    def observe_lock(self, bind, error = False):
+        with self._lock:
+            counter = self.lock_errors if error else self.lock_waits
+            counter[bind] = counter.get(bind, 0) + 1
+
+    def render(self):
+        '''
+        :return: Prometheus文本格式的指标
+        '''
+        with self._lock:
+            requests = sorted(self.requests.items())
+            latency = sorted((k, (list(h.counts), h.sum, h.count)) for (k, h) in self.latency.items())
+            sql = sorted((k, tuple(v)) for (k, v) in self.sql.items())
+            lock_waits = sorted(self.lock_waits.items())
+            lock_errors = sorted(self.lock_errors.items())
+
+        pid = os.getpid()
+        lines = ['# HELP biz_process_start_time_seconds Start time of the process since unix epoch.',
+                 '# TYPE biz_process_start_time_seconds gauge',
+                 'biz_process_start_time_seconds{pid="%d"} %.3f' % (pid, self.start_time),
+                 '# HELP biz_http_requests_total Total HTTP requests by endpoint, method and status.',
+                 '# TYPE biz_http_requests_total counter']
+        for ((endpoint, method, status), count) in requests:
+            lines.append('biz_http_requests_total{%s} %d' %
+                         (_labels(pid = pid, endpoint = endpoint, method = method, status = status), count))
+
+        lines.extend(['# HELP biz_http_request_duration_seconds HTTP request latency by endpoint and method.',
+                      '# TYPE biz_http_request_duration_seconds histogram'])
+        for ((endpoint, method), (counts, total, count)) in latency:
+            cumulative = 0
+            for (bound, bucket_count) in zip(BUCKETS + (float('inf'),), counts):
+                cumulative += bucket_count
+                lines.append('biz_http_request_duration_seconds_bucket{%s} %d' %
+                             (_labels(pid = pid, endpoint = endpoint, method = method,
+                                      le = '+Inf' if bound == float('inf') else repr(bound)), cumulative))
+            lines.append('biz_http_request_duration_seconds_sum{%s} %.6f' %
+                         (_labels(pid = pid, endpoint = endpoint, method = method), total))
+            lines.append('biz_http_request_duration_seconds_count{%s} %d' %
+                         (_labels(pid = pid, endpoint = endpoint, method = method), count))
+
+        lines.extend(['# HELP biz_sql_statements_total SQL statements executed by endpoint and database bind.',
+                      '# TYPE biz_sql_statements_total counter'])
+        for ((endpoint, bind), (count, seconds)) in sql:
+            lines.append('biz_sql_statements_total{%s} %d' %
+                         (_labels(pid = pid, endpoint = endpoint, bind = bind), count))
+        lines.extend(['# HELP biz_sql_duration_seconds_total Time spent executing SQL by endpoint and database bind.',
+                      '# TYPE biz_sql_duration_seconds_total counter'])
+        for ((endpoint, bind), (count, seconds)) in sql:
+            lines.append('biz_sql_duration_seconds_total{%s} %.6f' %
+                         (_labels(pid = pid, endpoint = endpoint, bind = bind), seconds))
+
+        lines.extend(['# HELP biz_sqlite_lock_waits_total Write statements that waited for the SQLite write lock.',
+                      '# TYPE biz_sqlite_lock_waits_total counter'])
+        for (bind, count) in lock_waits:
+            lines.append('biz_sqlite_lock_waits_total{%s} %d' % (_labels(pid = pid, bind = bind), count))
+        lines.extend(['# HELP biz_sqlite_lock_errors_total Statements failed with "database is locked".',
+                      '# TYPE biz_sqlite_lock_errors_total counter'])
+        for (bind, count) in lock_errors:
+            lines.append('biz_sqlite_lock_errors_total{%s} %d' % (_labels(pid = pid, bind = bind), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for (k, v) in sorted(labels.items()))
+
+
+metrics = Metrics()
+
+
+def get_endpoint():
+    '''
+    :return: 当前请求的endpoint，请求之外返回background，未匹配到URL规则时返回unmatched
+    '''
+    if not has_request_context():
+        return BACKGROUND
+    return request.endpoint or 'unmatched'
+
+
+def _sql_listeners(bind, lock_wait_threshold):
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('metrics_start')
+        if not starts:
+            return
+        seconds = time.perf_counter() - starts.pop()
+        metrics.observe_sql(get_endpoint(), bind, seconds)
+        if seconds >= lock_wait_threshold and statement.lstrip()[:7].upper().startswith(WRITE_PREFIXES):
+            metrics.observe_lock(bind)
+
+    def handle_error(context):
+        starts = context.connection.info.get('metrics_start') if context.connection is not None else None
+        if starts:
+            starts.pop()
+        if 'database is locked' in str(context.original_exception):
+            metrics.observe_lock(bind, error = True)
+
+    return (before_cursor_execute, after_cursor_execute, handle_error)
+
+
+def _is_local(remote_addr):
+    return remote_addr in ('127.0.0.1', '::1', 'localhost')
+
+
+def init(app):
+    '''
+    注册请求计时、SQL计时及/metrics
+    :param app: flask app
+    '''
+    metrics_config = config().get('metrics', {})
+    if not metrics_config.get('enabled', True):
+        return
+
+    engines = list(db_control.get_engines(app).items())
+    # 未声明__bind_key__的数据表(如users_roles)使用SQLALCHEMY_DATABASE_URI的engine，与default为同一数据库文件
+    engines.append(('default', db_control.get_db().get_engine(app)))
+    lock_wait_threshold = metrics_config.get('lock_wait_threshold', 20) / 1000
+    for (bind, engine) in engines:
+        (before, after, error) = _sql_listeners(bind, lock_wait_threshold)
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+        event.listen(engine, 'handle_error', error)
+
+    def start_timer():
+        g._metrics_start = time.perf_counter()
+
+    # 放在最前面，使其他before_request的耗时也计入请求延迟
+    app.before_request_funcs.setdefault(None, []).insert(0, start_timer)
+
+    def observe(status):
+        start = g.pop('_metrics_start', None)
+        if start is not None:
+            metrics.observe_request(get_endpoint(), request.method, status, time.perf_counter() - start)
+
+    @app.after_request
+    def observe_response(response):
+        observe(response.status_code)
+        return response
+
+    @app.teardown_request
+    def observe_exception(exc):
+        # 未处理的异常不经过after_request
+        if exc is not None:
+            observe(500)
+
+    @app.route('/metrics')
+    def export_metrics():
+        if not metrics_config.get('allow_remote', False) and not _is_local(request.remote_addr):
+            abort(403)
+        return Response(metrics.render(), content_type = 'text/plain; version=0.0.4; charset=utf-8')
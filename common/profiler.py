@@ -0,0 +1,223 @@
+'''
+    按需剖析请求
+
+    请求header X-Profile或查询参数_profile的值与配置的令牌一致，或由已登录的管理员发起时，
+    对该请求同时执行cProfile和调用栈采样，结果写入get_profile_dir()：
+    .prof为cProfile结果(可用pstats、snakeviz查看)，.collapsed为折叠调用栈(可用flamegraph.pl、speedscope生成火焰图)。
+    同时剖析的请求数超出上限时请求照常处理但不剖析，响应header X-Profile-Status为busy。
+    在系统设置-性能剖析中查看及下载剖析结果。
+'''
+import cProfile
+import hmac
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+import flask_login as login
+from flask import request, g
+
+from app_view import CVAdminFileView
+from env import get_profile_dir, get_config as config
+from plugin import PluginsRegistry
+
+__registry__ = pr = PluginsRegistry()
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ARG = '_profile'
+
+
+class StackSampler:
+    def __init__(self, thread_id, interval):
+        '''
+        :param thread_id: 被采样线程的ID
+        :param interval: 采样间隔(秒)
+        '''
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target = self._run, name = 'profile-sampler', daemon = True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        '''
+        :return: 折叠调用栈文本，每行为"调用栈 采样数"
+        '''
+        return ''.join('%s %d\n' % (stack, count) for (stack, count) in sorted(self.stacks.items()))
+
+
+class RequestProfile:
+    def __init__(self, name, interval):
+        '''
+        :param name: 剖析结果文件名(不含扩展名)
+        :param interval: 调用栈采样间隔(秒)
+        '''
+        self.name = name
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), interval)
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.sampler.start()
+        try:
+            self.profiler.enable()
+        except ValueError:
+            # 3.12起cProfile在进程内只能同时启用一个，已被占用时只采样调用栈
+            self.profiler = None
+
+    def stop(self):
+        '''
+        停止剖析并写入结果文件
+        :return: 请求耗时(秒)
+        '''
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.sampler.stop()
+        seconds = time.perf_counter() - self.start_time
+        path = os.path.join(get_profile_dir(), self.name)
+        if self.profiler is not None:
+            self.profiler.dump_stats(path + '.prof')
+        with open(path + '.collapsed', 'w', encoding = 'utf-8') as f:
+            f.write(self.sampler.collapsed())
+        return seconds
+
+
+class RequestProfiler:
+    def __init__(self, token = '', max_concurrent = 1, interval = 2, keep = 50):
+        '''
+        :param token: 剖析令牌，为空时只允许已登录的管理员
+        :param max_concurrent: 同时剖析的最大请求数
+        :param interval: 调用栈采样间隔(毫秒)
+        :param keep: 保留的剖析结果数
+        '''
+        self.token = token
+        self.interval = interval / 1000
+        self.keep = keep
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    def is_requested(self):
+        '''
+        :return: 当前请求是否要求剖析且有权限
+        '''
+        value = request.headers.get(PROFILE_HEADER) or request.args.get(PROFILE_ARG)
+        if not value:
+            return False
+        # 按常数时间比较，响应时间不泄露令牌前缀
+        if self.token and hmac.compare_digest(value.encode('utf-8'), str(self.token).encode('utf-8')):
+            return True
+        from common.login import admin_permission
+        return login.current_user.is_authenticated and admin_permission.can()
+
+    def start(self):
+        '''
+        开始剖析当前请求
+        :return: 剖析对象，超出并发上限时返回None
+        '''
+        if not self._slots.acquire(blocking = False):
+            return None
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        name = '%s-%s-%d-%d' % (time.strftime('%Y%m%d%H%M%S'),
+                                re.sub(r'[^\w.]+', '_', request.endpoint or 'unmatched'), os.getpid(), seq)
+        profile = RequestProfile(name, self.interval)
+        try:
+            profile.start()
+        except Exception:
+            self._slots.release()
+            raise
+        return profile
+
+    def stop(self, profile):
+        try:
+            return profile.stop()
+        finally:
+            self._slots.release()
+            self._prune()
+
+    def _prune(self):
+        # 文件名以时间开头，按文件名排序即按剖析时间排序
+        profile_dir = get_profile_dir()
+        names = sorted(os.path.splitext(f)[0] for f in os.listdir(profile_dir) if f.endswith('.collapsed'))
+        for name in names[:max(len(names) - self.keep, 0)]:
+            for ext in ('.prof', '.collapsed'):
+                try:
+                    os.remove(os.path.join(profile_dir, name + ext))
+                except OSError:
+                    pass
+
+
+_profile_config = config().get('profile', {})
+
+request_profiler = RequestProfiler(token = _profile_config.get('token', ''),
+                                   max_concurrent = _profile_config.get('max_concurrent', 1),
+                                   interval = _profile_config.get('interval', 2),
+                                   keep = _profile_config.get('keep', 50))
+
+
+def init(app):
+    '''
+    注册请求剖析
+    :param app: flask app
+    '''
+
+    @app.before_request
+    def start_profile():
+        if not request_profiler.is_requested():
+            return
+        profile = request_profiler.start()
+        if profile is None:
+            g._profile_status = 'busy'
+        else:
+            g._profile = profile
+            g._profile_status = profile.name
+
+    @app.after_request
+    def add_profile_header(response):
+        status = g.get('_profile_status')
+        if status is not None:
+            response.headers['X-Profile-Status'] = status
+        return response
+
+    @app.teardown_request
+    def stop_profile(exc):
+        profile = g.pop('_profile', None)
+        if profile is not None:
+            request_profiler.stop(profile)
+
+
+# View-----------------------------------------------------------------------------------------------------
+@pr.register_page()
+class ProfileFileView(CVAdminFileView):
+    allowed_extensions = ('prof', 'collapsed')
+    can_upload = False
+    can_delete = True
+    default_sort_column = 'date'
+    default_desc = True
+
+    def __init__(self):
+        CVAdminFileView.__init__(self, get_profile_dir(), '', name = '性能剖析', category = '系统设置',
+                                 endpoint = 'profile')
@@ -0,0 +1,225 @@
+'''
+    慢查询日志
+
+    记录执行时间超过阈值的SQL语句及其绑定、参数、所在endpoint和EXPLAIN QUERY PLAN，
+    保存在进程内的环形缓冲中，开启持久化时由后台线程写入scheduler数据库。
+    在系统设置-慢查询中只读查看，查询计划中出现全表扫描的语句标记为全表扫描。
+'''
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+import flask_login as login
+from sqlalchemy import event
+
+import db_control
+from app_view import CVAdminModelView
+from common.metrics import get_endpoint
+from common.util import get_now, display_datetime, get_yesno_display
+from env import get_config as config
+from plugin import PluginsRegistry
+
+__registry__ = pr = PluginsRegistry()
+
+db = db_control.get_db()
+
+# 只对这些语句执行EXPLAIN QUERY PLAN
+EXPLAIN_PREFIXES = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+
+@pr.register_model(97)
+class SlowQuery(db.Model):
+    __bind_key__ = 'scheduler'
+    __tablename__ = 'slow_query'
+    id = db.Column(db.Integer, primary_key = True, autoincrement = True)
+    bind = db.Column(db.String(20), nullable = False)
+    endpoint = db.Column(db.String(255), nullable = False)
+    statement = db.Column(db.Text, nullable = False)
+    parameters = db.Column(db.Text, nullable = True)
+    duration = db.Column(db.Float, nullable = False)
+    plan = db.Column(db.Text, nullable = True)
+    full_scan = db.Column(db.Integer, nullable = False, default = 0)
+    create_at = db.Column(db.DateTime, nullable = False, default = lambda: get_now())
+
+    __table_args__ = (db.Index('ix_slow_query_create_at', 'create_at'),)
+
+
+def is_table_scan(detail):
+    '''
+    :param detail: EXPLAIN QUERY PLAN结果中的一行说明
+    :return: 是否为全表扫描
+    '''
+    # 3.36之前为"SCAN TABLE speak"，之后为"SCAN speak"，使用索引时包含"INDEX"
+    words = detail.split()
+    return len(words) > 1 and words[0] == 'SCAN' and 'INDEX' not in words and \
+           words[1] not in ('CONSTANT', 'SUBQUERY')
+
+
+def explain(dbapi_connection, statement, parameters):
+    '''
+    在执行语句的连接上获取查询计划，不会执行语句本身
+    :return: 查询计划各行的说明，无法获取时返回空列表
+    '''
+    if not statement.lstrip().upper().startswith(EXPLAIN_PREFIXES):
+        return []
+    try:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            return [str(row[-1]) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+    except Exception:
+        return []
+
+
+class SlowQueryLog:
+    def __init__(self, threshold, buffer_size = 200, persist = False, persist_max_rows = 10000):
+        '''
+        :param threshold: 慢查询阈值(毫秒)
+        :param buffer_size: 环形缓冲保留的记录数
+        :param persist: 是否写入scheduler数据库
+        :param persist_max_rows: 数据库中保留的最大记录数
+        '''
+        self.threshold = threshold
+        self.persist = persist
+        self.persist_max_rows = persist_max_rows
+        self._lock = threading.Condition()
+        self._records = deque(maxlen = buffer_size)
+        self._pending = []
+        self._writer_pid = None
+        self._local = threading.local()
+
+    def attach(self, bind, engine):
+        '''
+        在engine上记录慢查询
+        :param bind: 绑定名称
+        :param engine: engine
+        '''
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('slowquery_start', []).append(time.perf_counter())
+
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            starts = conn.info.get('slowquery_start')
+            if not starts:
+                return
+            duration = (time.perf_counter() - starts.pop()) * 1000
+            if duration >= self.threshold and not getattr(self._local, 'writing', False):
+                if executemany and parameters:
+                    parameters = parameters[0]
+                self.add(bind, statement, parameters, duration, explain(conn.connection, statement, parameters))
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    def add(self, bind, statement, parameters, duration, plan):
+        record = {'bind': bind,
+                  'endpoint': get_endpoint(),
+                  'statement': statement,
+                  'parameters': repr(parameters)[:1000] if parameters else None,
+                  'duration': round(duration, 3),
+                  'plan': '\n'.join(plan),
+                  'full_scan': 1 if any(is_table_scan(detail) for detail in plan) else 0,
+                  'create_at': get_now().replace(tzinfo = None)}
+        with self._lock:
+            self._records.append(record)
+            if self.persist:
+                self._ensure_writer()
+                self._pending.append(record)
+                self._lock.notify()
+
+    def records(self):
+        '''
+        :return: 环形缓冲中的记录，最新的在前
+        '''
+        with self._lock:
+            return list(reversed(self._records))
+
+    def _ensure_writer(self):
+        # fork后的子进程不继承写线程，按进程号重新启动
+        if self._writer_pid != os.getpid():
+            self._writer_pid = os.getpid()
+            self._pending = []
+            threading.Thread(target = self._run, name = 'slowquery-writer', daemon = True).start()
+
+    def _run(self):
+        self._local.writing = True
+        while True:
+            with self._lock:
+                while len(self._pending) == 0:
+                    self._lock.wait()
+                (records, self._pending) = (self._pending, [])
+            try:
+                self._write(records)
+            except Exception as e:
+                print('Failed to persist slow queries: ' + str(e), file = sys.stderr)
+
+    def _write(self, records):
+        table = SlowQuery.__table__
+        with db.get_engine(bind = 'scheduler').begin() as conn:
+            conn.execute(table.insert(), records)
+            last_id = conn.execute(db.select([db.func.max(table.c.id)])).scalar() or 0
+            conn.execute(table.delete().where(table.c.id <= last_id - self.persist_max_rows))
+
+
+_slow_query_config = config().get('slow_query', {})
+
+slow_query_log = SlowQueryLog(_slow_query_config.get('threshold', 0),
+                              buffer_size = _slow_query_config.get('buffer_size', 200),
+                              persist = _slow_query_config.get('persist', False),
+                              persist_max_rows = _slow_query_config.get('persist_max_rows', 10000))
+
+
+def init(app):
+    '''
+    在全部绑定上记录慢查询，阈值为0时不记录
+    :param app: flask app
+    '''
+    if slow_query_log.threshold <= 0:
+        return
+    engines = list(db_control.get_engines(app).items())
+    engines.append(('default', db.get_engine(app)))
+    for (bind, engine) in engines:
+        slow_query_log.attach(bind, engine)
+
+
+# View-----------------------------------------------------------------------------------------------------
+@pr.register_view()
+class SlowQueryView(CVAdminModelView):
+    can_create = False
+    can_edit = False
+    can_delete = False
+
+    column_list = ('create_at', 'duration', 'bind', 'endpoint', 'statement', 'parameters', 'plan', 'full_scan')
+    column_labels = dict(create_at = '时间', duration = '耗时(毫秒)', bind = '绑定', endpoint = 'Endpoint',
+                         statement = 'SQL', parameters = '参数', plan = '查询计划', full_scan = '全表扫描')
+    column_formatters = dict(create_at = lambda v, c, m, p: display_datetime(m.create_at),
+                             full_scan = lambda v, c, m, p: get_yesno_display(m.full_scan))
+    column_filters = ('bind', 'endpoint', 'full_scan')
+    column_default_sort = ('create_at', True)
+
+    def __init__(self, model, session):
+        CVAdminModelView.__init__(self, model, session, '慢查询', '系统设置')
+
+    def is_accessible(self):
+        from common.login import admin_permission
+        if admin_permission.can():
+            return login.current_user.is_authenticated
+        else:
+            return False
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute = True, page_size = None):
+        if slow_query_log.persist:
+            return super().get_list(page, sort_column, sort_desc, search, filters, execute, page_size)
+
+        # 未开启持久化时列出本进程环形缓冲中的记录，不支持筛选
+        records = [SlowQuery(**record) for record in slow_query_log.records()]
+        if sort_column is not None:
+            records.sort(key = lambda r: (getattr(r, sort_column) is not None, getattr(r, sort_column)),
+                         reverse = bool(sort_desc))
+        page_size = page_size or self.page_size
+        start = (page or 0) * page_size
+        return len(records), records[start:start + page_size]
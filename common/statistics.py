@@ -1,8 +1,77 @@
 '''
     统计服务接口
 '''
+import hashlib
+
+from flask import json
 from flask_restful import abort
 
+from common.cache import Cache
+from env import get_config as config
+
+_cache_config = config().get('statistics_cache', {})
+
+# 缓存键 -> (JSON文本, ETag)，缓存键包含请求参数、日期及所涉目标的写入水位，目标有新的写入后不再命中
+statistics_cache = Cache('statistics', maxsize = _cache_config.get('maxsize', 1000), ttl = _cache_config.get('ttl', 60))
+
+
+def get_statistics_response(request):
+    '''
+        获取dashboard的统计数据及其ETag，相同的请求在所涉目标没有新的写入时直接返回缓存，
+        并发到达的相同请求只计算一次
+    :param request: HTTP请求对象
+    :return: (JSON文本, ETag)
+    '''
+    key = _get_cache_key(*_get_args(request))
+    if key is None:
+        return _render(request)
+    return statistics_cache.get(key, lambda key: _render(request))
+
+
+def _get_args(request):
+    '''
+    :return: (type, botid, target, days)
+    '''
+    if request.method == 'GET':
+        values = request.args
+    elif request.method == 'POST':
+        values = request.form
+    return (values.get('type'), values.get('botid'), values.get('target'), values.get('days'))
+
+
+def _get_cache_key(type, botid, target, days):
+    '''
+    :return: 缓存键，不缓存的请求返回None
+    '''
+    from common import login
+    from common.dashboard_stream import delta_hub
+    from common.util import output_datetime, get_now
+    from plugins.setting import TargetRule
+
+    if not _cache_config.get('enabled', True) or type is None or int(type) == 3:
+        # 3：重新计算发言统计
+        return None
+    if int(type) == 1:
+        # 汇总数据按用户可见的目标计算，未登录时不缓存，由_get_counts返回401
+        if not login.current_user.is_authenticated:
+            return None
+        username = login.current_user.username
+        targets = [(r.botid, r.target) for r in TargetRule.find_allow_by_user(username)]
+    else:
+        username = None
+        targets = [(botid, target)]
+    watermark = delta_hub.watermark(targets)
+    if watermark is None:
+        return None
+    # 按天数计算的日期范围随日期变化
+    return (int(type), botid, target, days, username, output_datetime(get_now(), True, False),
+            tuple(targets), watermark)
+
+
+def _render(request):
+    body = json.dumps(get_statistics_data(request))
+    return (body, hashlib.sha1(body.encode('utf-8')).hexdigest())
+
 
 def get_statistics_data(request):
     '''
@@ -14,16 +83,7 @@ def get_statistics_data(request):
 
     from common.util import output_datetime, get_now
 
-    if request.method == 'GET':
-        type = request.args.get('type')
-        botid = request.args.get('botid')
-        target = request.args.get('target')
-        days = request.args.get('days')
-    elif request.method == 'POST':
-        type = request.form.get('type')
-        botid = request.form.get('botid')
-        target = request.form.get('target')
-        days = request.form.get('days')
+    (type, botid, target, days) = _get_args(request)
 
     today = output_datetime(get_now(), True, False)
     if int(type) == 1:
@@ -82,7 +142,7 @@ def _get_speak_statistics(botid, target, date_from, date_to):
                                             target_prefix2name(target.split('#')[0]),
                                             target.split('#')[1],
                                             date_from,
-                                            date_to).fetchall()
+                                            date_to)
 
     for r in statistics_data:
         max_count = max(max_count, int(r.message_count))
@@ -154,70 +214,39 @@ def _get_speak_tops(botid, target, date_from, date_to):
 
 
 def _get_counts(botid):
-    from plugins.setting import TargetRule
-
     from common import login
-    from common.util import output_datetime, get_now
 
     if not login.current_user.is_authenticated :
         abort(401)
 
-    targets = TargetRule.find_allow_by_user(login.current_user.username)
-
-    speak_today_count = 0
-    sign_today_count = 0
-    point_today_total = 0
-    score_today_total = 0
-
-    today = output_datetime(get_now(), True, False)
-
-    for target in targets:
-        speak_today_count += _get_speak_today_count(botid, target, today, today)
-        sign_today_count += _get_sign_today_count(botid, target, today, today)
-        point_today_total += _get_point_today_total(botid, target, today, today)
-        score_today_total += _get_score_today_total(botid, target, today, today)
     return {'success': 1,
             'data': {
-                'statistics_data':
-                    {'speak_today_count': speak_today_count,
-                     'sign_today_count': sign_today_count,
-                     'point_today_total': point_today_total,
-                     'score_today_total': score_today_total}}
+                'statistics_data': get_today_counts(login.current_user.username)}
 
             }
 
 
-def _get_speak_today_count(botid, target, date_from, date_to):
-    from plugins.speak import Speak
-    from common.util import target_prefix2name
-
-    speak_today = Speak.get_count(target.botid, target_prefix2name(target.target.split('#')[0]),
-                                  target.target.split('#')[1], date_from, date_to)
-    return speak_today.cnt_full if speak_today.cnt_full is not None else 0
-
-
-def _get_score_today_total(botid, target, date_from, date_to):
-    from plugins.score import ScoreRecord
-    from common.util import target_prefix2name
-
-    score_today = ScoreRecord.get_flow(target.botid, target_prefix2name(target.target.split('#')[0]),
-                                       target.target.split('#')[1], date_from, date_to)
-    return score_today.total if score_today.total is not None else 0
-
-
-def _get_point_today_total(botid, target, date_from, date_to):
+def get_today_counts(username):
+    '''
+        获取用户可见的各目标今天的汇总数据
+    :param username: 用户名
+    :return: 汇总数据
+    '''
     from plugins.point import Point
-    from common.util import target_prefix2name
+    from plugins.score import ScoreRecord
+    from plugins.setting import TargetRule
+    from plugins.sign import Sign
+    from plugins.speak import Speak
 
-    point_today = Point.get_total(target.botid, target_prefix2name(target.target.split('#')[0]),
-                                  target.target.split('#')[1], date_from, date_to)
-    return point_today.total_success if point_today.total_success is not None else 0
+    from common.util import output_datetime, get_now
 
+    # 各项按(机器人, 目标)分组一次查出，查询次数不随目标数增加
+    targets = [(r.botid, r.target) for r in TargetRule.find_allow_by_user(username)]
 
-def _get_sign_today_count(botid, target, date_from, date_to):
-    from plugins.sign import Sign
-    from common.util import target_prefix2name
+    today = output_datetime(get_now(), True, False)
 
-    sign_today = Sign.get_count(target.botid, target_prefix2name(target.target.split('#')[0]),
-                                target.target.split('#')[1], date_from, date_to)
-    return sign_today.cnt if sign_today.cnt is not None else 0
\ No newline at end of file
+    return {'date': today,
+            'speak_today_count': sum(Speak.get_count_by_targets(targets, today, today).values()),
+            'sign_today_count': sum(Sign.get_count_by_targets(targets, today, today).values()),
+            'point_today_total': sum(Point.get_total_by_targets(targets, today, today).values()),
+            'score_today_total': sum(ScoreRecord.get_flow_by_targets(targets, today, today).values())}
@@ -0,0 +1,131 @@
+'''
+    多模式文本匹配
+
+    AhoCorasick对文本扫描一次即可找出其中出现的全部字面量，
+    required_literals从正则表达式中提取必需的字面量，用于在执行正则前判断其是否可能匹配。
+'''
+import re
+from collections import deque
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+
+class AhoCorasick:
+    def __init__(self, patterns):
+        '''
+        :param patterns: 字面量列表
+        '''
+        self.patterns = list(patterns)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [frozenset()]
+
+        for (index, pattern) in enumerate(self.patterns):
+            node = 0
+            for ch in pattern:
+                next_node = self._goto[node].get(ch)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(frozenset())
+                    self._goto[node][ch] = next_node
+                node = next_node
+            self._out[node] = self._out[node] | {index}
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for (ch, child) in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0) if node != 0 else 0
+                self._out[child] = self._out[child] | self._out[self._fail[child]]
+
+    def find(self, text):
+        '''
+        扫描文本
+        :param text: 文本
+        :return: 文本中出现的字面量在patterns中的下标集合
+        '''
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        node = 0
+        found = set()
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found |= out[node]
+        return found
+
+
+def required_literals(pattern):
+    '''
+    提取正则表达式的必需字面量：任何一次匹配的文本都至少包含其中一个字面量
+    :param pattern: 正则表达式
+    :return: 字面量集合，无法确定时返回None
+    '''
+    try:
+        if re.compile(pattern).flags & re.IGNORECASE:
+            return None
+        return _cover(sre_parse.parse(pattern), False)
+    except (re.error, RecursionError):
+        return None
+
+
+def _cover(subpattern, ignorecase):
+    # 从顺序执行的各个元素中选出最具区分度(最短字面量最长)的一个
+    candidates = []
+    run = ''
+    for (op, av) in subpattern:
+        if op is sre_constants.LITERAL and not ignorecase:
+            run += chr(av)
+            continue
+        if run:
+            candidates.append({run})
+            run = ''
+        cover = _element_cover(op, av, ignorecase)
+        if cover is not None:
+            candidates.append(cover)
+    if run:
+        candidates.append({run})
+    if len(candidates) == 0:
+        return None
+    return max(candidates, key = lambda c: min(len(s) for s in c))
+
+
+def _element_cover(op, av, ignorecase):
+    if op is sre_constants.SUBPATTERN:
+        if len(av) == 4:
+            (group, add_flags, del_flags, p) = av
+            if add_flags & sre_constants.SRE_FLAG_IGNORECASE:
+                ignorecase = True
+            if del_flags & sre_constants.SRE_FLAG_IGNORECASE:
+                ignorecase = False
+        else:
+            p = av[-1]
+        return _cover(p, ignorecase)
+    if op is sre_constants.BRANCH:
+        cover = set()
+        for p in av[1]:
+            branch = _cover(p, ignorecase)
+            if branch is None:
+                return None
+            cover |= branch
+        return cover
+    if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) or \
+            op is getattr(sre_constants, 'POSSESSIVE_REPEAT', None):
+        (min_count, max_count, p) = av
+        return _cover(p, ignorecase) if min_count >= 1 else None
+    if op is getattr(sre_constants, 'ATOMIC_GROUP', None):
+        return _cover(av, ignorecase)
+    return None
@@ -0,0 +1,78 @@
+'''
+    计数最大的k个键
+
+    TopK是记录每个键所在位置的小顶堆，堆中保存计数最大的k个键，堆顶为其中最小的计数。
+    计数只增不减时，不在堆中的键的计数不会超过堆顶，每次更新的时间复杂度为O(log k)。
+'''
+
+
+class TopK:
+    def __init__(self, k):
+        '''
+        :param k: 保留的键数
+        '''
+        self.k = k
+        # [(计数, 键)]，按计数及键排序的小顶堆
+        self._heap = []
+        # 键 -> 在堆中的位置
+        self._pos = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def update(self, key, count):
+        '''
+        更新键的计数，计数不能小于上次更新的值
+        :param key: 键
+        :param count: 新的计数
+        '''
+        i = self._pos.get(key)
+        if i is not None:
+            # 计数增大时向堆底移动
+            self._heap[i] = (count, key)
+            self._sift_down(i)
+        elif len(self._heap) < self.k:
+            self._heap.append((count, key))
+            self._pos[key] = len(self._heap) - 1
+            self._sift_up(len(self._heap) - 1)
+        elif self.k > 0 and (count, key) > self._heap[0]:
+            # 替换堆顶的最小计数
+            del self._pos[self._heap[0][1]]
+            self._heap[0] = (count, key)
+            self._pos[key] = 0
+            self._sift_down(0)
+
+    def items(self, limit = None):
+        '''
+        :param limit: 返回的最大键数，None表示返回全部k个
+        :return: 按计数从大到小排列的(计数, 键)列表
+        '''
+        return sorted(self._heap, reverse = True)[:limit]
+
+    def _swap(self, i, j):
+        heap = self._heap
+        (heap[i], heap[j]) = (heap[j], heap[i])
+        self._pos[heap[i][1]] = i
+        self._pos[heap[j][1]] = j
+
+    def _sift_up(self, i):
+        heap = self._heap
+        while i > 0:
+            parent = (i - 1) // 2
+            if heap[i] >= heap[parent]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        heap = self._heap
+        size = len(heap)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < size and heap[child] < heap[smallest]:
+                    smallest = child
+            if smallest == i:
+                break
+            self._swap(i, smallest)
+            i = smallest
@@ -146,7 +146,6 @@ class User(db.Model):
 
 
 def init(**kwargs):
-    db.create_all()
     user_cnt = User.find_by_role('admin')
     if user_cnt is None or user_cnt.cnt == 0:
         admin_role = Role(name = 'admin', description = '管理员角色')
@@ -162,9 +161,6 @@ def init(**kwargs):
     return
 
 
-db.create_all()
-
-
 # View-----------------------------------------------------------------------------------------------------
 @pr.register_view()
 class UserView(CVAdminModelView):
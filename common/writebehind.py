@@ -0,0 +1,222 @@
+'''
+    写后缓冲(write-behind)
+
+    数据先进入进程内的有界队列并追加写入本地spool文件即视为已受理，
+    由后台写线程每隔flush_interval毫秒或累计flush_rows条后一次性组提交。
+    spool文件在数据提交成功后删除，进程崩溃后残留的spool文件在下次启动时重放。
+'''
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class BufferFullError(Exception):
+    pass
+
+
+class _Segment:
+    '''
+    spool文件分段，文件在删除前一直保持打开并持有排他锁，避免被其他进程当作残留文件重放
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', encoding = 'utf-8')
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def write(self, line, fsync = False):
+        self.file.write(line + '\n')
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        finally:
+            self.file.close()
+
+
+class WriteBehindBuffer:
+    def __init__(self, name, flush_func, spool_dir, encode = json.dumps, decode = json.loads,
+                 flush_interval = 200, flush_rows = 500, queue_size = 10000, fsync = False):
+        '''
+        :param name: 缓冲名称，用于spool文件命名
+        :param flush_func: 组提交函数，参数为数据行列表，须在一个事务中写入全部数据行
+        :param spool_dir: spool文件目录
+        :param encode: 数据行序列化为一行文本的函数
+        :param decode: 一行文本反序列化为数据行的函数
+        :param flush_interval: 组提交的最大间隔(毫秒)
+        :param flush_rows: 触发组提交的累计行数
+        :param queue_size: 队列容量，队列满时put抛出BufferFullError
+        :param fsync: 每条数据写入spool后是否fsync
+        '''
+        self.name = name
+        self.flush_func = flush_func
+        self.spool_dir = spool_dir
+        self.encode = encode
+        self.decode = decode
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.queue_size = queue_size
+        self.fsync = fsync
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._segments = []
+        self._current = None
+        self._seq = 0
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+
+        self._stats = {'accepted': 0, 'rejected': 0, 'flushes': 0, 'flushed_rows': 0, 'flush_errors': 0,
+                       'last_flush_rows': 0, 'last_flush_ms': 0.0, 'max_flush_ms': 0.0, 'total_flush_ms': 0.0,
+                       'last_error': None}
+
+    def put(self, row):
+        '''
+        数据行进入缓冲
+        :param row: 数据行
+        :return: 当前队列深度
+        '''
+        line = self.encode(row)
+        with self._cond:
+            if len(self._pending) >= self.queue_size:
+                self._stats['rejected'] += 1
+                raise BufferFullError('写后缓冲' + self.name + '已满')
+            self._ensure_writer()
+            self._current.write(line, self.fsync)
+            self._pending.append(row)
+            self._stats['accepted'] += 1
+            if len(self._pending) >= self.flush_rows:
+                self._cond.notify()
+            return len(self._pending)
+
+    def flush(self):
+        '''
+        立即提交缓冲中的全部数据
+        :return: 提交的行数
+        '''
+        with self._cond:
+            if len(self._pending) == 0:
+                return 0
+            rows = self._pending
+            segments = self._segments
+            if self._current is not None:
+                segments.append(self._current)
+                self._current = None
+            self._pending = []
+            self._segments = []
+
+        start = time.perf_counter()
+        try:
+            self.flush_func(rows)
+        except Exception as e:
+            with self._cond:
+                self._pending = rows + self._pending
+                self._segments = segments + self._segments
+                self._stats['flush_errors'] += 1
+                self._stats['last_error'] = str(e)
+            print('Failed to flush write-behind buffer "' + self.name + '": ' + str(e), file = sys.stderr)
+            return 0
+
+        elapsed = (time.perf_counter() - start) * 1000
+        for segment in segments:
+            segment.remove()
+        with self._cond:
+            self._stats['flushes'] += 1
+            self._stats['flushed_rows'] += len(rows)
+            self._stats['last_flush_rows'] = len(rows)
+            self._stats['last_flush_ms'] = round(elapsed, 2)
+            self._stats['max_flush_ms'] = round(max(self._stats['max_flush_ms'], elapsed), 2)
+            self._stats['total_flush_ms'] += elapsed
+        return len(rows)
+
+    def stop(self):
+        '''
+        停止写线程并提交剩余数据
+        '''
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def replay(self):
+        '''
+        重放崩溃后残留的spool文件
+        :return: 重放的行数
+        '''
+        count = 0
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, self.name + '-*.spool'))):
+            try:
+                segment = _Segment(path)
+            except (IOError, OSError):
+                # 文件仍被存活的进程持有
+                continue
+            rows = []
+            with open(path, encoding = 'utf-8') as f:
+                for line in f:
+                    try:
+                        rows.append(self.decode(line))
+                    except ValueError:
+                        # 崩溃时未写完整的行
+                        pass
+            if len(rows) > 0:
+                self.flush_func(rows)
+            segment.remove()
+            count += len(rows)
+        return count
+
+    def stats(self):
+        '''
+        :return: 队列深度及组提交延迟等运行指标
+        '''
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._pending)
+            stats['queue_size'] = self.queue_size
+        stats['avg_flush_ms'] = round(stats.pop('total_flush_ms') / stats['flushes'], 2) if stats['flushes'] else 0.0
+        stats['flush_interval'] = self.flush_interval
+        stats['flush_rows'] = self.flush_rows
+        return stats
+
+    def _new_segment(self):
+        self._seq += 1
+        return _Segment(os.path.join(self.spool_dir,
+                                     '%s-%d-%d-%06d.spool' % (self.name, os.getpid(), int(time.time()), self._seq)))
+
+    def _ensure_writer(self):
+        # fork后的子进程不继承写线程，按进程号重新启动
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending = []
+            self._segments = []
+            self._current = None
+            self._stopping = False
+            self._thread = threading.Thread(target = self._run, name = 'writebehind-' + self.name, daemon = True)
+            self._thread.start()
+        if self._current is None:
+            self._current = self._new_segment()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._pending) < self.flush_rows:
+                    self._cond.wait(self.flush_interval / 1000)
+                stopping = self._stopping
+            if stopping:
+                return
+            self.flush()
@@ -1,18 +1,35 @@
 import os
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
 
 from flask_babelex import Babel
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
+from sqlalchemy.pool import QueuePool
 
 from env import get_default_db_path, get_db_dir, get_config as config
 
 _db = None
 
+# 名称 -> (绑定名称, 函数)，按注册顺序执行
+_data_migrations = OrderedDict()
+# 已确认完成的数据迁移
+_applied_data_migrations = set()
+
 
 def init(app):
     app.config.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite:///' + get_default_db_path())
     app.config.setdefault('SQLALCHEMY_BINDS', get_db_binds())
     app.config.setdefault('SQLALCHEMY_ECHO', False)
     app.config.setdefault('SQLALCHEMY_TRACK_MODIFICATIONS', False)
+    if config().get('db_pool_size', 0) > 0:
+        # 保持连接使PRAGMA及页缓存在请求之间有效，连接由连接池在线程间传递
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {'poolclass': QueuePool,
+                                                             'pool_size': config().get('db_pool_size'),
+                                                             'connect_args': {'check_same_thread': False}})
     babel = Babel(app)
 
     @babel.localeselector
@@ -21,6 +38,7 @@ def init(app):
 
     global _db
     _db = SQLAlchemy(app)
+    _tune_engines(app)
     return _db
 
 
@@ -39,4 +57,239 @@ def get_db_binds() -> dict:
     db_binds = {}
     for (k, v) in binds.items():
         db_binds[k] = 'sqlite:///' + os.path.join(get_db_dir(), v)
-    return db_binds
\ No newline at end of file
+    return db_binds
+
+
+def get_engines(app = None):
+    '''
+    :return: 绑定名称到engine的字典
+    '''
+    return {bind: _db.get_engine(app, bind) for bind in config().get('db_binds', {}).keys()}
+
+
+def _tune_engines(app):
+    pragmas = config().get('db_pragmas', {})
+    for (bind, engine) in get_engines(app).items():
+        if pragmas.get(bind):
+            event.listen(engine, 'connect', _pragma_setter(pragmas.get(bind)))
+
+    interval = config().get('db_maintenance_interval', 0)
+    if interval > 0:
+        @app.before_request
+        def start_db_maintenance():
+            _start_maintenance(app, interval)
+
+
+def _pragma_setter(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for (name, value) in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    return set_pragmas
+
+
+def maintain(app = None):
+    '''
+    对全部绑定执行wal_checkpoint及optimize，将WAL文件中的数据写回数据库并更新查询计划所需的统计信息
+    :param app: flask app
+    :return: 绑定名称到wal_checkpoint结果(busy, log, checkpointed)的字典
+    '''
+    results = {}
+    for (bind, engine) in get_engines(app).items():
+        with engine.connect() as conn:
+            results[bind] = tuple(conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone())
+            conn.execute('PRAGMA optimize')
+    return results
+
+
+_maintenance_pid = None
+
+
+def _start_maintenance(app, interval):
+    # fork后的子进程不继承后台线程，按进程号重新启动
+    global _maintenance_pid
+    if _maintenance_pid == os.getpid():
+        return
+    _maintenance_pid = os.getpid()
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                maintain(app)
+            except Exception as e:
+                print('Failed to maintain databases: ' + str(e), file = sys.stderr)
+
+    threading.Thread(target = run, name = 'db-maintenance', daemon = True).start()
+
+
+def ensure_columns(model):
+    '''
+    为已存在的数据表补充模型中新增的可空字段及这些字段上的索引，create_all不会修改已存在的数据表
+    其他缺失的索引在大表上创建耗时较长，由dbindex.py在维护时创建
+    :param model: 数据模型
+    :return: 补充的字段名列表
+    '''
+    return _ensure_table_columns(model.__table__, _db.get_engine(bind = getattr(model, '__bind_key__', None)))
+
+
+def _ensure_table_columns(table, engine):
+    inspector = inspect(engine)
+    if table.name not in inspector.get_table_names():
+        return []
+    columns = set(c['name'] for c in inspector.get_columns(table.name))
+    added = []
+    with engine.begin() as conn:
+        for column in table.columns:
+            if column.name not in columns and column.nullable:
+                conn.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                             (table.name, column.name, column.type.compile(dialect = engine.dialect)))
+                added.append(column.name)
+    for index in table.indexes:
+        if any(column.name in added for column in index.columns):
+            index.create(engine)
+    return added
+
+
+def get_schema_version():
+    '''
+    :return: 已加载的全部数据模型的结构版本，数据表、字段或索引变化时改变
+    '''
+    parts = []
+    for table in sorted(_db.Model.metadata.tables.values(), key = lambda t: t.name):
+        parts.append('%s@%s(%s)[%s]' % (table.name,
+                                        table.info.get('bind_key'),
+                                        ','.join(c.name for c in table.columns),
+                                        ','.join(sorted(i.name for i in table.indexes))))
+    return '%08x' % (zlib.crc32(';'.join(parts).encode('utf-8')) & 0xffffffff)
+
+
+def _get_schema_stamp_path():
+    return os.path.join(get_db_dir(), 'schema.version')
+
+
+def get_migrated_version():
+    '''
+    :return: 上次迁移时记录的结构版本，未迁移过时返回None
+    '''
+    try:
+        with open(_get_schema_stamp_path()) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def migrate(app = None):
+    '''
+    创建缺失的数据表并补充已存在数据表中缺失的字段，完成后记录结构版本
+    须在导入全部插件模块(加载全部数据模型)之后执行
+    :param app: flask app
+    :return: 新建的数据表及补充的字段
+    '''
+    engines = get_engines(app)
+    existing = {bind: set(inspect(engine).get_table_names()) for (bind, engine) in engines.items()}
+    _db.create_all(app = app)
+
+    created = []
+    columns = []
+    for table in _db.Model.metadata.sorted_tables:
+        bind = table.info.get('bind_key') or 'default'
+        if table.name not in existing.get(bind, set()):
+            created.append(table.name)
+            continue
+        columns.extend(table.name + '.' + name for name in _ensure_table_columns(table, engines[bind]))
+
+    data_migrations = _run_data_migrations(engines)
+
+    with open(_get_schema_stamp_path(), 'w') as f:
+        f.write(get_schema_version())
+    return {'version': get_schema_version(), 'created_tables': created, 'added_columns': columns,
+            'data_migrations': data_migrations}
+
+
+def register_data_migration(name, bind = None):
+    '''
+    注册一次性的数据迁移，由migrate在创建数据表后按注册顺序执行，每个数据库只执行一次
+    函数的参数为绑定上的连接，与完成记录在同一个事务中提交
+    :param name: 迁移名称
+    :param bind: 绑定名称
+    '''
+    def decorator(func):
+        _data_migrations[name] = (bind or 'default', func)
+        return func
+
+    return decorator
+
+
+def is_data_migrated(name, app = None):
+    '''
+    :return: 数据迁移是否已完成
+    '''
+    if name in _applied_data_migrations:
+        return True
+    if name in _get_applied_data_migrations(get_engines(app)[_data_migrations[name][0]]):
+        _applied_data_migrations.add(name)
+        return True
+    return False
+
+
+def get_pending_data_migrations(app = None):
+    '''
+    :return: 尚未执行的数据迁移名称列表
+    '''
+    engines = get_engines(app)
+    applied = {}
+    pending = []
+    for (name, (bind, func)) in _data_migrations.items():
+        if bind not in applied:
+            applied[bind] = _get_applied_data_migrations(engines[bind])
+        if name in applied[bind]:
+            _applied_data_migrations.add(name)
+        else:
+            pending.append(name)
+    return pending
+
+
+def _get_applied_data_migrations(engine):
+    if 'data_migration' not in inspect(engine).get_table_names():
+        return set()
+    with engine.connect() as conn:
+        return set(r[0] for r in conn.execute(text('SELECT name FROM data_migration')))
+
+
+def _run_data_migrations(engines):
+    '''
+    :return: 本次执行的数据迁移名称列表
+    '''
+    done = []
+    for (name, (bind, func)) in _data_migrations.items():
+        engine = engines[bind]
+        engine.execute(text('CREATE TABLE IF NOT EXISTS data_migration '
+                            '(name VARCHAR(64) PRIMARY KEY, applied_at DATETIME NOT NULL)'))
+        with engine.begin() as conn:
+            # 先写入完成记录以取得写锁，多个进程同时迁移时只有一个进程执行
+            if conn.execute(text('INSERT OR IGNORE INTO data_migration(name, applied_at) '
+                                 'VALUES (:name, CURRENT_TIMESTAMP)'), {'name': name}).rowcount == 1:
+                func(conn)
+                done.append(name)
+        _applied_data_migrations.add(name)
+    return done
+
+
+def ensure_schema(app = None):
+    '''
+    结构版本与上次迁移时一致、数据库文件均存在且数据迁移均已完成时跳过迁移，避免每次启动都检查全部数据表
+    不一致时按配置自动迁移，关闭自动迁移时须先执行python migrate.py
+    :param app: flask app
+    :return: 是否执行了迁移
+    '''
+    if get_migrated_version() == get_schema_version() and \
+            all(os.path.exists(engine.url.database) for engine in get_engines(app).values()) and \
+            len(get_pending_data_migrations(app)) == 0:
+        return False
+    if not config().get('auto_migrate', True):
+        raise RuntimeError('数据库结构版本不一致，请先执行python migrate.py')
+    migrate(app)
+    return True
@@ -0,0 +1,214 @@
+'''
+    索引维护工具
+
+    create_all只为新建的数据表创建索引，已部署的数据库文件中缺失的索引由本工具创建。
+    SQLite创建索引期间持有写锁，本工具逐个索引在独立的短事务中创建，WAL模式下读请求不受影响，
+    写请求在busy_timeout内等待，开启写后缓冲时发言记录在缓冲中排队；
+    可先用--estimate在数据库副本上创建，预估每个索引的锁定时间后再选择时间执行。
+    --check在临时数据库中检查热点查询的查询计划，有查询退化为全表扫描时以非0状态退出。
+    用法：python dbindex.py [--bind score] [--dry-run | --estimate | --check]
+'''
+import argparse
+import datetime
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+
+def load_models():
+    '''
+    导入全部插件模块以加载数据模型，不执行插件的init
+    :return: flask app
+    '''
+    sys.path.insert(0, os.path.split(os.path.realpath(__file__))[0])
+
+    import db_control
+    import plugin
+    from app import app
+
+    plugin.import_plugins('common')
+    plugin.import_plugins('plugins')
+    db_control.ensure_schema(app)
+    return app
+
+
+def missing_indexes(app, bind):
+    '''
+    :param bind: 绑定名称
+    :return: 模型中声明而数据库中不存在的索引列表
+    '''
+    from sqlalchemy import inspect
+
+    import db_control
+
+    db = db_control.get_db()
+    engine = db_control.get_engines(app)[bind]
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    indexes = []
+    for table in db.get_tables_for_bind(bind):
+        if table.name not in tables:
+            continue
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        indexes.extend(index for index in sorted(table.indexes, key = lambda i: i.name)
+                       if index.name not in existing)
+    return indexes
+
+
+def build_indexes(engine, indexes):
+    '''
+    逐个创建索引，每个索引在独立的事务中创建
+    :return: 每个索引的创建结果
+    '''
+    results = []
+    for index in indexes:
+        rows = engine.execute('SELECT COUNT(1) FROM ' + index.table.name).scalar()
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            index.create(conn)
+        results.append({'table': index.table.name,
+                        'index': index.name,
+                        'rows': rows,
+                        'lock_seconds': round(time.perf_counter() - start, 3)})
+    if len(results) > 0:
+        # 更新查询计划所需的统计信息
+        engine.execute('PRAGMA optimize')
+    return results
+
+
+def estimate(engine, indexes):
+    '''
+    在数据库副本上创建索引，预估锁定时间，不修改原数据库
+    '''
+    from sqlalchemy import create_engine
+
+    path = engine.url.database
+    tmp_dir = tempfile.mkdtemp(prefix = 'biz-dbindex-')
+    try:
+        copy = os.path.join(tmp_dir, os.path.basename(path))
+        source = sqlite3.connect(path)
+        target = sqlite3.connect(copy)
+        if hasattr(source, 'backup'):
+            # backup API在复制期间不阻塞其他连接的读写
+            source.backup(target)
+        else:
+            target.executescript(';\n'.join(source.iterdump()))
+        target.close()
+        source.close()
+        return build_indexes(create_engine('sqlite:///' + copy), indexes)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+
+
+# 热点查询所在的数据表，这些表上的查询计划中不允许出现全表扫描
+HOT_TABLES = ('speak', 'speak_count', 'speak_total', 'point_record', 'sign', 'score_record')
+HOT_TABLE_PATTERN = re.compile(r'\b(FROM|JOIN)\s+(%s)\b' % '|'.join(HOT_TABLES), re.IGNORECASE)
+
+
+def hot_queries():
+    '''
+    :return: (名称, 执行热点查询的函数)列表
+    '''
+    from plugins.point import Point
+    from plugins.score import ScoreRecord
+    from plugins.sign import Sign
+    from plugins.speak import LiveTop, Speak, SpeakCount, SpeakTotal, live_top
+
+    date = '2020-01-01'
+    return [
+        ('SpeakCount.get_top', lambda: SpeakCount.get_top('bot', 'g#1', date, date)),
+        ('SpeakCount.get_date_range', lambda: SpeakCount.get_date_range('bot', 'g#1')),
+        ('LiveTop.rebuild', lambda: live_top.rebuild()),
+        ('LiveTop.refresh', lambda: LiveTop._read(date, [('bot', 'g#1'), ('bot', 'g#2')])),
+        ('SpeakTotal.get_top', lambda: SpeakTotal.get_top('bot', 'g#1')),
+        ('SpeakTotal.get_top(valid)', lambda: SpeakTotal.get_top('bot', 'g#1', is_valid = True)),
+        ('Speak.updatewash', lambda: Speak.updatewash('bot', 'group', '1', date, date, workers = 1)),
+        ('Speak.get_count', lambda: Speak.get_count('bot', 'group', '1', date, date)),
+        ('Speak.get_count(sender)', lambda: Speak.get_count('bot', 'group', '1', date, date, '2')),
+        ('SpeakCount.statistics', lambda: SpeakCount.statistics('bot', 'group', '1', date, date)),
+        ('Point.get_report_count', lambda: Point.get_report_count('bot', 'g#1', '2', '3', date)),
+        ('Sign.find_by_date', lambda: Sign.find_by_date('bot', 'group', '1', '2', date, date)),
+        ('ScoreRecord.get_flow', lambda: ScoreRecord.get_flow('bot', 'group', '1', date, date)),
+    ]
+
+
+def check_query_plans(app):
+    '''
+    执行热点查询并检查其查询计划
+    :return: 每条查询的检查结果
+    '''
+    from sqlalchemy import event
+
+    import db_control
+    from common.slowquery import is_table_scan
+    from plugins.score import ScoreAccount
+    from plugins.speak import Speak
+
+    db = db_control.get_db()
+    engine = db_control.get_engines(app)['score']
+    # get_flow在目标没有积分账户时不按账户过滤，需要先创建账户
+    db.session.add(ScoreAccount(botid = 'bot', name = 'bot', target = 'g#1', is_default = 1))
+    # updatewash在范围内有发言记录时才分块读取，需要先写入一条
+    db.session.add(Speak(botid = 'bot', target = 'g#1', sender_id = '2', sender_name = '2',
+                         date = datetime.date(2020, 1, 1), message = 'm', washed_text = 'm', washed_chars = 1))
+    db.session.commit()
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    results = []
+    for (name, query) in hot_queries():
+        del statements[:]
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            with app.app_context():
+                query()
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+        for (statement, parameters) in statements:
+            if HOT_TABLE_PATTERN.search(statement) is None:
+                continue
+            plan = [row[-1] for row in engine.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()]
+            results.append({'query': name, 'plan': plan, 'ok': not any(is_table_scan(detail) for detail in plan)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = '索引维护工具')
+    parser.add_argument('--bind', default = 'score', help = '数据库绑定名称')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--dry-run', action = 'store_true', help = '只列出缺失的索引')
+    group.add_argument('--estimate', action = 'store_true', help = '在数据库副本上创建索引以预估锁定时间')
+    group.add_argument('--check', action = 'store_true', help = '在临时数据库中检查热点查询的查询计划')
+    args = parser.parse_args()
+
+    if args.check:
+        os.environ['DATA_DIR'] = tempfile.mkdtemp(prefix = 'biz-dbindex-')
+        results = check_query_plans(load_models())
+        print(json.dumps(results, indent = 2, ensure_ascii = False))
+        shutil.rmtree(os.environ['DATA_DIR'], ignore_errors = True)
+        sys.exit(0 if all(r['ok'] for r in results) else 1)
+
+    import db_control
+
+    app = load_models()
+    indexes = missing_indexes(app, args.bind)
+    engine = db_control.get_engines(app)[args.bind]
+    if args.dry_run:
+        results = [{'table': index.table.name, 'index': index.name} for index in indexes]
+    elif args.estimate:
+        results = estimate(engine, indexes)
+    else:
+        results = build_indexes(engine, indexes)
+    print(json.dumps(results, indent = 2, ensure_ascii = False))
+
+
+if __name__ == '__main__':
+    main()
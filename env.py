@@ -1,3 +1,4 @@
+import importlib.util
 import os
 
 
@@ -7,11 +8,140 @@ def get_config():
             'default': 'default.sqlite',
             'score': 'score.sqlite',
             'scheduler': 'scheduler.sqlite'
+        },
+        'server': {
+            # production：以gunicorn多进程方式运行，dev：以flask开发服务器运行
+            'mode': os.environ.get('SERVER_MODE', 'production' if importlib.util.find_spec('gunicorn') else 'dev'),
+            'workers': int(os.environ.get('WORKERS', str(os.cpu_count() or 1))),
+            'threads': int(os.environ.get('THREADS', '4')),
+            'timeout': int(os.environ.get('WORKER_TIMEOUT', '30')),
+            # 收到SIGTERM后等待工作进程处理完当前请求的最长时间(秒)
+            'graceful_timeout': int(os.environ.get('GRACEFUL_TIMEOUT', '30'))
+        },
+        # SQLite连接池大小，为0时每次访问数据库都新建连接
+        'db_pool_size': int(os.environ.get('SQLITE_POOL_SIZE', '5')),
+        # 每个数据库连接建立时执行的PRAGMA，可用SQLITE_<绑定名>_<PRAGMA名>单独设置某个绑定
+        'db_pragmas': {bind: _sqlite_pragmas(bind) for bind in ('default', 'score', 'scheduler')},
+        # 定期执行wal_checkpoint及optimize的间隔(秒)，为0时不执行
+        'db_maintenance_interval': int(os.environ.get('SQLITE_MAINTENANCE_INTERVAL', '600')),
+        # 启动时数据库结构版本与上次迁移不一致时自动迁移，为0时须先执行python migrate.py
+        'auto_migrate': os.environ.get('AUTO_MIGRATE', '1') == '1',
+        'metrics': {
+            # 按endpoint统计请求延迟及SQL耗时，从/metrics输出
+            'enabled': os.environ.get('METRICS', '1') == '1',
+            # 是否允许非本机地址读取/metrics
+            'allow_remote': os.environ.get('METRICS_ALLOW_REMOTE', '0') == '1',
+            # 写语句耗时超过此值(毫秒)时计为一次SQLite锁等待
+            'lock_wait_threshold': float(os.environ.get('METRICS_LOCK_WAIT_MS', '20'))
+        },
+        'slow_query': {
+            # 慢查询阈值(毫秒)，为0时不记录
+            'threshold': float(os.environ.get('SLOW_QUERY_MS', '100')),
+            'buffer_size': int(os.environ.get('SLOW_QUERY_BUFFER_SIZE', '200')),
+            # 是否将慢查询写入scheduler数据库，多进程部署时可在管理界面查看全部工作进程的记录
+            'persist': os.environ.get('SLOW_QUERY_PERSIST', '0') == '1',
+            'persist_max_rows': int(os.environ.get('SLOW_QUERY_PERSIST_MAX_ROWS', '10000'))
+        },
+        'profile': {
+            # 请求header X-Profile或查询参数_profile的值与此一致时剖析该请求，为空时只允许已登录的管理员
+            'token': os.environ.get('PROFILE_TOKEN', ''),
+            # 同时剖析的最大请求数，超出时请求不剖析
+            'max_concurrent': int(os.environ.get('PROFILE_MAX_CONCURRENT', '1')),
+            # 调用栈采样间隔(毫秒)
+            'interval': float(os.environ.get('PROFILE_INTERVAL', '2')),
+            # 保留的剖析结果数
+            'keep': int(os.environ.get('PROFILE_KEEP', '50'))
+        },
+        'dashboard_stream': {
+            # 仪表板通过Server-Sent Events接收发言、签到、报点及积分的增量，为0时仪表板定时刷新汇总数据
+            'enabled': os.environ.get('DASHBOARD_STREAM', '1') == '1',
+            # 增量写入及轮询的间隔(秒)
+            'interval': float(os.environ.get('DASHBOARD_STREAM_INTERVAL', '1')),
+            # 每个进程同时推送的最大连接数，每个连接占用一个工作线程，默认为线程数的一半，单线程时不推送
+            'max_streams': int(os.environ.get('DASHBOARD_STREAM_MAX', str(int(os.environ.get('THREADS', '4')) // 2))),
+            # 连接保持的最长时间(秒)，到期后浏览器在retry秒后重连并重新获取汇总数据
+            'timeout': int(os.environ.get('DASHBOARD_STREAM_TIMEOUT', '300')),
+            'retry': int(os.environ.get('DASHBOARD_STREAM_RETRY', '3')),
+            'heartbeat': int(os.environ.get('DASHBOARD_STREAM_HEARTBEAT', '15')),
+            'keep_rows': int(os.environ.get('DASHBOARD_STREAM_KEEP_ROWS', '10000'))
+        },
+        'statistics_cache': {
+            # 仪表板统计数据按请求参数及所涉目标的写入水位缓存，写入水位来自dashboard_stream的增量，未开启推送时不缓存
+            'enabled': os.environ.get('STATISTICS_CACHE', '1') == '1',
+            'maxsize': int(os.environ.get('STATISTICS_CACHE_SIZE', '1000')),
+            # 不经过写入路径的修改(如在管理界面中编辑记录)最迟在ttl秒后生效
+            'ttl': int(os.environ.get('STATISTICS_CACHE_TTL', '60'))
+        },
+        'startup': {
+            # 管理界面的数据模型视图在首次访问/admin时创建，API进程不承担创建视图的开销
+            'lazy_views': os.environ.get('LAZY_VIEWS', '1') == '1',
+            # 启动完成后输出各插件导入、初始化等步骤的耗时
+            'report': os.environ.get('STARTUP_REPORT', '0') == '1'
+        },
+        'live_top': {
+            # 今天的发言排行榜由进程内的排行榜返回，每个目标保留k个发言人
+            'enabled': os.environ.get('LIVE_TOP', '1') == '1',
+            'k': int(os.environ.get('LIVE_TOP_K', '50')),
+            # 多进程部署时其他进程写入的发言最迟在refresh_interval秒后计入排行榜(需开启dashboard_stream)，为0时不合并
+            'refresh_interval': float(os.environ.get('LIVE_TOP_REFRESH', '5'))
+        },
+        'speak_records': {
+            # /speakrecords每次最多提交的记录数，全部记录在同一个事务中写入，超出时返回错误
+            'max_batch': int(os.environ.get('SPEAK_RECORDS_MAX_BATCH', '1000'))
+        },
+        'speak_buffer': {
+            # 发言记录写后缓冲，开启后/speakrecord在数据进入缓冲后即返回，由后台线程组提交
+            'enabled': os.environ.get('SPEAK_BUFFER', '0') == '1',
+            'flush_interval': int(os.environ.get('SPEAK_BUFFER_FLUSH_INTERVAL', '200')),
+            'flush_rows': int(os.environ.get('SPEAK_BUFFER_FLUSH_ROWS', '500')),
+            'queue_size': int(os.environ.get('SPEAK_BUFFER_QUEUE_SIZE', '10000')),
+            'fsync': os.environ.get('SPEAK_BUFFER_FSYNC', '0') == '1'
+        },
+        'rewash': {
+            # 重新清洗发言记录时并行清洗的进程数，小于2时在当前进程中清洗；也是API中workers参数的上限
+            'workers': int(os.environ.get('REWASH_WORKERS', '0'))
+        },
+        'wash_reconcile': {
+            # 后台重新清洗清洗规则版本已过期的发言记录
+            'enabled': os.environ.get('WASH_RECONCILE', '1') == '1',
+            'interval': int(os.environ.get('WASH_RECONCILE_INTERVAL', '10')),
+            'batch_size': int(os.environ.get('WASH_RECONCILE_BATCH_SIZE', '500')),
+            'pause': int(os.environ.get('WASH_RECONCILE_PAUSE', '200'))
+        },
+        'cache_ttl': {
+            # 进程内缓存的有效期(秒)，多进程部署时其他进程的修改最迟在有效期后生效
+            'wash_rule': int(os.environ.get('CACHE_TTL_WASH_RULE', '300')),
+            'apikey': int(os.environ.get('CACHE_TTL_APIKEY', '60')),
+            'bot_param': int(os.environ.get('CACHE_TTL_BOT_PARAM', '300')),
+            'target_rule': int(os.environ.get('CACHE_TTL_TARGET_RULE', '60'))
+        },
+        'cache_size': {
+            # 进程内缓存的最大条目数
+            'apikey': int(os.environ.get('CACHE_SIZE_APIKEY', '1024'))
         }
     }
     return config
 
 
+def _sqlite_pragmas(bind):
+    if os.environ.get('SQLITE_TUNING', '1') != '1':
+        return {}
+
+    def pragma(name, default):
+        return os.environ.get('SQLITE_' + bind.upper() + '_' + name, os.environ.get('SQLITE_' + name, default))
+
+    return {
+        # WAL模式下读不阻塞写，NORMAL同步级别在WAL模式下断电只会丢失最后的事务而不会损坏数据库
+        'journal_mode': pragma('JOURNAL_MODE', 'WAL'),
+        'synchronous': pragma('SYNCHRONOUS', 'NORMAL'),
+        'mmap_size': int(pragma('MMAP_SIZE', str(256 * 1024 * 1024))),
+        # 负数表示KB
+        'cache_size': int(pragma('CACHE_SIZE', str(-64 * 1024))),
+        'temp_store': pragma('TEMP_STORE', 'MEMORY'),
+        'busy_timeout': int(pragma('BUSY_TIMEOUT', '5000'))
+    }
+
+
 def _mkdir_if_not_exists_and_return_path(path):
     os.makedirs(path, exist_ok = True)
     return path
@@ -25,8 +155,12 @@ def get_plugin_dir(plugin_dir_name):
     return _mkdir_if_not_exists_and_return_path(os.path.join(get_root_dir(), plugin_dir_name))
 
 
+def get_data_dir():
+    return _mkdir_if_not_exists_and_return_path(os.environ.get('DATA_DIR', os.path.join(get_root_dir(), 'data')))
+
+
 def get_db_dir():
-    return _mkdir_if_not_exists_and_return_path(os.path.join(get_root_dir(), 'data', 'db'))
+    return _mkdir_if_not_exists_and_return_path(os.path.join(get_data_dir(), 'db'))
 
 
 def get_default_db_path():
@@ -34,7 +168,15 @@ def get_default_db_path():
 
 
 def get_tmp_dir():
-    return _mkdir_if_not_exists_and_return_path(os.path.join(get_root_dir(), 'data', 'tmp'))
+    return _mkdir_if_not_exists_and_return_path(os.path.join(get_data_dir(), 'tmp'))
+
+
+def get_spool_dir():
+    return _mkdir_if_not_exists_and_return_path(os.path.join(get_data_dir(), 'spool'))
+
+
+def get_profile_dir():
+    return _mkdir_if_not_exists_and_return_path(os.path.join(get_tmp_dir(), 'profiles'))
 
 
 def get_env_host():
@@ -0,0 +1,541 @@
+'''
+    并发负载回放
+
+    按比例混合发言写入、签到、报点及确认、积分变动和仪表板轮询，由多个进程、每个进程多个线程并发请求服务，
+    输出各类请求的p50/p95/p99延迟、错误率，以及压测期间各数据库绑定的SQLite锁等待次数
+    锁等待由压测前后抓取/metrics中的biz_sqlite_lock_*指标相减得到，多进程部署时多次抓取以覆盖各工作进程
+    请求序列可用--write-mix保存为JSONL后以--replay回放，也可回放按同样格式录制的请求，每行为：
+    {"name": "sign", "method": "POST", "path": "/sign", "data": {...}}
+    name为统计分组，data为表单(GET请求为查询参数)，"admin": true时以管理员登录后请求，"then": "pointconfirm"时
+    报点成功后以返回的confirm_code确认报点
+    用法：
+    python loadtest.py --serve [--server-mode production] [--workers 4] [--processes 2] [--concurrency 8]
+    python loadtest.py --url http://127.0.0.1:8080 --api-key KEY [--admin admin:admin] [--replay mix.jsonl]
+    --serve在临时数据目录中由benchmark.py生成数据并启动app.py，压测结束后停止
+'''
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from bisect import bisect_right
+from collections import Counter
+
+import benchmark
+
+# 默认的请求比例
+DEFAULT_MIX = 'speakrecord=50,sign=10,pointreport=10,score_change=10,dashboard=20'
+
+METRIC_LINE = re.compile(r'^(biz_process_start_time_seconds|biz_sqlite_lock_waits_total|biz_sqlite_lock_errors_total)'
+                         r'\{([^}]*)\} ([0-9.eE+-]+)$')
+METRIC_LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+
+def parse_mix(value):
+    '''
+    :param value: 如speakrecord=50,sign=10
+    :return: [(请求类型, 比例)]
+    '''
+    mix = []
+    for item in value.split(','):
+        (name, weight) = item.split('=')
+        if name not in BUILDERS:
+            raise ValueError('未知的请求类型：' + name)
+        mix.append((name, float(weight)))
+    return mix
+
+
+def _speakrecord(rng, i, botid, members):
+    return {'method': 'POST', 'path': '/speakrecord',
+            'data': {'target_type': 'group',
+                     'target_account': rng.choice(benchmark.TARGETS),
+                     'sender_id': str(20000 + rng.randrange(members)),
+                     'sender_name': '成员',
+                     'message': rng.choice(benchmark.MESSAGES)}}
+
+
+def _sign(rng, i, botid, members):
+    # 每个成员每天只能签到一次，使用序列号作为成员避免重复签到
+    return {'method': 'POST', 'path': '/sign',
+            'data': {'target_type': 'group',
+                     'target_account': rng.choice(benchmark.TARGETS),
+                     'member_id': str(100000 + i),
+                     'member_name': '签到成员',
+                     'message': '签到'}}
+
+
+def _pointreport(rng, i, botid, members):
+    return {'method': 'POST', 'path': '/pointreport', 'then': 'pointconfirm',
+            'data': {'target_type': 'group',
+                     'target_account': rng.choice(benchmark.TARGETS),
+                     'member_id': str(20000 + rng.randrange(members)),
+                     'member_name': '成员',
+                     'reporter_id': str(20000 + rng.randrange(members)),
+                     'reporter_name': '成员',
+                     'point': 1,
+                     'message': '报点'}}
+
+
+def _score_change(rng, i, botid, members):
+    return {'method': 'POST', 'path': '/score_change',
+            'data': {'biz_type': benchmark.SCORE_INCOME if rng.random() < 0.7 else benchmark.SCORE_OUTGO,
+                     'member_id': str(20000 + rng.randrange(members))}}
+
+
+def _dashboard(rng, i, botid, members):
+    # 仪表板打开时先请求汇总数据，再轮询各目标的发言统计及排行榜
+    query = rng.choice([{'type': 1, 'botid': botid}] +
+                       [{'type': 2, 'botid': botid, 'target': 'g#' + t, 'days': 30} for t in benchmark.TARGETS] +
+                       [{'type': 4, 'botid': botid, 'target': 'g#' + t, 'days': 7} for t in benchmark.TARGETS])
+    return {'method': 'GET', 'path': '/admin/statistics/', 'admin': True, 'data': query}
+
+
+BUILDERS = {'speakrecord': _speakrecord,
+            'sign': _sign,
+            'pointreport': _pointreport,
+            'score_change': _score_change,
+            'dashboard': _dashboard}
+
+
+def synthetic_mix(count, mix, botid = benchmark.BOTID, members = 200, seed = 1):
+    '''
+    按比例生成请求序列
+    :param count: 请求数(报点确认不计入)
+    :param mix: parse_mix的结果
+    :return: 请求列表
+    '''
+    rng = random.Random(seed)
+    names = [name for (name, weight) in mix]
+    cumulative = []
+    total = 0
+    for (name, weight) in mix:
+        total += weight
+        cumulative.append(total)
+    entries = []
+    for i in range(count):
+        name = names[min(bisect_right(cumulative, rng.random() * total), len(names) - 1)]
+        entry = BUILDERS[name](rng, i, botid, members)
+        entry['name'] = name
+        entries.append(entry)
+    return entries
+
+
+def load_mix(path):
+    with open(path, encoding = 'utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_mix(path, entries):
+    with open(path, 'w', encoding = 'utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii = False) + '\n')
+
+
+class Client:
+    def __init__(self, url, api_key, timeout = 30):
+        '''
+        保持长连接的HTTP客户端，每个线程一个
+        :param url: 服务地址，如http://127.0.0.1:8080
+        :param api_key: 机器人的API Key
+        '''
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.timeout = timeout
+        self.authorization = json.dumps({'api_key': api_key})
+        self.cookie = None
+        self.conn = None
+
+    def request(self, method, path, data = None, admin = False):
+        '''
+        :return: (状态码, 响应内容)
+        '''
+        body = None
+        headers = {}
+        query = urllib.parse.urlencode(data or {})
+        if method == 'GET':
+            if query:
+                path = path + '?' + query
+        else:
+            body = query
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if admin:
+            if self.cookie:
+                headers['Cookie'] = self.cookie
+        else:
+            headers['Authorization'] = self.authorization
+
+        # 服务端关闭了空闲的长连接时重连一次
+        for retry in (True, False):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout = self.timeout)
+            try:
+                self.conn.request(method, path, body = body, headers = headers)
+                resp = self.conn.getresponse()
+                content = resp.read()
+            except (http.client.RemoteDisconnected, ConnectionError, http.client.BadStatusLine):
+                self.close()
+                if retry:
+                    continue
+                raise
+            cookie = resp.getheader('Set-Cookie')
+            if cookie:
+                self.cookie = cookie.split(';', 1)[0]
+            if resp.getheader('Connection', '').lower() == 'close':
+                self.close()
+            return (resp.status, content)
+
+    def login(self, username, password):
+        (status, content) = self.request('POST', '/admin/login/', {'username': username, 'password': password},
+                                         admin = True)
+        if status != 302:
+            raise Exception('管理员登录失败：%d' % status)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 请求类型 -> 统计
+        self.stats = {}
+
+    def record(self, name, seconds, status, content):
+        try:
+            result = json.loads(content.decode('utf-8')) if status == 200 else None
+        except ValueError:
+            result = None
+        with self._lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = {'samples': [], 'errors': 0, 'faults': 0, 'locked': 0,
+                                           'messages': Counter()}
+            stat['samples'].append(seconds)
+            if status != 200:
+                stat['errors'] += 1
+                stat['messages']['HTTP %d' % status] += 1
+                if b'database is locked' in content:
+                    stat['locked'] += 1
+            elif isinstance(result, dict) and result.get('success') == 0:
+                # 业务拒绝(如重复签到、报点超出上限)，请求本身已正常处理
+                stat['faults'] += 1
+                message = str(result.get('message', ''))
+                stat['messages'][message[:80]] += 1
+                if 'database is locked' in message:
+                    stat['locked'] += 1
+        return result
+
+    def record_exception(self, name, seconds, e):
+        with self._lock:
+            stat = self.stats.setdefault(name, {'samples': [], 'errors': 0, 'faults': 0, 'locked': 0,
+                                                'messages': Counter()})
+            stat['samples'].append(seconds)
+            stat['errors'] += 1
+            stat['messages'][type(e).__name__] += 1
+
+
+def _run_thread(client, entries, next_index, deadline, recorder):
+    while True:
+        i = next_index()
+        if i is None or (deadline is not None and time.time() >= deadline):
+            break
+        entry = entries[i % len(entries)]
+        name = entry.get('name', entry['path'])
+        start = time.perf_counter()
+        try:
+            (status, content) = client.request(entry['method'], entry['path'], entry.get('data'),
+                                               entry.get('admin', False))
+        except Exception as e:
+            recorder.record_exception(name, time.perf_counter() - start, e)
+            continue
+        result = recorder.record(name, time.perf_counter() - start, status, content)
+
+        if entry.get('then') == 'pointconfirm' and isinstance(result, dict) and result.get('success') == 1:
+            data = entry['data']
+            params = {'target_type': data['target_type'], 'target_account': data['target_account'],
+                      'member_id': data['member_id'], 'confirm_code': result['data']['confirm_code']}
+            start = time.perf_counter()
+            try:
+                (status, content) = client.request('PATCH', '/pointconfirm', params)
+            except Exception as e:
+                recorder.record_exception('pointconfirm', time.perf_counter() - start, e)
+                continue
+            recorder.record('pointconfirm', time.perf_counter() - start, status, content)
+
+
+def run_process(url, api_key, admin, entries, concurrency, duration, queue):
+    '''
+    在一个进程中以concurrency个线程请求entries，duration为0时每个请求执行一次，否则循环执行duration秒
+    结果放入queue
+    '''
+    recorder = Recorder()
+    deadline = time.time() + duration if duration else None
+    lock = threading.Lock()
+    counter = [0]
+
+    def next_index():
+        with lock:
+            i = counter[0]
+            if deadline is None and i >= len(entries):
+                return None
+            counter[0] += 1
+            return i
+
+    clients = []
+    threads = []
+    for t in range(concurrency):
+        client = Client(url, api_key)
+        if admin and any(entry.get('admin') for entry in entries):
+            client.login(*admin)
+        clients.append(client)
+        threads.append(threading.Thread(target = _run_thread,
+                                        args = (client, entries, next_index, deadline, recorder)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for client in clients:
+        client.close()
+
+    queue.put({name: dict(stat, messages = dict(stat['messages'])) for (name, stat) in recorder.stats.items()})
+
+
+def scrape_locks(url, scrapes):
+    '''
+    多次抓取/metrics，每次新建连接以分散到不同的工作进程
+    :return: {进程号: {'start': 启动时间, 'waits': {绑定: 次数}, 'errors': {绑定: 次数}}}
+    '''
+    parsed = urllib.parse.urlsplit(url)
+    processes = {}
+    for i in range(scrapes):
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout = 10)
+        try:
+            conn.request('GET', '/metrics', headers = {'Connection': 'close'})
+            resp = conn.getresponse()
+            if resp.status != 200:
+                return processes
+            text = resp.read().decode('utf-8')
+        except (OSError, http.client.HTTPException):
+            return processes
+        finally:
+            conn.close()
+        current = {'start': None, 'waits': {}, 'errors': {}}
+        pid = None
+        for line in text.splitlines():
+            match = METRIC_LINE.match(line)
+            if match is None:
+                continue
+            (metric, labels, value) = match.groups()
+            labels = dict(METRIC_LABEL.findall(labels))
+            if metric == 'biz_process_start_time_seconds':
+                (pid, current['start']) = (labels['pid'], float(value))
+            elif metric == 'biz_sqlite_lock_waits_total':
+                current['waits'][labels['bind']] = int(float(value))
+            else:
+                current['errors'][labels['bind']] = int(float(value))
+        if pid is not None:
+            processes[pid] = current
+    return processes
+
+
+def diff_locks(before, after):
+    '''
+    :return: 压测期间各绑定的锁等待及锁超时次数，压测中重启的工作进程按全部计入
+    '''
+    result = {'waits': Counter(), 'errors': Counter(), 'processes': len(after)}
+    for (pid, current) in after.items():
+        base = before.get(pid)
+        if base is not None and base['start'] != current['start']:
+            base = None
+        for kind in ('waits', 'errors'):
+            for (bind, count) in current[kind].items():
+                result[kind][bind] += count - (base[kind].get(bind, 0) if base else 0)
+    return {'waits': dict(result['waits']), 'errors': dict(result['errors']), 'processes': result['processes']}
+
+
+def _percentile(samples, p):
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+
+def summarize(results, seconds):
+    '''
+    合并各进程的结果
+    :return: 各类请求的延迟及错误率
+    '''
+    merged = {}
+    for result in results:
+        for (name, stat) in result.items():
+            item = merged.setdefault(name, {'samples': [], 'errors': 0, 'faults': 0, 'locked': 0,
+                                            'messages': Counter()})
+            item['samples'].extend(stat['samples'])
+            for key in ('errors', 'faults', 'locked'):
+                item[key] += stat[key]
+            item['messages'].update(stat['messages'])
+
+    endpoints = {}
+    for (name, item) in sorted(merged.items()):
+        samples = sorted(item['samples'])
+        count = len(samples)
+        endpoints[name] = {'requests': count,
+                           'rps': round(count / seconds, 1) if seconds > 0 else None,
+                           'ms_p50': round(_percentile(samples, 0.5) * 1000, 2),
+                           'ms_p95': round(_percentile(samples, 0.95) * 1000, 2),
+                           'ms_p99': round(_percentile(samples, 0.99) * 1000, 2),
+                           'ms_max': round(samples[-1] * 1000, 2),
+                           'error_rate': round(item['errors'] / count, 4),
+                           'fault_rate': round(item['faults'] / count, 4),
+                           'locked': item['locked'],
+                           'top_messages': dict(item['messages'].most_common(3))}
+    total = sum(e['requests'] for e in endpoints.values())
+    return {'seconds': round(seconds, 3),
+            'requests': total,
+            'rps': round(total / seconds, 1) if seconds > 0 else None,
+            'endpoints': endpoints}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve(args):
+    '''
+    在临时数据目录中生成数据并启动服务
+    :return: (服务进程, 服务地址, API Key)
+    '''
+    # 服务进程继承create_test_app设置的DATA_DIR
+    benchmark.create_test_app(tempfile.mkdtemp(prefix = 'biz-load-'))
+    headers = benchmark.prepare_bot()
+    benchmark.generate([benchmark.BOTID], args.members, args.speak_rows, args.days,
+                       args.speak_rows // 10, args.speak_rows // 10, args.speak_rows // 4)
+
+    import db_control
+    from plugins.setting import BotParam
+
+    # 报点上限足够大使报点不因超限被拒绝，签到时增加积分
+    for name in ('point_accept_limit', 'point_normal_limit', 'point_newbie_limit'):
+        BotParam.create(benchmark.BOTID, name, '1000000')
+    BotParam.create(benchmark.BOTID, 'sign_code', benchmark.SCORE_INCOME)
+    db = db_control.get_db()
+    db.session.remove()
+    for engine in db_control.get_engines().values():
+        engine.dispose()
+
+    port = _free_port()
+    env = dict(os.environ, HOST = '127.0.0.1', PORT = str(port), SERVER_MODE = args.server_mode)
+    if args.workers:
+        env['WORKERS'] = str(args.workers)
+    log = open(os.path.join(os.environ['DATA_DIR'], 'server.log'), 'w')
+    proc = subprocess.Popen([sys.executable, os.path.join(os.path.split(os.path.realpath(__file__))[0], 'app.py')],
+                            env = env, stdout = log, stderr = subprocess.STDOUT)
+    url = 'http://127.0.0.1:%d' % port
+    for i in range(600):
+        if proc.poll() is not None:
+            raise Exception('服务启动失败，见' + log.name)
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout = 1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return (proc, url, json.loads(headers['Authorization'])['api_key'])
+
+
+def run(args, url, api_key):
+    if args.replay:
+        entries = load_mix(args.replay)
+    else:
+        entries = synthetic_mix(args.requests, parse_mix(args.mix), members = args.members, seed = args.seed)
+    if args.write_mix:
+        write_mix(args.write_mix, entries)
+    admin = tuple(args.admin.split(':', 1)) if args.admin else None
+    scrapes = max(args.processes * args.concurrency, 10) * 2
+
+    locks_before = scrape_locks(url, scrapes)
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target = run_process,
+                                         args = (url, api_key, admin, entries[p::args.processes], args.concurrency,
+                                                 args.duration, queue))
+                 for p in range(args.processes)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    # 先取结果再join，避免结果较大时子进程阻塞在队列写入上
+    results = [queue.get() for process in processes]
+    seconds = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    locks_after = scrape_locks(url, scrapes)
+
+    summary = summarize(results, seconds)
+    summary['sqlite_locks'] = diff_locks(locks_before, locks_after)
+    summary['meta'] = {'url': url,
+                       'processes': args.processes,
+                       'concurrency': args.concurrency,
+                       'duration': args.duration,
+                       'mix': args.replay or args.mix,
+                       'server_mode': args.server_mode if args.serve else None,
+                       'workers': args.workers if args.serve else None}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description = '并发负载回放')
+    parser.add_argument('--serve', action = 'store_true', help = '在临时数据目录中生成数据并启动服务')
+    parser.add_argument('--url', help = '已运行的服务地址')
+    parser.add_argument('--api-key', help = '已运行的服务中机器人的API Key')
+    parser.add_argument('--admin', default = 'admin:admin', help = '仪表板请求使用的管理员账号，格式为用户名:密码')
+    parser.add_argument('--server-mode', default = 'production', choices = ('production', 'dev'),
+                        help = '--serve启动服务的方式')
+    parser.add_argument('--workers', type = int, default = 0, help = '--serve启动服务的工作进程数，为0时按CPU数')
+    parser.add_argument('--members', type = int, default = 200, help = '每个目标的成员数')
+    parser.add_argument('--days', type = int, default = 30, help = '--serve生成数据的天数')
+    parser.add_argument('--speak-rows', type = int, default = 20000, help = '--serve生成的发言记录数')
+    parser.add_argument('--mix', default = DEFAULT_MIX, help = '各类请求的比例')
+    parser.add_argument('--replay', help = '回放的请求序列JSONL文件')
+    parser.add_argument('--write-mix', help = '保存请求序列的JSONL文件')
+    parser.add_argument('--requests', type = int, default = 2000, help = '生成的请求数')
+    parser.add_argument('--processes', type = int, default = 2, help = '发起请求的进程数')
+    parser.add_argument('--concurrency', type = int, default = 4, help = '每个进程的并发线程数')
+    parser.add_argument('--duration', type = int, default = 0, help = '循环请求的秒数，为0时每个请求执行一次')
+    parser.add_argument('--seed', type = int, default = 1, help = '随机数种子')
+    parser.add_argument('--output', help = '结果JSON文件')
+    args = parser.parse_args()
+
+    if not args.serve and not (args.url and args.api_key):
+        parser.error('须指定--serve，或同时指定--url及--api-key')
+
+    proc = None
+    if args.serve:
+        (proc, url, api_key) = serve(args)
+    else:
+        (url, api_key) = (args.url.rstrip('/'), args.api_key)
+    try:
+        summary = run(args, url, api_key)
+    finally:
+        if proc is not None:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(60)
+
+    output = json.dumps(summary, indent = 2, ensure_ascii = False)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding = 'utf-8') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+'''
+    数据库迁移工具
+
+    插件模块导入时不再创建数据表，由本工具在部署或升级后执行一次：
+    创建缺失的数据表，为已存在的数据表补充新增的可空字段，执行尚未完成的数据迁移，并记录结构版本。
+    app启动时结构版本一致即跳过迁移；AUTO_MIGRATE=1(默认)时不一致会自动迁移，
+    为0时启动前须先执行本工具。缺失的索引在大表上创建耗时较长，由dbindex.py创建。
+    用法：python migrate.py [--check]
+'''
+import argparse
+import json
+import os
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description = '数据库迁移工具')
+    parser.add_argument('--check', action = 'store_true', help = '只检查结构版本及数据迁移，需要迁移时以非0状态退出')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.split(os.path.realpath(__file__))[0])
+
+    import db_control
+    import plugin
+    from app import app
+
+    plugin.import_plugins('common')
+    plugin.import_plugins('plugins')
+
+    if args.check:
+        version = db_control.get_schema_version()
+        migrated_version = db_control.get_migrated_version()
+        pending = db_control.get_pending_data_migrations(app)
+        print(json.dumps({'version': version, 'migrated_version': migrated_version,
+                          'pending_data_migrations': pending}, indent = 2))
+        sys.exit(0 if migrated_version == version and len(pending) == 0 else 1)
+
+    print(json.dumps(db_control.migrate(app), indent = 2, ensure_ascii = False))
+
+
+if __name__ == '__main__':
+    main()
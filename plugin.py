@@ -1,6 +1,10 @@
+import atexit
 import importlib
 import os
 import sys
+import threading
+import time
+from contextlib import contextmanager
 
 from env import get_plugin_dir
 
@@ -14,6 +18,7 @@ class PluginsRegistry:
         self.init_func = init_func
         self.model_map = {}
         self.view_map = {}
+        self.page_map = {}
 
     def register_model(self, order):
         def decorator(cls):
@@ -29,6 +34,18 @@ class PluginsRegistry:
 
         return decorator
 
+    def register_page(self):
+        """
+        Register an admin view that is not bound to a model,
+        the class is instantiated without arguments.
+        """
+
+        def decorator(cls):
+            self.page_map[cls.__name__] = cls
+            return cls
+
+        return decorator
+
 
 class PluginsHub:
     """
@@ -74,13 +91,100 @@ def _add_registry_mod_cb(mod):
 
 
 def load_plugins(plugin_dir_name, app = None):
+    for mod in import_plugins(plugin_dir_name):
+        init_plugin(mod, app)
+
+
+def import_plugins(plugin_dir_name):
+    """
+    Import the plugin modules in a directory without running their init,
+    timing each import for the startup report.
+
+    :param plugin_dir_name: plugin directory name, e.g. 'plugins'
+    :return: list of imported modules
+    """
     plugin_dir = get_plugin_dir(plugin_dir_name)
     plugin_files = filter(
         lambda filename: filename.endswith('.py') and not filename.startswith('_'),
-        os.listdir(plugin_dir)
+        sorted(os.listdir(plugin_dir))
     )
-    plugins = [os.path.splitext(file)[0] for file in plugin_files]
-    for mod_name in plugins:
-        mod = importlib.import_module(plugin_dir_name + '.' + mod_name)
+    mods = []
+    for mod_name in [os.path.splitext(file)[0] for file in plugin_files]:
+        with timed('import ' + plugin_dir_name + '.' + mod_name):
+            mods.append(importlib.import_module(plugin_dir_name + '.' + mod_name))
+    return mods
+
+
+def init_plugin(mod, app = None):
+    """
+    Run the init of an imported plugin module and add its registry to the hub.
+    """
+    with timed('init ' + mod.__name__):
         _init_mod(mod, app)
-        _add_registry_mod_cb(mod)
\ No newline at end of file
+        _add_registry_mod_cb(mod)
+
+
+_timings = []
+
+
+@contextmanager
+def timed(name):
+    """
+    Record how long a startup step takes, shown by startup_report().
+
+    :param name: step name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _timings.append((name, time.perf_counter() - start))
+
+
+def startup_report():
+    """
+    Format the recorded startup steps, slowest first.
+
+    :return: report text
+    """
+    total = sum(seconds for (name, seconds) in _timings)
+    lines = ['Startup report (%d steps, %.1f ms):' % (len(_timings), total * 1000)]
+    for (name, seconds) in sorted(_timings, key = lambda t: t[1], reverse = True):
+        lines.append('  %8.1f ms  %5.1f%%  %s' % (seconds * 1000, seconds * 100 / total if total else 0, name))
+    return '\n'.join(lines)
+
+
+_shutdown_funcs = []
+_shutdown_pid = None
+
+# Set when the process has been asked to stop, so that long-running
+# responses such as event streams can finish before the graceful timeout.
+stopping = threading.Event()
+
+
+def register_shutdown(func):
+    """
+    Register a cleanup function run once when the process exits,
+    e.g. flushing buffers. Usable as a decorator.
+    """
+    _shutdown_funcs.append(func)
+    return func
+
+
+def shutdown():
+    """
+    Run the registered cleanup functions once per process.
+    Called at interpreter exit and by the production server when a worker exits.
+    """
+    global _shutdown_pid
+    if _shutdown_pid == os.getpid():
+        return
+    _shutdown_pid = os.getpid()
+    for func in _shutdown_funcs:
+        try:
+            func()
+        except Exception as e:
+            print('Failed to run shutdown function "' + func.__qualname__ + '": ' + str(e), file = sys.stderr)
+
+
+atexit.register(shutdown)
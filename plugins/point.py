@@ -6,6 +6,7 @@ from sqlalchemy import case, func, and_
 import api_control as ac
 import db_control
 from app_view import CVAdminModelView
+from common.dashboard_stream import delta_hub
 from common.util import get_now, get_botname, get_target_composevalue, get_target_display, output_datetime,\
     generate_key,\
     get_yesno_display, display_datetime, get_list_by_botassign,\
@@ -23,6 +24,9 @@ db = db_control.get_db()
 class Point(db.Model):
     __bind_key__ = 'score'
     __tablename__ = 'point_record'
+    # 覆盖get_report_count，查询不需要回表
+    __table_args__ = (db.Index('ix_point_record_botid_target_reporter_date',
+                               'botid', 'target', 'reporter_id', 'date', 'has_confirmed', 'member_id', 'point'),)
 
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
     botid = db.Column(db.String(20), nullable = False)
@@ -66,11 +70,11 @@ class Point(db.Model):
 
     @staticmethod
     def check_limit(botid, target, member_id, reporter_id, point: int, date, is_newbie: bool = False):
-        member_limit = int(BotParam.find(botid, 'point_accept_limit').value)
-        if is_newbie:
-            report_limit = int(BotParam.find(botid, 'point_newbie_limit').value)
-        else:
-            report_limit = int(BotParam.find(botid, 'point_normal_limit').value)
+        params = BotParam.get_params(botid)
+        member_limit = params.get('point_accept_limit')
+        report_limit = params.get('point_newbie_limit' if is_newbie else 'point_normal_limit')
+        if member_limit is None or report_limit is None:
+            raise Exception('机器人参数中的报点上限未设置或不是整数')
         result = Point.get_report_count(botid, target, member_id, reporter_id, date)
         if int(result.reporter_confirmed_total) + point > report_limit:
             raise Exception('报点数超过了报点人今天累计的上限')
@@ -145,7 +149,9 @@ class Point(db.Model):
                           is_newbie)
 
         point.has_confirmed = 1
+        delta = (point.botid, point.target, point.date, point.point)
         Point.query.session.commit()
+        delta_hub.publish(delta[0], delta[1], delta[2], point = delta[3])
 
         return point
 
@@ -176,6 +182,28 @@ class Point(db.Model):
             Point.member_id == member_id if member_id is not None else 1 == 1
         ).first()
 
+    @staticmethod
+    def get_total_by_targets(targets, date_from, date_to):
+        '''
+        按目标分组统计已确认的报点数，查询次数与目标数无关
+        :param targets: (机器人ID, 目标)的列表
+        :return: (机器人ID, 目标) -> 已确认的报点数
+        '''
+        targets = set(targets)
+        if len(targets) == 0:
+            return {}
+        records = Point.query.session.query(
+            Point.botid, Point.target,
+            func.sum(case([(Point.has_confirmed == 1, Point.point)], else_ = 0)).label('total_success')
+        ).filter(
+            Point.botid.in_({botid for (botid, target) in targets}),
+            Point.target.in_({target for (botid, target) in targets}),
+            Point.date >= date_from,
+            Point.date <= date_to
+        ).group_by(Point.botid, Point.target).all()
+        return {(r.botid, r.target): r.total_success or 0 for r in records if (r.botid, r.target) in targets}
+
+
 @pr.register_model(21)
 class PointConfirm(db.Model):
     __bind_key__ = 'score'
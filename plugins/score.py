@@ -13,6 +13,7 @@ import api_control as ac
 import db_control
 from app_view import CVAdminModelView
 from common.bot import Bot
+from common.dashboard_stream import delta_hub
 from common.util import get_now, display_datetime, get_botname, get_yesno_display, get_acttype_display,\
     get_acttype_choice, get_target_display, output_datetime,\
     get_transtype_display, get_list_by_botassign, get_list_count_by_botassign, get_list_by_scoreaccount,\
@@ -160,6 +161,8 @@ class ScoreMember(db.Model):
 class ScoreRecord(db.Model):
     __bind_key__ = 'score'
     __tablename__ = 'score_record'
+    # 覆盖get_flow，查询不需要回表
+    __table_args__ = (db.Index('ix_score_record_account_date', 'account', 'date', 'member_id', 'amount'),)
 
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
     account = db.Column(db.String(20), nullable = False, index = True)
@@ -216,6 +219,7 @@ class ScoreRecord(db.Model):
         else:
             ScoreMember.increase(account, member_id, amount, **kwargs)
             ScoreAccount.increase(account, member_id, amount)
+        ScoreRecord.publish_flow(account, amount)
         return record
 
     @staticmethod
@@ -269,16 +273,34 @@ class ScoreRecord(db.Model):
         ScoreAccount.reduce(account, outgo_member_id, amount)
         ScoreMember.increase(account, income_member_id, amount, **kwargs)
         ScoreAccount.increase(account, income_member_id, amount)
+        # 转出与转入各计一次流水
+        ScoreRecord.publish_flow(account, amount * 2)
 
         return record
 
+    @staticmethod
+    def publish_flow(account, amount):
+        '''
+        向仪表板推送积分账户所在目标的积分流水增量
+        :param account: 积分账户
+        :param amount: 流水金额
+        '''
+        if not delta_hub.enabled:
+            return
+        act = ScoreAccount.get_acount(account)
+        if act is not None:
+            delta_hub.publish(act.botid, act.target, get_now().date(), score = abs(amount))
+
     @staticmethod
     def find_by_member(member_id):
         session = sessionmaker(bind = db.get_engine(bind = 'score'))()
-        cnts = session.execute('SELECT count(1) cnt FROM score_record WHERE member_id = :id', {'id': member_id})
-        if cnts is not None:
-            return cnts.first()
-        return None
+        try:
+            cnts = session.execute('SELECT count(1) cnt FROM score_record WHERE member_id = :id', {'id': member_id})
+            if cnts is not None:
+                return cnts.first()
+            return None
+        finally:
+            session.close()
 
     @staticmethod
     def find_first_by_member_name(member_name):
@@ -305,8 +327,27 @@ class ScoreRecord(db.Model):
             ScoreRecord.member_id == member_id if member_id is not None else 1 == 1
         ).first()
 
-
-db.create_all()
+    @staticmethod
+    def get_flow_by_targets(targets, date_from, date_to):
+        '''
+        按积分账户所在的目标分组统计积分流水，查询次数与目标数无关
+        :param targets: (机器人ID, 目标)的列表
+        :return: (机器人ID, 目标) -> 积分流水合计，目标下没有积分账户时不包含该目标
+        '''
+        targets = set(targets)
+        if len(targets) == 0:
+            return {}
+        records = ScoreRecord.query.session.query(
+            ScoreAccount.botid, ScoreAccount.target, func.sum(func.abs(ScoreRecord.amount)).label('total')
+        ).join(
+            ScoreAccount, ScoreAccount.name == ScoreRecord.account
+        ).filter(
+            ScoreAccount.botid.in_({botid for (botid, target) in targets}),
+            ScoreAccount.target.in_({target for (botid, target) in targets}),
+            ScoreRecord.date >= date_from,
+            ScoreRecord.date <= date_to
+        ).group_by(ScoreAccount.botid, ScoreAccount.target).all()
+        return {(r.botid, r.target): r.total or 0 for r in records if (r.botid, r.target) in targets}
 
 
 # View-----------------------------------------------------------------------------------------------------
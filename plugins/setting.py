@@ -6,8 +6,13 @@
 
 """
 
+import json
+import zlib
+
+from flask import request, Response
 from flask_admin.form import rules, Select2Widget
 from flask_restful import reqparse, Resource
+from werkzeug.http import quote_etag
 from wtforms import validators, fields
 
 import api_control as ac
@@ -15,8 +20,10 @@ import db_control
 from app_view import CVAdminModelView
 from common.basedata import Basedata
 from common.bot import Bot, bot_registry
+from common.cache import Cache
 from common.util import get_now, display_datetime, get_botname, get_target_display, get_target_type_choice,\
     get_target_composevalue, get_list_by_botassign, get_list_count_by_botassign
+from env import get_config as config
 from plugin import PluginsRegistry
 
 __registry__ = pr = PluginsRegistry()
@@ -38,6 +45,14 @@ class BotParam(db.Model):
     update_at = db.Column(db.DateTime, nullable = False, default = lambda: get_now(), onupdate = lambda: get_now())
     remark = db.Column(db.String(255), nullable = True)
 
+    # 按参数名转换参数值的类型，未列出的参数保持字符串
+    value_types = {'point_accept_limit': int,
+                   'point_newbie_limit': int,
+                   'point_normal_limit': int,
+                   'speak_valid_baseline': int}
+
+    param_cache = Cache('bot_param', ttl = config().get('cache_ttl', {}).get('bot_param'))
+
     @staticmethod
     def create(botid, name, value, remark = None, update = False):
         param = BotParam.find(botid, name)
@@ -48,6 +63,7 @@ class BotParam(db.Model):
                              remark = remark if remark is not None else '')
             param.query.session.add(param)
             param.query.session.commit()
+            BotParam.param_cache.invalidate(botid)
         else:
             if update:
                 param = BotParam.update(botid, name, value, remark)
@@ -61,6 +77,7 @@ class BotParam(db.Model):
             param.value = value
             if remark:  param.remark = remark
             param.query.session.commit()
+            BotParam.param_cache.invalidate(botid)
         return param
 
     @staticmethod
@@ -75,13 +92,55 @@ class BotParam(db.Model):
     def delete(botid, name):
         BotParam.query.filter_by(botid = botid, name = name).delete()
         BotParam.query.session.commit()
+        BotParam.param_cache.invalidate(botid)
         return True
 
+    @staticmethod
+    def load_params(botid):
+        '''
+        一次查询加载机器人的全部参数并按value_types转换类型
+        :param botid: 机器人ID
+        :return: 参数名到参数值的字典，无法转换类型的参数值为None
+        '''
+        params = {}
+        for r in BotParam.findall(botid):
+            value_type = BotParam.value_types.get(r.name)
+            if value_type is None:
+                params[r.name] = r.value
+            else:
+                try:
+                    params[r.name] = value_type(r.value)
+                except ValueError:
+                    params[r.name] = None
+        return params
+
+    @staticmethod
+    def get_params(botid):
+        '''
+        获取机器人的全部参数，参数变化前不再访问数据库，返回的字典为缓存本身，不可修改
+        :param botid: 机器人ID
+        :return: 参数名到参数值的字典
+        '''
+        return BotParam.param_cache.get(botid, BotParam.load_params)
+
+    @staticmethod
+    def get_value(botid, name, default = None):
+        '''
+        获取已转换类型的参数值
+        :param botid: 机器人ID
+        :param name: 参数名
+        :param default: 参数不存在或无法转换类型时的返回值
+        :return: 参数值
+        '''
+        value = BotParam.get_params(botid).get(name)
+        return default if value is None else value
+
     @staticmethod
     @br.register_init()
     def init(botid):
         for r in Basedata.find_by_type(1):
             BotParam.create(botid, r.value, '请更新设置', r.name)
+        BotParam.param_cache.invalidate(botid)
         return True
 
     @staticmethod
@@ -89,9 +148,43 @@ class BotParam(db.Model):
     def destroy(botid):
         for r in BotParam.findall(botid):
             BotParam.delete(botid, r.name)
+        BotParam.param_cache.invalidate(botid)
         return True
 
 
+class TargetRuleIndex:
+    '''
+    机器人的允许/拒绝目标索引
+    '''
+
+    def __init__(self, botid, rules):
+        '''
+        :param botid: 机器人ID
+        :param rules: TargetRule列表
+        '''
+        self.botid = botid
+        self.targets = {'allow': set(), 'block': set()}
+        self.rules = {'allow': [], 'block': []}
+        for rule in sorted(rules, key = lambda r: (r.type, r.target)):
+            self.targets.setdefault(rule.type, set()).add(rule.target)
+            self.rules.setdefault(rule.type, []).append({'botid': rule.botid,
+                                                         'type': rule.type,
+                                                         'target': rule.target,
+                                                         'create_at': rule.create_at.strftime('%Y-%m-%d %H:%M'),
+                                                         'update_at': rule.update_at.strftime('%Y-%m-%d %H:%M'),
+                                                         'remark': rule.remark})
+        # 版本号由规则内容计算得出，多进程部署时各进程对同样的规则给出同样的版本号
+        self.version = zlib.crc32(json.dumps(self.rules, sort_keys = True).encode('utf-8'))
+        self.etag = botid + '-' + str(self.version)
+
+    def check(self, target):
+        '''
+        :param target: 目标，格式为类型前缀#账号
+        :return: (是否在允许列表中, 是否在拒绝列表中)
+        '''
+        return target in self.targets['allow'], target in self.targets['block']
+
+
 @pr.register_model(72)
 class TargetRule(db.Model):
     __bind_key__ = 'score'
@@ -104,6 +197,8 @@ class TargetRule(db.Model):
     update_at = db.Column(db.DateTime, nullable = False, default = lambda: get_now(), onupdate = lambda: get_now())
     remark = db.Column(db.String(255), nullable = True)
 
+    index_cache = Cache('target_rule', ttl = config().get('cache_ttl', {}).get('target_rule'))
+
     @staticmethod
     def create(botid, type, target, remark = None):
         rule = TargetRule.find(botid, type, target)
@@ -114,6 +209,7 @@ class TargetRule(db.Model):
                               remark = remark if remark else '')
             rule.query.session.add(rule)
             rule.query.session.commit()
+            TargetRule.index_cache.invalidate(botid)
         return rule
 
     @staticmethod
@@ -142,6 +238,7 @@ class TargetRule(db.Model):
     def delete(botid, type, target):
         TargetRule.query.filter_by(botid = botid, type = type, target = target).delete()
         TargetRule.query.session.commit()
+        TargetRule.index_cache.invalidate(botid)
         return True
 
     @staticmethod
@@ -149,10 +246,17 @@ class TargetRule(db.Model):
     def destroy(botid):
         for r in TargetRule.findall(botid):
             TargetRule.delete(botid, r.type, r.target)
+        TargetRule.index_cache.invalidate(botid)
         return True
 
-
-db.create_all()
+    @staticmethod
+    def get_index(botid):
+        '''
+        获取机器人的允许/拒绝目标索引，规则变化前不再访问数据库
+        :param botid: 机器人ID
+        :return: TargetRuleIndex
+        '''
+        return TargetRule.index_cache.get(botid, lambda botid: TargetRuleIndex(botid, TargetRule.findall(botid)))
 
 
 # View-----------------------------------------------------------------------------------------------------
@@ -186,6 +290,12 @@ class BotParamView(CVAdminModelView):
     def __init__(self, model, session):
         CVAdminModelView.__init__(self, model, session, '机器人参数', '机器人设置')
 
+    def after_model_change(self, form, model, is_created):
+        BotParam.param_cache.invalidate(model.botid)
+
+    def after_model_delete(self, model):
+        BotParam.param_cache.invalidate(model.botid)
+
     def get_query(self):
         return get_list_by_botassign(BotParam, BotParamView, self)
 
@@ -225,6 +335,13 @@ class TargetRuleView(CVAdminModelView):
     def __init__(self, model, session):
         CVAdminModelView.__init__(self, model, session, '目标规则设置', '机器人设置')
 
+    def after_model_change(self, form, model, is_created):
+        # 编辑时可能修改了规则所属的机器人，全部失效
+        TargetRule.index_cache.clear()
+
+    def after_model_delete(self, model):
+        TargetRule.index_cache.invalidate(model.botid)
+
     def get_query(self):
         return get_list_by_botassign(TargetRule, TargetRuleView, self)
 
@@ -398,16 +515,12 @@ class BotParamAPI(Resource):
 
 def get_targetrules(type):
     try:
-        rules = TargetRule.findall(ac.get_bot(), type)
-        result = []
-        for rule in rules:
-            result.append({'botid': rule.botid,
-                           'type': rule.type,
-                           'target': rule.target,
-                           'create_at': rule.create_at.strftime('%Y-%m-%d %H:%M'),
-                           'update_at': rule.update_at.strftime('%Y-%m-%d %H:%M'),
-                           'remark': rule.remark})
-        return ac.success(params = result)
+        index = TargetRule.get_index(ac.get_bot())
+        # 规则未变化时只返回304，调用方可以低成本地轮询
+        if request.if_none_match.contains(index.etag):
+            return Response(status = 304, headers = {'ETag': quote_etag(index.etag)})
+        (data, status) = ac.success(params = index.rules.get(type, []), version = index.version)
+        return data, status, {'ETag': quote_etag(index.etag)}
     except Exception as e:
         return ac.fault(error = e)
 
@@ -474,6 +587,26 @@ class AllowsAPI(Resource):
         return get_targetrules('allow')
 
 
+@ac.register_api('/target_check', endpoint = 'targetcheck')
+class TargetCheckAPI(Resource):
+    method_decorators = [ac.require_apikey]
+
+    def post(self):
+        try:
+            parser = reqparse.RequestParser()
+            parser.add_argument('targets', type = list, location = 'json', required = True,
+                                help = '请求中必须包含targets')
+            args = parser.parse_args()
+            index = TargetRule.get_index(ac.get_bot())
+            results = []
+            for target in args['targets']:
+                (allow, block) = index.check(target)
+                results.append({'target': target, 'allow': allow, 'block': block})
+            return ac.success(version = index.version, results = results)
+        except Exception as e:
+            return ac.fault(error = e)
+
+
 @ac.register_api('/allow_group', endpoint = 'allowgroup')
 class AllowGroupAPI(Resource):
     method_decorators = [ac.require_apikey]
@@ -6,6 +6,7 @@ from sqlalchemy import func
 import api_control as ac
 import db_control
 from app_view import CVAdminModelView
+from common.dashboard_stream import delta_hub
 from common.util import get_now, get_botname, get_target_composevalue, get_target_display, output_datetime,\
     display_datetime,\
     get_list_by_botassign, get_list_count_by_botassign, get_CQ_display
@@ -23,6 +24,7 @@ db = db_control.get_db()
 class Sign(db.Model):
     __bind_key__ = 'score'
     __tablename__ = 'sign'
+    __table_args__ = (db.Index('ix_sign_botid_target_member_date', 'botid', 'target', 'member_id', 'date'),)
 
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
     botid = db.Column(db.String(20), nullable = False)
@@ -59,9 +61,10 @@ class Sign(db.Model):
                       message = message)
         record.query.session.add(record)
         record.query.session.commit()
-        sign_code = BotParam.find(botid, 'sign_code')
+        delta_hub.publish(botid, target, get_now().date(), sign = 1)
+        sign_code = BotParam.get_value(botid, 'sign_code')
         if sign_code is not None:
-            ScoreRecord.create_change(sign_code.value, member_id,
+            ScoreRecord.create_change(sign_code, member_id,
                                       member_name = kwargs.get('member_name'), botid = botid)
 
         return record
@@ -101,6 +104,26 @@ class Sign(db.Model):
             Sign.member_id == member_id if member_id is not None else 1 == 1
         ).first()
 
+    @staticmethod
+    def get_count_by_targets(targets, date_from, date_to):
+        '''
+        按目标分组统计签到数，查询次数与目标数无关
+        :param targets: (机器人ID, 目标)的列表
+        :return: (机器人ID, 目标) -> 签到数
+        '''
+        targets = set(targets)
+        if len(targets) == 0:
+            return {}
+        records = Sign.query.session.query(
+            Sign.botid, Sign.target, func.count().label('cnt')
+        ).filter(
+            Sign.botid.in_({botid for (botid, target) in targets}),
+            Sign.target.in_({target for (botid, target) in targets}),
+            Sign.date >= date_from,
+            Sign.date <= date_to
+        ).group_by(Sign.botid, Sign.target).all()
+        return {(r.botid, r.target): r.cnt for r in records if (r.botid, r.target) in targets}
+
 # View-----------------------------------------------------------------------------------------------------
 @pr.register_view()
 class SignView(CVAdminModelView):
@@ -1,28 +1,48 @@
 import re
+import sqlite3
+from collections import OrderedDict, deque, namedtuple
 from datetime import datetime, timedelta
 
 import math
-from flask import request, redirect, json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import zlib
+from flask import request, redirect, json, flash
 from flask_admin import expose
 from flask_admin.form import rules, FormOpts, Select2Widget, DatePickerWidget
 from flask_admin.helpers import get_redirect_target, validate_form_on_submit
 from flask_restful import reqparse, Resource
-from sqlalchemy import func, desc, case, UniqueConstraint, bindparam
+from sqlalchemy import func, desc, case, UniqueConstraint, bindparam, and_, or_, select, text
 from sqlalchemy.orm import sessionmaker
 from wtforms import validators, fields, HiddenField
 
 import api_control as ac
 import db_control
 from app_view import CVAdminModelView
-from common.basedata import Basedata
-from common.bot import bot_registry
+from common.basedata import Basedata, basedata_registry
+from common.bot import Bot, bot_registry
+from common.cache import Cache
+from common.dashboard_stream import delta_hub
+from common.textmatch import AhoCorasick, required_literals
+from common.topk import TopK
 from common.util import get_now, display_datetime, get_botname, get_target_composevalue, get_target_display,\
     get_list_by_botassign, get_list_count_by_botassign, target_prefix2name, output_datetime, get_CQ_display
+from common.writebehind import WriteBehindBuffer, BufferFullError
+from env import get_config as config, get_spool_dir, get_tmp_dir
 from plugin import PluginsRegistry
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 __registry__ = pr = PluginsRegistry()
 
 br = bot_registry()
+bdr = basedata_registry()
 
 # Model----------------------------------------------------------------------------------------------------
 db = db_control.get_db()
@@ -32,6 +52,9 @@ db = db_control.get_db()
 class Speak(db.Model):
     __bind_key__ = 'score'
     __tablename__ = 'speak'
+    __table_args__ = (db.Index('ix_speak_botid_wash_version', 'botid', 'wash_version'),
+                      # 覆盖get_top、get_count，查询不需要回表
+                      db.Index('ix_speak_botid_target_date', 'botid', 'target', 'date', 'sender_id', 'washed_chars'))
 
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
     botid = db.Column(db.String(20), nullable = False)
@@ -45,11 +68,15 @@ class Speak(db.Model):
     message = db.Column(db.String(20), nullable = False)
     washed_text = db.Column(db.String(20), nullable = False)
     washed_chars = db.Column(db.Integer, nullable = False)
+    # 清洗时所用规则集的版本，与当前规则集版本不一致的记录由后台重新清洗
+    wash_version = db.Column(db.Integer, nullable = True)
 
     @staticmethod
     def create(botid, target_type, target_account, sender_id, message, **kwargs):
         target = get_target_composevalue(target_type, target_account)
-        washed_text = SpeakWash.do(botid, message)
+        rules = SpeakWash.get_rules(botid)
+        washed_text = rules.wash(message)
+        now = get_now()
         record = Speak(botid = botid,
                        target = target,
                        sender_id = sender_id,
@@ -60,51 +87,340 @@ class Speak(db.Model):
                        #     'time') is None else kwargs.get('time'),
                        # create_at = int(datetime.now(tz = utc).timestamp()) if kwargs.get(
                        #     'create_at') is None else kwargs.get('create_at'),
+                       date = now.date(),
+                       time = now.time(),
+                       create_at = now,
+                       update_at = now,
                        message = message,
                        washed_text = washed_text,
-                       washed_chars = len(washed_text))
+                       washed_chars = len(washed_text),
+                       wash_version = rules.version)
         record.query.session.add(record)
-        record.query.session.commit()
+        # 发言统计与发言记录在同一个事务中更新
+        counts = SpeakCount.increment(record.query.session.connection(bind = db.get_engine(bind = 'score')),
+                                      [{'botid': record.botid,
+                                        'target': record.target,
+                                        'sender_id': record.sender_id,
+                                        'sender_name': record.sender_name,
+                                        'date': record.date,
+                                        'washed_chars': record.washed_chars}])
+        with live_top.ingest:
+            record.query.session.commit()
+            live_top.add(counts)
+        delta_hub.publish(botid, target, now.date(), speak = 1)
         return record
 
+    @staticmethod
+    def create_batch(botid, records):
+        '''
+        批量创建发言记录，清洗规则只加载一次，全部记录在同一个事务中写入
+        :param botid: 机器人ID
+        :param records: 发言记录列表，每条记录须包含target_type、target_account、sender_id、message，可包含sender_name
+        :return: 与records顺序一致的结果列表，成功的记录为写入的数据行，失败的记录为异常对象
+        '''
+        rules = SpeakWash.get_rules(botid)
+        now = get_now()
+        results = []
+        rows = []
+        for record in records:
+            try:
+                row = Speak.make_row(botid, rules, now, record)
+                rows.append(row)
+                results.append(row)
+            except Exception as e:
+                results.append(e)
+        Speak.insert_rows(rows)
+        return results
+
+    @staticmethod
+    def make_row(botid, rules, now, record):
+        '''
+        根据请求数据生成待写入的发言数据行
+        :param botid: 机器人ID
+        :param rules: SpeakWash.get_rules返回的清洗规则
+        :param now: 记录时间
+        :param record: 发言记录
+        :return: 数据行
+        '''
+        if not isinstance(record, dict):
+            raise Exception('发言记录必须是JSON对象')
+        for name in ('target_type', 'target_account', 'sender_id', 'message'):
+            if record.get(name) is None:
+                raise Exception('请求中必须包含' + name)
+        washed_text = rules.wash(record['message'])
+        return {'botid': botid,
+                'target': get_target_composevalue(record['target_type'], record['target_account']),
+                'sender_id': record['sender_id'],
+                'sender_name': '' if record.get('sender_name') is None else record.get('sender_name'),
+                'date': now.date(),
+                'time': now.time(),
+                'create_at': now,
+                'update_at': now,
+                'message': record['message'],
+                'washed_text': washed_text,
+                'washed_chars': len(washed_text),
+                'wash_version': rules.version}
+
+    @staticmethod
+    def insert_rows(rows):
+        '''
+        在一个事务中批量写入发言数据行
+        :param rows: 数据行列表
+        :return: 写入的行数
+        '''
+        if len(rows) == 0:
+            return 0
+        with live_top.ingest:
+            with db.get_engine(bind = 'score').begin() as conn:
+                conn.execute(Speak.__table__.insert(), rows)
+                live_counts = SpeakCount.increment(conn, rows)
+            live_top.add(live_counts)
+        counts = {}
+        for row in rows:
+            key = (row['botid'], row['target'], row['date'])
+            counts[key] = counts.get(key, 0) + 1
+        for ((botid, target, date), count) in counts.items():
+            delta_hub.publish(botid, target, date, speak = count)
+        return len(rows)
+
+    @staticmethod
+    def dump_row(row):
+        '''
+        发言数据行序列化为一行JSON文本，用于写后缓冲的spool文件
+        '''
+        data = dict(row)
+        data['date'] = row['date'].strftime('%Y-%m-%d')
+        data['time'] = row['time'].strftime('%H:%M:%S.%f')
+        data['create_at'] = row['create_at'].strftime('%Y-%m-%d %H:%M:%S.%f')
+        data['update_at'] = row['update_at'].strftime('%Y-%m-%d %H:%M:%S.%f')
+        return json.dumps(data, ensure_ascii = False)
+
+    @staticmethod
+    def load_row(line):
+        '''
+        从spool文件的一行JSON文本还原发言数据行
+        '''
+        row = json.loads(line)
+        row['date'] = datetime.strptime(row['date'], '%Y-%m-%d').date()
+        row['time'] = datetime.strptime(row['time'], '%H:%M:%S.%f').time()
+        row['create_at'] = datetime.strptime(row['create_at'], '%Y-%m-%d %H:%M:%S.%f')
+        row['update_at'] = datetime.strptime(row['update_at'], '%Y-%m-%d %H:%M:%S.%f')
+        return row
+
     @staticmethod
     def dowash(id):
         record = Speak.find_by_id(id)
         if record is not None:
-            record.washed_text = SpeakWash.do(record.botid, record.message)
-            record.washed_chars = len(record.washed_text)
-            record.query.session.commit()
+            rules = SpeakWash.get_rules(record.botid)
+            washed_text = rules.wash(record.message)
+            # 与批量重新清洗一样由write_wash写入，有效发言排行使用的发言统计同时调整
+            Speak.write_wash(db.get_engine(bind = 'score'),
+                             [{'b_id': record.id, 'washed_text': washed_text, 'washed_chars': len(washed_text),
+                               'wash_version': rules.version}])
+            record.query.session.refresh(record)
         return record
 
     @staticmethod
-    def updatewash(botid, target_type, target_account, date_from, date_to):
-        start = get_now()
-        records = Speak.find_by_date(botid, target_type, target_account, date_from, date_to)
-        # texts = {record.id: record.message for record in records}
-        count = len(records)
-        texts = {str(record.id) + '>>>END>>>' + record.message for record in records}
-        text = '<<<BEGIN<<<'.join(texts)
-        ws = SpeakWash.do(botid, text)
-
-        data = []
-        wl = ws.split('<<<BEGIN<<<')
-        for ts in wl:
-            tl = ts.split('>>>END>>>')
-            data.append({'b_id': tl[0], 'washed_text': tl[1], 'washed_chars': len(tl[1])})
-
-        speaktable = Speak.metadata.tables['speak']
+    def updatewash(botid, target_type, target_account, date_from, date_to, chunk_size = 2000, workers = None):
+        '''
+        重新清洗指定范围内的发言记录，按id顺序分块读取，每块清洗后单独批量更新，内存占用与数据量无关
+        :param botid: 机器人ID
+        :param target_type: 目标类型
+        :param target_account: 目标账号
+        :param date_from: 开始日期
+        :param date_to: 结束日期
+        :param chunk_size: 每块的记录数
+        :param workers: 并行清洗的进程数，为空时使用limit_rewash_workers的结果，小于2时在当前进程中清洗
+        :return: (处理的记录数, 耗时秒数)
+        '''
+        if workers is None:
+            workers = Speak.limit_rewash_workers()
+        target = get_target_composevalue(target_type, target_account)
+        rules = SpeakWash.get_rules(botid)
+        speaktable = Speak.__table__
+        engine = db.get_engine(bind = 'score')
+
+        params = {'botid': botid, 'target': target, 'date_from': str(date_from), 'date_to': str(date_to)}
+        (total, min_id, max_id) = engine.execute(
+            select([func.count(1), func.min(speaktable.c.id), func.max(speaktable.c.id)]).
+            where(and_(speaktable.c.botid == botid,
+                       speaktable.c.target == target,
+                       speaktable.c.date >= date_from,
+                       speaktable.c.date <= date_to))).first()
+        progress = WashProgress(botid, target, total, workers if workers > 1 else 1)
+        wash_progress[(botid, target)] = progress
+
+        def write(result):
+            (count, data, wash_seconds) = result
+            start = time.perf_counter()
+            Speak.write_wash(engine, data)
+            progress.advance(count, wash_seconds + time.perf_counter() - start)
+
+        shards = Speak._iter_shards(engine, params, min_id, max_id, chunk_size, progress) if total > 0 else []
+        if workers > 1:
+            # 清洗在进程池中并行执行，更新仍由当前进程逐块写入，避免多个写入者争用SQLite的写锁
+            pool = multiprocessing.Pool(workers, _init_wash_worker, (botid, rules.definition))
+            try:
+                pending = deque()
+                for shard in shards:
+                    pending.append(pool.apply_async(_wash_shard, (shard,)))
+                    if len(pending) >= workers * 2:
+                        write(pending.popleft().get())
+                while pending:
+                    write(pending.popleft().get())
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for shard in shards:
+                write(_wash_records(rules, shard))
+
+        progress.finish()
+        return progress.done, round(progress.elapsed(), 1)
+
+    @staticmethod
+    def limit_rewash_workers(workers = None):
+        '''
+        限制API调用方或管理界面请求的并行清洗进程数
+        :param workers: 请求的进程数，为空时使用配置
+        :return: 不超过配置及CPU核数的进程数
+        '''
+        max_workers = min(config().get('rewash', {}).get('workers', 0), os.cpu_count() or 1)
+        return max_workers if workers is None else min(workers, max_workers)
 
+    @staticmethod
+    def write_wash(engine, data, retries = 3):
+        '''
+        在一个事务中写入重新清洗的结果，并按有效字数的变化调整发言统计及累计发言统计，
+        提交后更新今日排行榜并使各进程中该目标的统计数据缓存失效
+        :param engine: score库的engine
+        :param data: _wash_records返回的需要更新的数据
+        :param retries: 读取清洗前的有效字数后记录被其他清洗修改时的重试次数
+        :return: 有效发言数变化的(机器人ID, 目标)集合
+        '''
+        if len(data) == 0:
+            return set()
+        speaktable = Speak.__table__
         upt = speaktable.update().\
-            where(speaktable.c.id == bindparam('b_id')).\
-            values(washed_text = bindparam('washed_text'), washed_chars = bindparam('washed_chars'))
+            where(and_(speaktable.c.id == bindparam('b_id'),
+                       # 只更新有效字数仍是读取时的值的记录，发言统计按读取时的值调整
+                       speaktable.c.washed_chars.is_(bindparam('b_washed_chars')))).\
+            values(washed_text = bindparam('washed_text'),
+                   washed_chars = bindparam('washed_chars'),
+                   wash_version = bindparam('wash_version'))
+        query = select([speaktable.c.id, speaktable.c.botid, speaktable.c.target, speaktable.c.sender_id,
+                        speaktable.c.date, speaktable.c.washed_chars])
+        for attempt in range(retries):
+            ids = [d['b_id'] for d in data]
+            old = {}
+            # 分段查询，避免超出SQLite的参数个数上限
+            for i in range(0, len(ids), 500):
+                old.update((r.id, r) for r in engine.execute(query.where(speaktable.c.id.in_(ids[i:i + 500]))))
+            rows = []
+            for d in data:
+                record = old.get(d['b_id'])
+                if record is not None:
+                    rows.append(dict(d, b_washed_chars = record.washed_chars, botid = record.botid,
+                                     target = record.target, sender_id = record.sender_id, date = record.date))
+            if len(rows) == 0:
+                return set()
+            with engine.connect() as conn:
+                trans = conn.begin()
+                try:
+                    if conn.execute(upt, rows).rowcount == len(rows):
+                        changes = SpeakCount.adjust_valid(conn, rows)
+                        trans.commit()
+                        break
+                    # 读取之后有记录被其他清洗修改，回滚后重新读取
+                    trans.rollback()
+                except Exception:
+                    trans.rollback()
+                    raise
+        else:
+            raise Exception('重新清洗的发言记录被同时修改，请稍后重试')
 
-        conn = db.get_engine(bind = 'score').connect()
-        conn.execute(upt, data)
-        conn.close()
+        for (botid, target, date) in changes:
+            if live_top.covers(date, date):
+                # 有效发言数可能减少，今日排行榜不能按增量更新
+                live_top.rebuild_target(botid, target)
+        targets = {(botid, target) for (botid, target, date) in changes}
+        for (botid, target) in targets:
+            delta_hub.touch(botid, target)
+        return targets
 
-        duration = round((get_now() - start).total_seconds(), 1)
+    @staticmethod
+    def count_stale(botid, version):
+        '''
+        统计清洗规则版本不是当前版本的发言记录数
+        :param botid: 机器人ID
+        :param version: 当前清洗规则集版本
+        :return: (待重新清洗的记录数, 记录总数)
+        '''
+        speaktable = Speak.__table__
+        # 两次计数都只扫描(botid, wash_version)索引
+        total = db.get_engine(bind = 'score').execute(
+            select([func.count(1)]).where(speaktable.c.botid == botid)).scalar()
+        current = db.get_engine(bind = 'score').execute(
+            select([func.count(1)]).where(and_(speaktable.c.botid == botid,
+                                               speaktable.c.wash_version == version))).scalar()
+        return total - current, total
+
+    @staticmethod
+    def has_stale(botid, version):
+        '''
+        是否有清洗规则版本不是当前版本的发言记录
+        :param botid: 机器人ID
+        :param version: 当前清洗规则集版本
+        '''
+        # 拆分为三个范围，每个范围只在(botid, wash_version)索引上定位一次
+        return db.get_engine(bind = 'score').execute(
+            text('SELECT EXISTS(SELECT 1 FROM speak WHERE botid = :botid AND wash_version IS NULL LIMIT 1) OR '
+                 'EXISTS(SELECT 1 FROM speak WHERE botid = :botid AND wash_version < :version LIMIT 1) OR '
+                 'EXISTS(SELECT 1 FROM speak WHERE botid = :botid AND wash_version > :version LIMIT 1)'),
+            {'botid': botid, 'version': version}).scalar() == 1
+
+    @staticmethod
+    def find_stale(botid, version, limit, before_id = None):
+        '''
+        按时间倒序查找清洗规则版本不是当前版本的发言记录
+        :param botid: 机器人ID
+        :param version: 当前清洗规则集版本
+        :param limit: 最大记录数
+        :param before_id: 只查找id小于该值的记录，传入上一批最后一条记录的id逐批向前读取
+        :return: (id, message, washed_text, wash_version)列表
+        '''
+        # +botid使SQLite不按botid索引读取后排序，而是从before_id开始沿主键倒序读取，每批只读取到凑满limit条为止
+        records = db.get_engine(bind = 'score').execute(
+            text('SELECT id,message,washed_text,wash_version FROM speak '
+                 'WHERE +botid = :botid AND (wash_version IS NULL OR wash_version != :version) %s'
+                 'ORDER BY id DESC LIMIT :limit' % ('AND id < :before_id ' if before_id is not None else '')),
+            {'botid': botid, 'version': version, 'before_id': before_id, 'limit': limit}).fetchall()
+        return [tuple(record) for record in records]
 
-        return count, duration
+    @staticmethod
+    def _iter_shards(engine, params, min_id, max_id, chunk_size, progress):
+        '''
+        按id顺序分块读取范围内的发言记录
+        :param params: 包含botid、target、date_from、date_to
+        :param min_id: 范围内记录的最小id
+        :param max_id: 范围内记录的最大id
+        :return: 每块的(id, message, washed_text, wash_version)列表
+        '''
+        # +botid等使SQLite不按索引读取后排序，而是从上一块最后一条记录开始沿主键读取，每块只读取到凑满chunk_size条为止
+        query = text('SELECT id,message,washed_text,wash_version FROM speak '
+                     'WHERE id > :last_id AND id <= :max_id AND +botid = :botid AND +target = :target '
+                     'AND +date >= :date_from AND +date <= :date_to ORDER BY id LIMIT :limit')
+        last_id = min_id - 1
+        while True:
+            # 以id作为游标分块读取，读取和更新不会长时间占用同一个事务
+            start = time.perf_counter()
+            records = engine.execute(query, dict(params, last_id = last_id, max_id = max_id,
+                                                 limit = chunk_size)).fetchall()
+            progress.advance(0, time.perf_counter() - start)
+            if len(records) == 0:
+                return
+            last_id = records[-1].id
+            yield [tuple(record) for record in records]
 
     @staticmethod
     def find_by_date(botid, target_type, target_account, date_from, date_to):
@@ -128,36 +444,48 @@ class Speak(db.Model):
 
     @staticmethod
     def get_top(botid, target_type, target_account, date_from, date_to, limit = 10, is_valid = False):
+        '''
+        发言排行榜，由发言统计查询，不扫描发言记录：
+        今天的排行榜由进程内的今日排行榜返回，不访问数据库；
+        日期范围覆盖该目标全部统计日期时查询累计发言统计，否则按日期范围汇总每日发言统计；
+        发言统计尚未补齐历史数据时由发言记录统计；各重新清洗途径均经write_wash在同一事务中调整有效发言数
+        :param is_valid: 是否按有效发言数排行
+        :return: 包含sender_id、sender_name、cnt的记录列表
+        '''
         target = get_target_composevalue(target_type, target_account)
-        baseline = 0
-        if is_valid:
-            from plugins.setting import BotParam
-            param = BotParam.find(botid, 'speak_valid_baseline')
-            if param is not None:
-                baseline = param.value
+        if not db_control.is_data_migrated('speak_count_backfill'):
+            return Speak.get_top_by_records(botid, target, date_from, date_to, limit, is_valid)
+        if str(date_from) == str(date_to):
+            records = live_top.get_top(botid, target, date_from, limit, is_valid)
+            if records is not None:
+                return records
+        (first_date, last_date) = SpeakCount.get_date_range(botid, target)
+        if first_date is None:
+            return []
+        if str(date_from) <= first_date and str(date_to) >= last_date:
+            return SpeakTotal.get_top(botid, target, limit, is_valid)
+        return SpeakCount.get_top(botid, target, date_from, date_to, limit, is_valid)
 
-        return Speak.query.session.query(
-            Speak.sender_id, Speak.sender_name, func.count(1).label('cnt')
-        ).filter(
-            Speak.botid == botid,
-            Speak.target == target,
-            Speak.date >= date_from,
-            Speak.date <= date_to,
-            Speak.washed_chars >= baseline
-        ).group_by(
-            Speak.sender_id,
-        ).order_by(
-            desc('cnt')
-        ).limit(limit)
+    @staticmethod
+    def get_top_by_records(botid, target, date_from, date_to, limit = 10, is_valid = False):
+        '''
+        由发言记录统计发言排行榜，有效发言的口径与发言统计一致
+        '''
+        with db.get_engine(bind = 'score').connect() as conn:
+            baseline = SpeakCount.get_valid_baseline(conn, botid) if is_valid else None
+            return conn.execute(
+                text('SELECT sender_id,sender_name,MAX(date) last_date,COUNT(1) cnt FROM speak '
+                     'WHERE botid = :botid AND target = :target AND date >= :date_from AND date <= :date_to %s'
+                     'GROUP BY sender_id ORDER BY cnt DESC LIMIT :limit' %
+                     ('AND washed_chars >= :baseline ' if baseline is not None else '')),
+                {'botid': botid, 'target': target, 'date_from': str(date_from), 'date_to': str(date_to),
+                 'baseline': baseline, 'limit': limit}).fetchall()
 
     @staticmethod
     def get_count(botid, target_type, target_account, date_from, date_to, sender = None):
         target = get_target_composevalue(target_type, target_account)
-        baseline = 0
         from plugins.setting import BotParam
-        param = BotParam.find(botid, 'speak_valid_baseline')
-        if param is not None:
-            baseline = int(param.value)
+        baseline = BotParam.get_value(botid, 'speak_valid_baseline', 0)
 
         if sender is None:
             sender_id = None
@@ -181,11 +509,8 @@ class Speak(db.Model):
     @staticmethod
     def get_count(botid, target_type, target_account, date_from, date_to, sender = None):
         target = get_target_composevalue(target_type, target_account)
-        baseline = 0
         from plugins.setting import BotParam
-        param = BotParam.find(botid, 'speak_valid_baseline')
-        if param is not None:
-            baseline = int(param.value)
+        baseline = BotParam.get_value(botid, 'speak_valid_baseline', 0)
 
         if sender is None:
             sender_id = None
@@ -206,6 +531,143 @@ class Speak(db.Model):
             Speak.sender_id == sender_id if sender_id is not None else 1 == 1
         ).first()
 
+    @staticmethod
+    def get_count_by_targets(targets, date_from, date_to):
+        '''
+        按目标分组统计发言数，查询次数与目标数无关
+        :param targets: (机器人ID, 目标)的列表
+        :return: (机器人ID, 目标) -> 发言数
+        '''
+        targets = set(targets)
+        if len(targets) == 0:
+            return {}
+        records = Speak.query.session.query(
+            Speak.botid, Speak.target, func.count().label('cnt_full')
+        ).filter(
+            Speak.botid.in_({botid for (botid, target) in targets}),
+            Speak.target.in_({target for (botid, target) in targets}),
+            Speak.date >= date_from,
+            Speak.date <= date_to
+        ).group_by(Speak.botid, Speak.target).all()
+        return {(r.botid, r.target): r.cnt_full for r in records if (r.botid, r.target) in targets}
+
+
+class WashProgress:
+    '''
+    重新清洗的进度
+    '''
+
+    def __init__(self, botid, target, total, workers = 1):
+        self.botid = botid
+        self.target = target
+        self.total = total
+        self.workers = workers
+        self.done = 0
+        self.finished = False
+        self.start_at = get_now()
+        # 读取、清洗、写入各步骤耗时之和，即在当前进程中逐块执行所需的时间
+        self.serial_seconds = 0.0
+        self._start = time.perf_counter()
+        self._end = None
+
+    def advance(self, count, seconds = 0.0):
+        self.done += count
+        self.serial_seconds += seconds
+
+    def finish(self):
+        self.finished = True
+        self._end = time.perf_counter()
+
+    def elapsed(self):
+        return (self._end if self._end is not None else time.perf_counter()) - self._start
+
+    def to_dict(self):
+        elapsed = self.elapsed()
+        return {'botid': self.botid,
+                'target': self.target,
+                'total': self.total,
+                'done': self.done,
+                'finished': self.finished,
+                'start_at': output_datetime(self.start_at),
+                'duration': round(elapsed, 1),
+                'rows_per_sec': round(self.done / elapsed, 1) if elapsed > 0 else 0,
+                'workers': self.workers,
+                'speedup': round(self.serial_seconds / elapsed, 2) if elapsed > 0 else 0}
+
+
+# 各目标最近一次重新清洗的进度
+wash_progress = {}
+
+
+def _wash_records(rules, records):
+    '''
+    清洗一块发言记录
+    :param rules: WashRuleSet
+    :param records: (id, message, washed_text, wash_version)列表
+    :return: (记录数, 需要更新的数据, 清洗耗时秒数)
+    '''
+    start = time.perf_counter()
+    data = []
+    for (id, message, washed_text, wash_version) in records:
+        washed = rules.wash(message)
+        if washed != washed_text or wash_version != rules.version:
+            data.append({'b_id': id, 'washed_text': washed, 'washed_chars': len(washed),
+                         'wash_version': rules.version})
+    return len(records), data, time.perf_counter() - start
+
+
+# 进程池中每个清洗进程持有的已编译规则集
+_worker_rules = None
+
+
+def _init_wash_worker(botid, definition):
+    global _worker_rules
+    _worker_rules = WashRuleSet(botid, definition)
+
+
+def _wash_shard(records):
+    return _wash_records(_worker_rules, records)
+
+
+class WashRuleSet:
+    '''
+    机器人已编译的清洗规则集
+    '''
+
+    def __init__(self, botid, rules):
+        '''
+        :param botid: 机器人ID
+        :param rules: 按执行顺序排列的(规则代码, 匹配规则, 清洗余量)列表
+        '''
+        self.botid = botid
+        self.definition = list(rules)
+        self.codes = set(r[0] for r in rules)
+        # 版本号由规则内容计算得出，规则内容不变时跨进程、跨重启保持一致
+        self.version = zlib.crc32(json.dumps(rules).encode('utf-8'))
+
+        # 预过滤：提取每条规则的必需字面量，文本中不含任何一个必需字面量的规则无需执行
+        literals = {}
+        self.rules = []
+        for (code, rule, surplus) in rules:
+            required = required_literals(r'' + rule)
+            if required is not None:
+                required = frozenset(literals.setdefault(literal, len(literals)) for literal in required)
+            self.rules.append((re.compile(r'' + rule), r'' + ''.join('_' * surplus), required))
+        self.matcher = AhoCorasick(sorted(literals, key = literals.get)) if len(literals) > 0 else None
+
+    def wash(self, text):
+        found = self.matcher.find(text) if self.matcher is not None else None
+        for (p, replace, required) in self.rules:
+            if required is not None and required.isdisjoint(found):
+                continue
+            washed = p.sub(replace, text)
+            if washed != text:
+                text = washed
+                # 替换可能产生新的字面量，重新扫描以保证结果与逐条执行全部规则一致
+                if self.matcher is not None:
+                    found = self.matcher.find(text)
+        return text
+
 
 @pr.register_model(73)
 class SpeakWash(db.Model):
@@ -222,6 +684,8 @@ class SpeakWash(db.Model):
     update_at = db.Column(db.DateTime, nullable = False, default = lambda: get_now(), onupdate = lambda: get_now())
     remark = db.Column(db.String(255), nullable = True)
 
+    rule_cache = Cache('wash_rule', ttl = config().get('cache_ttl', {}).get('wash_rule'))
+
     @staticmethod
     def create(botid, rule, surplus, remark):
         wash = SpeakWash.find(botid, rule)
@@ -233,6 +697,7 @@ class SpeakWash(db.Model):
                              remark = remark)
             wash.query.session.add(wash)
             wash.query.session.commit()
+            SpeakWash.rule_cache.invalidate(botid)
         else:
             wash = SpeakWash.update(botid, rule, surplus = surplus, remark = remark)
         return wash
@@ -245,6 +710,7 @@ class SpeakWash(db.Model):
             if kwargs.get('status'): wash.status = kwargs.get('status')
             if kwargs.get('remark'): wash.remark = kwargs.get('remark')
             wash.query.session.commit()
+            SpeakWash.rule_cache.invalidate(botid)
         return wash
 
     @staticmethod
@@ -259,26 +725,55 @@ class SpeakWash(db.Model):
     def delete(botid, rule):
         SpeakWash.query.filter_by(botid = botid, rule = rule).delete()
         SpeakWash.query.session.commit()
+        SpeakWash.rule_cache.invalidate(botid)
         return True
 
+    @staticmethod
+    def load_rules(botid):
+        '''
+        从数据库加载机器人的清洗规则并编译
+        :param botid: 机器人ID
+        :return: WashRuleSet
+        '''
+        washlist = SpeakWash.query.filter_by(botid = botid, status = 1).order_by(SpeakWash.id).all()
+        basedata = {}
+        if len(washlist) > 0:
+            basedata = {r.code: r.value for r in
+                        Basedata.query.filter(Basedata.code.in_(set(w.rule for w in washlist))).all()}
+        return WashRuleSet(botid,
+                           [(w.rule, basedata[w.rule], w.surplus) for w in washlist if w.rule in basedata])
+
+    @staticmethod
+    def get_rules(botid):
+        '''
+        获取机器人的清洗规则，规则变化前不再访问数据库
+        :param botid: 机器人ID
+        :return: WashRuleSet
+        '''
+        return SpeakWash.rule_cache.get(botid, SpeakWash.load_rules)
+
     @staticmethod
     def do(botid, text):
-        washlist = SpeakWash.findall(botid)
-        for wash in washlist:
-            basedata = Basedata.find_by_code(wash.rule)
-            rule = basedata.value
-            replace = ''.join('_' * wash.surplus)
-            p = re.compile(r'' + rule)
-            text = p.sub(r'' + replace, text)
-        return text
+        return SpeakWash.get_rules(botid).wash(text)
 
     @staticmethod
     @br.register_destroy()
     def destroy(botid):
         for r in SpeakWash.findall(botid):
             SpeakWash.delete(botid, r.rule)
+        SpeakWash.rule_cache.invalidate(botid)
         return True
 
+    @staticmethod
+    @bdr.register_change()
+    def on_basedata_change(basedata):
+        '''
+        清洗规则引用的基础数据变化后，使缓存的规则集失效
+        :param basedata: 变化的基础数据
+        '''
+        if basedata.type == 2 or any(basedata.code in rules.codes for rules in SpeakWash.rule_cache.values()):
+            SpeakWash.rule_cache.clear()
+
 
 # todo 实现计划调度自动计算speak count
 @pr.register_model(40)
@@ -295,13 +790,167 @@ class SpeakCount(db.Model):
     message_count = db.Column(db.Integer, nullable = False)
     vaild_count = db.Column(db.Integer, nullable = False)
 
-    __table_args__ = (UniqueConstraint('botid', 'target', 'sender_id', 'date', name = 'speak_daily_count_uc'),)
+    __table_args__ = (UniqueConstraint('botid', 'target', 'sender_id', 'date', name = 'speak_daily_count_uc'),
+                      # 按日期范围统计及排行时覆盖查询
+                      db.Index('ix_speak_count_botid_target_date',
+                               'botid', 'target', 'date', 'sender_id', 'message_count', 'vaild_count'),
+                      # 重建今日排行榜时读取全部目标当天的统计
+                      db.Index('ix_speak_count_date', 'date'))
+
+    # SQLite 3.24开始支持UPSERT，更早的版本先UPDATE，未更新到数据时再INSERT
+    UPSERT_SUPPORTED = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+    @staticmethod
+    def increment(conn, rows):
+        '''
+        按新写入的发言数据行累加发言统计，须与发言数据行在同一个事务中执行
+        :param conn: 写入发言数据行所用的连接
+        :param rows: 发言数据行列表，须包含botid、target、sender_id、sender_name、date、washed_chars
+        :return: 按(机器人, 目标, 发言人, 日期)累加的数据列表，事务提交后用于更新今日排行榜
+        '''
+        baselines = {}
+        counts = OrderedDict()
+        for row in rows:
+            botid = row['botid']
+            if botid not in baselines:
+                baselines[botid] = SpeakCount.get_valid_baseline(conn, botid)
+            date = row['date'].strftime('%Y-%m-%d')
+            key = (botid, row['target'], row['sender_id'], date)
+            count = counts.get(key)
+            if count is None:
+                count = counts[key] = {'botid': botid, 'target': row['target'], 'sender_id': row['sender_id'],
+                                       'date': date, 'message_count': 0, 'vaild_count': 0}
+            count['sender_name'] = row['sender_name']
+            count['message_count'] += 1
+            count['vaild_count'] += SpeakCount.is_valid(row['washed_chars'], baselines[botid])
+
+        if len(counts) == 0:
+            return []
+        SpeakCount.accumulate(conn, 'speak_count', ('botid', 'target', 'sender_id', 'date'), list(counts.values()))
+
+        totals = OrderedDict()
+        for count in counts.values():
+            key = (count['botid'], count['target'], count['sender_id'])
+            total = totals.get(key)
+            if total is None:
+                total = totals[key] = {'botid': count['botid'], 'target': count['target'],
+                                       'sender_id': count['sender_id'], 'message_count': 0, 'vaild_count': 0}
+            total['sender_name'] = count['sender_name']
+            total['message_count'] += count['message_count']
+            total['vaild_count'] += count['vaild_count']
+        SpeakCount.accumulate(conn, 'speak_total', ('botid', 'target', 'sender_id'), list(totals.values()))
+        return list(counts.values())
+
+    @staticmethod
+    def adjust_valid(conn, rows):
+        '''
+        按重新清洗前后的有效字数调整有效发言数，须与更新发言记录在同一个事务中执行
+        :param conn: 更新发言记录所用的连接
+        :param rows: 包含botid、target、sender_id、date、清洗前的有效字数b_washed_chars及清洗后的washed_chars
+        :return: 有效发言数变化的(机器人ID, 目标, 日期)集合
+        '''
+        baselines = {}
+        deltas = {}
+        for row in rows:
+            botid = row['botid']
+            if botid not in baselines:
+                baselines[botid] = SpeakCount.get_valid_baseline(conn, botid)
+            delta = SpeakCount.is_valid(row['washed_chars'], baselines[botid]) - \
+                SpeakCount.is_valid(row['b_washed_chars'], baselines[botid])
+            if delta != 0:
+                key = (botid, row['target'], row['sender_id'], str(row['date']))
+                deltas[key] = deltas.get(key, 0) + delta
+        changes = [{'botid': botid, 'target': target, 'sender_id': sender_id, 'date': date, 'delta': delta}
+                   for ((botid, target, sender_id, date), delta) in deltas.items() if delta != 0]
+        if len(changes) > 0:
+            # 尚未补齐历史数据的日期没有发言统计，不更新，补齐时由发言记录统计
+            conn.execute(text('UPDATE speak_count SET vaild_count = vaild_count + :delta '
+                              'WHERE botid = :botid AND target = :target AND sender_id = :sender_id AND date = :date'),
+                         changes)
+            conn.execute(text('UPDATE speak_total SET vaild_count = vaild_count + :delta '
+                              'WHERE botid = :botid AND target = :target AND sender_id = :sender_id'),
+                         changes)
+        return {(c['botid'], c['target'], c['date']) for c in changes}
+
+    @staticmethod
+    def is_valid(washed_chars, baseline):
+        '''
+        :return: 有效字数是否达到基线，与SpeakCount.do中的统计口径一致，为1或0
+        '''
+        return 1 if baseline is None or washed_chars is None or washed_chars >= baseline else 0
+
+    @staticmethod
+    def accumulate(conn, table, keys, counts):
+        '''
+        按唯一键累加message_count、vaild_count，不存在时插入，同时更新sender_name
+        :param conn: 连接
+        :param table: speak_count或speak_total
+        :param keys: 唯一键的字段
+        :param counts: 累加的数据，须包含唯一键字段及sender_name、message_count、vaild_count
+        '''
+        columns = keys + ('sender_name', 'message_count', 'vaild_count')
+        insert = 'INSERT INTO %s(%s) VALUES (%s)' % (table, ','.join(columns), ','.join(':' + c for c in columns))
+        if SpeakCount.UPSERT_SUPPORTED:
+            conn.execute(
+                text(insert + ' ON CONFLICT(%s) DO UPDATE SET '
+                              'sender_name = excluded.sender_name,'
+                              'message_count = message_count + excluded.message_count,'
+                              'vaild_count = vaild_count + excluded.vaild_count' % ','.join(keys)),
+                counts)
+        else:
+            update = text('UPDATE %s SET sender_name = :sender_name,'
+                          'message_count = message_count + :message_count,'
+                          'vaild_count = vaild_count + :vaild_count '
+                          'WHERE %s' % (table, ' AND '.join('%s = :%s' % (k, k) for k in keys)))
+            for count in counts:
+                if conn.execute(update, count).rowcount == 0:
+                    conn.execute(text(insert), count)
+
+    @staticmethod
+    @db_control.register_data_migration('speak_count_backfill', bind = 'score')
+    def backfill(conn):
+        '''
+        由发言记录重新生成全部日期的发言统计，并由发言统计重建累计发言统计
+        写入发言时累加发言统计之前，只有执行过重新计算的日期才有发言统计，升级后须补齐历史数据
+        :param conn: 连接
+        '''
+        conn.execute(text('DELETE FROM speak_count'))
+        # 按索引的顺序分组，不需要额外排序
+        conn.execute(text(
+            'INSERT INTO speak_count(botid,target,sender_id,sender_name,date,message_count,vaild_count) '
+            'SELECT t1.botid,t1.target,t1.sender_id,t1.sender_name,t1.date,'
+            'SUM(1) message_count,SUM(CASE WHEN t1.washed_chars < t2.value THEN 0 ELSE 1 END) vaild_count '
+            "FROM speak t1 LEFT JOIN bot_param t2 ON t1.botid=t2.botid AND t2.name='speak_valid_baseline' "
+            'GROUP BY t1.botid,t1.target,t1.date,t1.sender_id'))
+        SpeakTotal.rebuild(conn)
+
+    @staticmethod
+    def get_valid_baseline(conn, botid):
+        '''
+        读取有效发言的字数基线，与SpeakCount.do中的统计口径一致
+        :return: 基线字数，未设置时返回None
+        '''
+        value = conn.execute(text("SELECT value FROM bot_param WHERE botid = :botid AND name = 'speak_valid_baseline'"),
+                             {'botid': botid}).scalar()
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            # SQLite中数字总是小于文本，与统计SQL的比较结果一致
+            return float('inf')
 
     @staticmethod
     def do(botid, target_type, target_account, date_from, date_to):
+        '''
+        全量重新计算日期范围内的发言统计，发言统计在写入发言记录时已同步累加，
+        仅在有效发言基线变化后需要执行，重新清洗时已按有效字数的变化调整；累计发言统计按重新计算前后的差额调整
+        '''
         target = get_target_composevalue(target_type, target_account)
+        params = {'botid': botid, 'target': target, 'date_from': date_from, 'date_to': date_to}
         session = sessionmaker(bind = db.get_engine(bind = 'score'))()
         try:
+            before = SpeakCount.sum_by_sender(session, params)
             session.execute(
                 'DELETE FROM speak_count '
                 'WHERE botid = :botid AND target = :target AND date >= :date_from AND date <= :date_to ',
@@ -314,12 +963,35 @@ class SpeakCount(db.Model):
                 'WHERE t1.botid = :botid AND t1.target = :target AND t1.date >= :date_from AND t1.date <= :date_to '
                 'GROUP BY t1.botid,t1.target,t1.sender_id,t1.date',
                 {'botid': botid, 'target': target, 'date_from': date_from, 'date_to': date_to})
+            after = SpeakCount.sum_by_sender(session, params)
+            changes = []
+            for sender_id in set(before) | set(after):
+                (message_count, vaild_count, sender_name) = after.get(sender_id, (0, 0, None))
+                (old_message_count, old_vaild_count, old_sender_name) = before.get(sender_id, (0, 0, None))
+                if message_count != old_message_count or vaild_count != old_vaild_count:
+                    changes.append({'botid': botid, 'target': target, 'sender_id': sender_id,
+                                    'sender_name': sender_name or old_sender_name,
+                                    'message_count': message_count - old_message_count,
+                                    'vaild_count': vaild_count - old_vaild_count})
+            if len(changes) > 0:
+                connection = session.connection()
+                SpeakCount.accumulate(connection, 'speak_total', ('botid', 'target', 'sender_id'), changes)
+                connection.execute(text('DELETE FROM speak_total '
+                                        'WHERE botid = :botid AND target = :target AND message_count <= 0'),
+                                   params)
             session.commit()
         # except IntegrityError as e:
         #     raise Exception(date_from + '到' + date_to + '期间已执行过此任务，部分数据处理失败')
         except Exception as e:
             raise e
-
+        finally:
+            session.close()
+
+        if live_top.covers(date_from, date_to):
+            # 重新计算可能减少计数，今日排行榜不能按增量更新
+            live_top.rebuild_target(botid, target)
+        # 使各进程中该目标的统计数据缓存失效
+        delta_hub.touch(botid, target)
         return True
 
     @staticmethod
@@ -333,12 +1005,437 @@ class SpeakCount(db.Model):
                 'FROM speak_count t1 '
                 'WHERE t1.botid = :botid AND t1.target = :target AND t1.date >= :date_from AND t1.date <= :date_to '
                 'GROUP BY t1.botid,t1.target,t1.date',
-                {'botid': botid, 'target': target, 'date_from': date_from, 'date_to': date_to})
+                {'botid': botid, 'target': target, 'date_from': date_from, 'date_to': date_to}).fetchall()
         except Exception as e:
             raise e
+        finally:
+            # 连接池中的连接在多线程的工作进程间共享，读取结果后立即归还
+            session.close()
+
+    @staticmethod
+    def sum_by_sender(session, params):
+        '''
+        :param params: 包含botid、target、date_from、date_to
+        :return: sender_id -> (发言数, 有效发言数, 最近的发言人名称)
+        '''
+        records = session.execute(
+            'SELECT sender_id,sender_name,MAX(date),SUM(message_count),SUM(vaild_count) FROM speak_count '
+            'WHERE botid = :botid AND target = :target AND date >= :date_from AND date <= :date_to '
+            'GROUP BY sender_id', params).fetchall()
+        return {r[0]: (r[3], r[4], r[1]) for r in records}
 
+    @staticmethod
+    def get_date_range(botid, target):
+        '''
+        :return: 目标的第一个及最后一个统计日期，没有统计时为(None, None)
+        '''
+        # 分别查询MIN和MAX，各自只需在索引上定位一次
+        params = {'botid': botid, 'target': target}
+        with db.get_engine(bind = 'score').connect() as conn:
+            return tuple(conn.execute(
+                text('SELECT (SELECT MIN(date) FROM speak_count WHERE botid = :botid AND target = :target),'
+                     '(SELECT MAX(date) FROM speak_count WHERE botid = :botid AND target = :target)'),
+                params).first())
+
+    @staticmethod
+    def get_top(botid, target, date_from, date_to, limit = 10, is_valid = False):
+        '''
+        汇总日期范围内的每日发言统计得到排行榜，读取的行数只与日期范围内的发言人数及天数有关
+        '''
+        column = 'vaild_count' if is_valid else 'message_count'
+        # 只有一个MAX聚合时，sender_name取自日期最近的一行
+        with db.get_engine(bind = 'score').connect() as conn:
+            return conn.execute(
+                text('SELECT sender_id,sender_name,MAX(date) last_date,SUM(%s) cnt FROM speak_count '
+                     'WHERE botid = :botid AND target = :target AND date >= :date_from AND date <= :date_to '
+                     'GROUP BY sender_id HAVING cnt > 0 ORDER BY cnt DESC LIMIT :limit' % column),
+                {'botid': botid, 'target': target, 'date_from': str(date_from), 'date_to': str(date_to),
+                 'limit': limit}).fetchall()
+
+
+class SpeakTotal(db.Model):
+    '''
+    每个发言人的累计发言统计，与speak_count同步累加，用于查询全部日期的排行榜
+    '''
+    __bind_key__ = 'score'
+    __tablename__ = 'speak_total'
+
+    id = db.Column(db.Integer, primary_key = True, autoincrement = True)
+    botid = db.Column(db.String(20), nullable = False)
+    target = db.Column(db.String(20), nullable = False)
+    sender_id = db.Column(db.String(20), nullable = False)
+    sender_name = db.Column(db.String(20), nullable = False)
+    message_count = db.Column(db.Integer, nullable = False)
+    vaild_count = db.Column(db.Integer, nullable = False)
+
+    __table_args__ = (UniqueConstraint('botid', 'target', 'sender_id', name = 'speak_total_uc'),
+                      # 排行榜按索引顺序读取前limit行
+                      db.Index('ix_speak_total_message_count', 'botid', 'target', 'message_count'),
+                      db.Index('ix_speak_total_vaild_count', 'botid', 'target', 'vaild_count'))
+
+    @staticmethod
+    def get_top(botid, target, limit = 10, is_valid = False):
+        column = 'vaild_count' if is_valid else 'message_count'
+        with db.get_engine(bind = 'score').connect() as conn:
+            return conn.execute(
+                text('SELECT sender_id,sender_name,%s cnt FROM speak_total '
+                     'WHERE botid = :botid AND target = :target AND %s > 0 ORDER BY %s DESC LIMIT :limit' %
+                     (column, column, column)),
+                {'botid': botid, 'target': target, 'limit': limit}).fetchall()
+
+    @staticmethod
+    def rebuild(conn):
+        '''
+        由speak_count重建累计发言统计
+        :param conn: 连接，与补齐发言统计在同一个事务中执行
+        :return: 写入的行数
+        '''
+        conn.execute(text('DELETE FROM speak_total'))
+        return conn.execute(text(
+            'INSERT INTO speak_total(botid,target,sender_id,sender_name,message_count,vaild_count) '
+            'SELECT botid,target,sender_id,sender_name,message_count,vaild_count FROM ('
+            'SELECT botid,target,sender_id,sender_name,MAX(date),'
+            'SUM(message_count) message_count,SUM(vaild_count) vaild_count '
+            'FROM speak_count GROUP BY botid,target,sender_id)')).rowcount
+
+
+class LiveTop:
+    '''
+    今日发言排行榜，按(机器人, 目标)在进程内保存今天每个发言人的计数及计数最大的k个发言人，
+    写入发言记录提交后按增量更新，查询今天的排行榜时不访问数据库。
+    启动时及跨日后由speak_count重建；多进程部署时，后台线程每隔refresh_interval秒由dashboard_delta找出有新发言的目标，
+    只重新读取这些目标今天的发言统计并替换，其他进程写入的发言及重新清洗、重新计算后减少的计数随之可见。
+    读取发言统计时持有ingest，读到的统计已包含本进程提交的全部发言，替换不会丢失本进程的增量
+    '''
+
+    def __init__(self, k = 50, refresh_interval = 5):
+        '''
+        :param k: 每个目标保留的发言人数，查询的排行数超过k时由发言统计查询
+        :param refresh_interval: 合并其他进程写入的发言的间隔(秒)，为0时不合并，跨日后在首次写入时从空的排行榜开始
+        '''
+        self.k = k
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        # 写入发言时从提交到更新排行榜期间持有，读取发言统计时持有，使读到的统计与本进程的增量不会重复计数
+        self.ingest = threading.Lock()
+        # 排行榜所属的日期，未建立时为None
+        self._date = None
+        # (botid, target) -> ({sender_id: [发言数, 有效发言数, 发言人名称]}, (发言数TopK, 有效发言数TopK))
+        self._targets = {}
+        # 已读取的dashboard_delta增量ID
+        self._delta_id = 0
+        self._pid = None
+
+    @staticmethod
+    def today():
+        return get_now().strftime('%Y-%m-%d')
+
+    def covers(self, date_from, date_to):
+        '''
+        :return: 日期范围是否包含排行榜所属的日期
+        '''
+        return self._date is not None and str(date_from) <= self._date <= str(date_to)
+
+    def rebuild(self):
+        '''
+        由speak_count重建今天的排行榜，在启动时及跨日后执行
+        :return: 读取的统计行数
+        '''
+        today = LiveTop.today()
+        with self.ingest:
+            # 先记下增量ID，之后写入的发言在下次合并时读取
+            delta_id = delta_hub.snapshot() if delta_hub.enabled else 0
+            records = LiveTop._read(today)
+            with self._lock:
+                (self._date, self._targets) = (today, {})
+                self._merge(records)
+                self._delta_id = delta_id
+        return len(records)
+
+    def rebuild_target(self, botid, target):
+        '''
+        重新读取一个目标今天的发言统计并替换，用于重新计算发言统计后计数可能减少的情况
+        '''
+        today = LiveTop.today()
+        with self.ingest:
+            records = LiveTop._read(today, [(botid, target)])
+            with self._lock:
+                if self._date != today:
+                    return
+                self._targets.pop((botid, target), None)
+                self._merge(records)
+
+    def refresh(self):
+        '''
+        重新读取其他进程有写入或修改的目标，跨日后重建
+        :return: 读取的统计行数
+        '''
+        today = LiveTop.today()
+        if self._date != today:
+            return self.rebuild()
+        if not delta_hub.enabled:
+            return 0
+        (targets, delta_id) = delta_hub.get_changed_targets(self._delta_id)
+        if targets is None:
+            # 上次读取之后的增量已被清理，不能确定哪些目标有变化
+            return self.rebuild()
+        with self.ingest:
+            records = LiveTop._read(today, targets) if len(targets) > 0 else []
+            with self._lock:
+                if self._date == today:
+                    for key in targets:
+                        self._targets.pop(key, None)
+                    self._merge(records)
+                    self._delta_id = delta_id
+        return len(records)
+
+    def add(self, counts):
+        '''
+        按增量更新，在发言数据行提交后、释放ingest之前调用
+        :param counts: SpeakCount.increment返回的累加数据
+        '''
+        with self._lock:
+            if self._date is None:
+                return
+            for count in counts:
+                if count['date'] < self._date:
+                    continue
+                if count['date'] > self._date:
+                    # 已跨日，新的一天从空的排行榜开始
+                    (self._date, self._targets) = (count['date'], {})
+                self._update(count['botid'], count['target'], count['sender_id'], count['sender_name'],
+                             count['message_count'], count['vaild_count'], True)
+
+    def get_top(self, botid, target, date, limit = 10, is_valid = False):
+        '''
+        :return: 包含sender_id、sender_name、cnt的记录列表，不是今天或排行数超过k时返回None
+        '''
+        if limit > self.k:
+            return None
+        today = LiveTop.today()
+        with self._lock:
+            if str(date) != today or self._date != today:
+                return None
+            item = self._targets.get((botid, target))
+            if item is None:
+                return []
+            (senders, tops) = item
+            return [LiveTopRecord(sender_id, senders[sender_id][2], cnt)
+                    for (cnt, sender_id) in tops[1 if is_valid else 0].items(limit) if cnt > 0]
+
+    def start(self, app):
+        # fork后的子进程不继承后台线程，按进程号重新启动
+        if self._pid == os.getpid() or self.refresh_interval <= 0:
+            return
+        self._pid = os.getpid()
+        threading.Thread(target = self._run, args = (app,), name = 'speak-live-top', daemon = True).start()
+
+    @staticmethod
+    def _read(date, targets = None):
+        '''
+        :param targets: (机器人ID, 目标)集合，为None时读取全部目标
+        :return: 当天的发言统计
+        '''
+        sql = 'SELECT botid,target,sender_id,sender_name,message_count,vaild_count FROM speak_count WHERE date = :date'
+        params = {'date': date}
+        if targets is not None:
+            targets = set(targets)
+            botids = sorted({botid for (botid, target) in targets})
+            names = sorted({target for (botid, target) in targets})
+            sql += ' AND botid IN (%s) AND target IN (%s)' % (
+                ','.join(':b%d' % i for i in range(len(botids))), ','.join(':t%d' % i for i in range(len(names))))
+            params.update(('b%d' % i, botid) for (i, botid) in enumerate(botids))
+            params.update(('t%d' % i, target) for (i, target) in enumerate(names))
+        with db.get_engine(bind = 'score').connect() as conn:
+            records = conn.execute(text(sql), params).fetchall()
+        if targets is None:
+            return records
+        return [r for r in records if (r.botid, r.target) in targets]
+
+    def _merge(self, records):
+        for r in records:
+            self._update(r.botid, r.target, r.sender_id, r.sender_name, r.message_count, r.vaild_count, False)
+
+    def _update(self, botid, target, sender_id, sender_name, message_count, vaild_count, increment):
+        '''
+        :param increment: 为True时累加计数，否则为由发言统计读取的计数，读取前已移除该目标，TopK中的计数只增不减
+        '''
+        item = self._targets.get((botid, target))
+        if item is None:
+            item = self._targets[(botid, target)] = ({}, (TopK(self.k), TopK(self.k)))
+        (senders, tops) = item
+        sender = senders.get(sender_id)
+        if sender is None:
+            sender = senders[sender_id] = [0, 0, sender_name]
+        if increment:
+            sender[0] += message_count
+            sender[1] += vaild_count
+        else:
+            (sender[0], sender[1]) = (message_count, vaild_count)
+        sender[2] = sender_name
+        tops[0].update(sender_id, sender[0])
+        if sender[1] > 0:
+            tops[1].update(sender_id, sender[1])
+
+    def _run(self, app):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                with app.app_context():
+                    self.refresh()
+            except Exception as e:
+                print('Failed to refresh speak live top: ' + str(e), file = sys.stderr)
+
+
+LiveTopRecord = namedtuple('LiveTopRecord', ('sender_id', 'sender_name', 'cnt'))
+
+_live_top_config = config().get('live_top', {})
+
+live_top = LiveTop(k = _live_top_config.get('k', 50),
+                   refresh_interval = _live_top_config.get('refresh_interval', 5))
+
+_speak_buffer_config = config().get('speak_buffer', {})
+
+speak_buffer = WriteBehindBuffer('speak',
+                                 Speak.insert_rows,
+                                 get_spool_dir(),
+                                 encode = Speak.dump_row,
+                                 decode = Speak.load_row,
+                                 flush_interval = _speak_buffer_config.get('flush_interval', 200),
+                                 flush_rows = _speak_buffer_config.get('flush_rows', 500),
+                                 queue_size = _speak_buffer_config.get('queue_size', 10000),
+                                 fsync = _speak_buffer_config.get('fsync', False))
+
+
+class WashReconciler:
+    '''
+    后台重新清洗：清洗规则变化后，按时间倒序分批重新清洗规则版本已过期的发言记录
+    多进程部署时通过文件锁保证只有一个进程执行
+    '''
+
+    def __init__(self, interval = 10, batch_size = 500, pause = 200):
+        '''
+        :param interval: 检查过期记录的间隔(秒)
+        :param batch_size: 每批重新清洗的记录数
+        :param pause: 每批之间的停顿(毫秒)，避免长时间占用SQLite的写锁
+        '''
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self._app = None
+        self._pid = None
+        self._lock_file = None
+        self._stats = {'rounds': 0, 'rewashed': 0, 'last_round_at': None, 'last_error': None}
+
+    def start(self, app):
+        # fork后的子进程不继承后台线程，按进程号重新启动
+        if self._pid == os.getpid():
+            return
+        self._app = app
+        self._pid = os.getpid()
+        self._lock_file = None
+        threading.Thread(target = self._run, name = 'wash-reconciler', daemon = True).start()
+
+    def reconcile(self):
+        '''
+        重新清洗全部机器人的过期记录
+        :return: 重新清洗的记录数
+        '''
+        engine = db.get_engine(bind = 'score')
+        count = 0
+        for bot in Bot.findall():
+            rules = SpeakWash.get_rules(bot.id)
+            # 先在索引上探测，没有过期记录时不读取数据表
+            if not Speak.has_stale(bot.id, rules.version):
+                continue
+            last_id = None
+            while True:
+                records = Speak.find_stale(bot.id, rules.version, self.batch_size, last_id)
+                if len(records) == 0:
+                    break
+                (rewashed, data, seconds) = _wash_records(rules, records)
+                current = SpeakWash.load_rules(bot.id)
+                if current.version != rules.version:
+                    # 规则在数据库中已变化而本进程缓存的仍是旧规则，不写入旧规则的清洗结果，按新规则从头开始
+                    SpeakWash.rule_cache.invalidate(bot.id)
+                    rules = SpeakWash.get_rules(bot.id)
+                    last_id = None
+                    continue
+                Speak.write_wash(engine, data)
+                last_id = records[-1][0]
+                count += rewashed
+                self._stats['rewashed'] += rewashed
+                time.sleep(self.pause / 1000)
+        self._stats['rounds'] += 1
+        self._stats['last_round_at'] = output_datetime(get_now())
+        return count
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['active'] = self._lock_file is not None
+        return stats
+
+    def _acquire(self):
+        if self._lock_file is not None:
+            return True
+        lock_file = open(os.path.join(get_tmp_dir(), 'wash-reconciler.lock'), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                lock_file.close()
+                return False
+        self._lock_file = lock_file
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self._acquire():
+                continue
+            try:
+                with self._app.app_context():
+                    self.reconcile()
+            except Exception as e:
+                self._stats['last_error'] = str(e)
+                print('Failed to reconcile speak wash: ' + str(e), file = sys.stderr)
+
+
+_wash_reconcile_config = config().get('wash_reconcile', {})
+
+wash_reconciler = WashReconciler(interval = _wash_reconcile_config.get('interval', 10),
+                                 batch_size = _wash_reconcile_config.get('batch_size', 500),
+                                 pause = _wash_reconcile_config.get('pause', 200))
 
-db.create_all()
+
+def init(app):
+    '''
+    在进程退出时提交写后缓冲，重放上次进程退出时写后缓冲中未提交的发言记录；
+    建立今日发言排行榜；启动后台重新清洗
+    :param app: flask app
+    '''
+    import plugin
+
+    # 先注册退出时提交缓冲，重放失败时本次运行中缓冲的发言记录仍会在退出时提交
+    plugin.register_shutdown(speak_buffer.stop)
+    try:
+        speak_buffer.replay()
+    except Exception as e:
+        # 未重放的记录保留在缓冲文件中，下次启动时再重放，不影响其他初始化
+        print('Failed to replay speak buffer: ' + str(e), file = sys.stderr)
+
+    if _live_top_config.get('enabled', True):
+        with app.app_context():
+            live_top.rebuild()
+
+        @app.before_request
+        def start_live_top():
+            live_top.start(app)
+
+    if _wash_reconcile_config.get('enabled', True):
+        @app.before_request
+        def start_wash_reconciler():
+            wash_reconciler.start(app)
 
 
 # View-----------------------------------------------------------------------------------------------------
@@ -512,6 +1609,19 @@ class SpeakWashView(CVAdminModelView):
     def __init__(self, model, session):
         CVAdminModelView.__init__(self, model, session, '发言清洗规则', '机器人设置')
 
+    def after_model_change(self, form, model, is_created):
+        SpeakWash.rule_cache.invalidate(model.botid)
+        self._flash_stale(model.botid)
+
+    def after_model_delete(self, model):
+        SpeakWash.rule_cache.invalidate(model.botid)
+        self._flash_stale(model.botid)
+
+    def _flash_stale(self, botid):
+        stale = Speak.count_stale(botid, SpeakWash.get_rules(botid).version)[0]
+        if stale > 0:
+            flash('清洗规则已变化，' + str(stale) + '条发言记录将在后台重新清洗', 'info')
+
     def get_query(self):
         return get_list_by_botassign(SpeakWash, SpeakWashView, self)
 
@@ -741,6 +1851,24 @@ class SpeakRecordAPI(Resource):
             parser.add_argument('sender_name')
             parser.add_argument('message', required = True, help = '请求中必须包含message')
             args = parser.parse_args()
+            if _speak_buffer_config.get('enabled'):
+                botid = ac.get_bot()
+                row = Speak.make_row(botid, SpeakWash.get_rules(botid), get_now(), args)
+                try:
+                    speak_buffer.put(row)
+                    return ac.success(botid = row['botid'],
+                                      target = row['target'],
+                                      sender_id = row['sender_id'],
+                                      sender_name = row['sender_name'],
+                                      date = output_datetime(row['date']),
+                                      time = output_datetime(row['time']),
+                                      create_at = output_datetime(row['create_at']),
+                                      message = row['message'],
+                                      washed_text = row['washed_text'],
+                                      washed_chars = row['washed_chars'])
+                except BufferFullError:
+                    # 缓冲已满时退回同步写入
+                    pass
             record = Speak.create(ac.get_bot(),
                                   args['target_type'],
                                   args['target_account'],
@@ -764,6 +1892,54 @@ class SpeakRecordAPI(Resource):
             return ac.fault(error = e)
 
 
+@ac.register_api('/speakbuffer', endpoint = 'speakbuffer')
+class SpeakBufferAPI(Resource):
+    method_decorators = [ac.require_apikey]
+
+    def get(self):
+        try:
+            return ac.success(enabled = bool(_speak_buffer_config.get('enabled')), **speak_buffer.stats())
+        except Exception as e:
+            return ac.fault(error = e)
+
+
+@ac.register_api('/speakrecords', endpoint = 'speakrecords')
+class SpeakRecordsAPI(Resource):
+    method_decorators = [ac.require_apikey]
+
+    def post(self):
+        try:
+            parser = reqparse.RequestParser()
+            parser.add_argument('records', type = list, location = 'json', required = True,
+                                help = '请求中必须包含records')
+            args = parser.parse_args()
+            max_batch = config().get('speak_records', {}).get('max_batch', 1000)
+            if len(args['records']) > max_batch:
+                raise Exception('每次最多提交' + str(max_batch) + '条发言记录')
+            results = []
+            success_count = 0
+            for result in Speak.create_batch(ac.get_bot(), args['records']):
+                if isinstance(result, Exception):
+                    results.append(ac.fault(error = result)[0])
+                else:
+                    success_count += 1
+                    results.append(ac.success(botid = result['botid'],
+                                              target = result['target'],
+                                              sender_id = result['sender_id'],
+                                              sender_name = result['sender_name'],
+                                              date = output_datetime(result['date']),
+                                              time = output_datetime(result['time']),
+                                              create_at = output_datetime(result['create_at']),
+                                              message = result['message'],
+                                              washed_text = result['washed_text'],
+                                              washed_chars = result['washed_chars'])[0])
+            return ac.success(total_count = len(results),
+                              success_count = success_count,
+                              results = results)
+        except Exception as e:
+            return ac.fault(error = e)
+
+
 @ac.register_api('/speakwashs', endpoint = 'speakwashs')
 class SpeakWashsAPI(Resource):
     method_decorators = [ac.require_apikey]
@@ -869,6 +2045,38 @@ class SpeakWashAPI(Resource):
             return ac.fault(error = e)
 
 
+@ac.register_api('/speakwashcache', endpoint = 'speakwashcache')
+class SpeakWashCacheAPI(Resource):
+    method_decorators = [ac.require_apikey]
+
+    def get(self):
+        try:
+            rules = SpeakWash.get_rules(ac.get_bot())
+            return ac.success(botid = rules.botid,
+                              version = rules.version,
+                              rule_count = len(rules.rules),
+                              cache = SpeakWash.rule_cache.stats())
+        except Exception as e:
+            return ac.fault(error = e)
+
+
+@ac.register_api('/speakwashstale', endpoint = 'speakwashstale')
+class SpeakWashStaleAPI(Resource):
+    method_decorators = [ac.require_apikey]
+
+    def get(self):
+        try:
+            rules = SpeakWash.get_rules(ac.get_bot())
+            (stale_count, total_count) = Speak.count_stale(rules.botid, rules.version)
+            return ac.success(botid = rules.botid,
+                              version = rules.version,
+                              stale_count = stale_count,
+                              total_count = total_count,
+                              reconciler = wash_reconciler.stats())
+        except Exception as e:
+            return ac.fault(error = e)
+
+
 @ac.register_api('/speakwashdo', endpoint = 'speakwashdo')
 class SpeakWashDoAPI(Resource):
     method_decorators = [ac.require_apikey]
@@ -907,12 +2115,14 @@ class SpeakWashUpdateAPI(Resource):
             parser.add_argument('target_account', required = True, help = '请求中必须包含target_account')
             parser.add_argument('date_from', required = True, help = '请求中必须包含date_from')
             parser.add_argument('date_to', required = True, help = '请求中必须包含date_to')
+            parser.add_argument('workers', type = int)
             args = parser.parse_args()
             result = Speak.updatewash(ac.get_bot(),
                                       args['target_type'],
                                       args['target_account'],
                                       args['date_from'],
-                                      args['date_to'])
+                                      args['date_to'],
+                                      workers = Speak.limit_rewash_workers(args['workers']))
             if result is not None:
                 return ac.success(update_count = result[0],
                                   update_duartion = result[1])
@@ -921,6 +2131,21 @@ class SpeakWashUpdateAPI(Resource):
         except Exception as e:
             return ac.fault(error = e)
 
+    def get(self):
+        try:
+            parser = reqparse.RequestParser()
+            parser.add_argument('target_type', required = True, help = '请求中必须包含target_type')
+            parser.add_argument('target_account', required = True, help = '请求中必须包含target_account')
+            args = parser.parse_args()
+            progress = wash_progress.get(
+                (ac.get_bot(), get_target_composevalue(args['target_type'], args['target_account'])))
+            if progress is not None:
+                return ac.success(**progress.to_dict())
+            else:
+                return ac.fault(error = Exception('该目标没有执行过重新清洗'))
+        except Exception as e:
+            return ac.fault(error = e)
+
 
 @ac.register_api('/speaktop', endpoint = 'speaktop')
 class SpeakTopAPI(Resource):
@@ -0,0 +1,83 @@
+'''
+    生产环境服务
+
+    以gunicorn多进程方式运行app：插件在主进程中预加载后再fork出工作进程，
+    收到SIGTERM时工作进程处理完当前请求后退出，退出前执行插件注册的清理工作(如提交写后缓冲)。
+    工作进程数、线程数等由env.get_config中的server配置决定。
+    用法：python app.py (SERVER_MODE=production)
+'''
+import signal
+import sys
+
+from gunicorn.app.base import BaseApplication
+
+import db_control
+import plugin
+from env import get_env_host, get_env_port, get_config as config
+
+
+class ProductionServer(BaseApplication):
+    def __init__(self, app, options):
+        '''
+        :param app: 已加载插件的flask app
+        :param options: gunicorn配置
+        '''
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for (key, value) in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def _when_ready(server):
+    print('Serving on %s with %d workers x %d threads' %
+          (server.cfg.bind[0], server.cfg.workers, server.cfg.threads), file = sys.stderr)
+
+
+def _pre_fork(server, worker):
+    # 主进程加载插件时打开的数据库连接不能被工作进程共用，fork前关闭，工作进程按需重新连接
+    for engine in db_control.get_engines().values():
+        engine.dispose()
+
+
+def _post_worker_init(worker):
+    # 工作进程收到SIGTERM后等待当前请求结束，先通知推送等长连接尽快结束
+    handle_exit = worker.handle_exit
+
+    def handle_stop(signum, frame):
+        plugin.stopping.set()
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_stop)
+
+
+def _worker_exit(server, worker):
+    plugin.shutdown()
+
+
+def get_options():
+    '''
+    :return: 由server配置生成的gunicorn配置
+    '''
+    server_config = config().get('server', {})
+    threads = server_config.get('threads', 1)
+    return {'bind': get_env_host() + ':' + str(get_env_port()),
+            'workers': server_config.get('workers', 1),
+            'threads': threads,
+            'worker_class': 'gthread' if threads > 1 else 'sync',
+            'timeout': server_config.get('timeout', 30),
+            'graceful_timeout': server_config.get('graceful_timeout', 30),
+            'preload_app': True,
+            'when_ready': _when_ready,
+            'pre_fork': _pre_fork,
+            'post_worker_init': _post_worker_init,
+            'worker_exit': _worker_exit}
+
+
+def run(app):
+    ProductionServer(app, get_options()).run()
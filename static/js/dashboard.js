@@ -1,5 +1,29 @@
+// 各目标面板的刷新函数，收到该目标的发言增量时调用
+var dashboard_panels = {};
+
+// 收到增量后刷新面板的最短间隔(毫秒)
+var PANEL_REFRESH_INTERVAL = 10000;
+
 function init_statistics_panel(botid, target, url) {
     var targetid = target.replace('#', '_');
+    var last_refresh = 0;
+    var refresh_timer = null;
+
+    dashboard_panels[botid + '|' + target] = function () {
+        if (refresh_timer !== null) {
+            return;
+        }
+        var delay = Math.max(0, last_refresh + PANEL_REFRESH_INTERVAL - new Date().getTime());
+        refresh_timer = setTimeout(function () {
+            refresh_timer = null;
+            last_refresh = new Date().getTime();
+            // 发言统计在写入发言时已累加，只需重新读取图表及今天的排行榜
+            $('#' + $('#' + targetid + '-chart-title').attr('last-status')).trigger("click");
+            if ($('#' + targetid + '-rank-title').text() === '今天') {
+                $('#' + targetid + '-rank-action-1').trigger("click");
+            }
+        }, delay);
+    };
 
     $('#' + targetid + '-chart-action-1').click(function () {
         get_statistics_data(botid, target, url, 2, 7);
@@ -48,22 +72,81 @@ function init_statistics_panel(botid, target, url) {
     });
 
     $(document).ready(function () {
-        get_statistics_data(botid, target, url, 1, 0);
-        setInterval(function () {
-            get_statistics_data(botid, target, url, 1, 0);
-            get_statistics_data(botid, target, url, 3, 1);
-            $('#' + $('#' + targetid + '-chart-title').attr('last-status')).trigger("click");
-        }, 30000);
         $('#' + targetid + '-chart-action-3').trigger("click");
         $('#' + targetid + '-rank-action-1').trigger("click");
     });
 }
 
+function init_dashboard_stream(stream_url, url) {
+    var summary = null;
+    var polling = false;
+
+    function show_summary() {
+        $('#speak_today_count').text(summary.speak_today_count);
+        $('#sign_today_count').text(summary.sign_today_count);
+        $('#point_today_total').text(summary.point_today_total);
+        $('#score_today_total').text(summary.score_today_total);
+    }
+
+    // 无法使用推送时定时刷新汇总数据及各面板
+    function start_polling() {
+        if (polling) {
+            return;
+        }
+        polling = true;
+        get_statistics_data('', '', url, 1, 0);
+        setInterval(function () {
+            get_statistics_data('', '', url, 1, 0);
+            for (var key in dashboard_panels) {
+                dashboard_panels[key]();
+            }
+        }, 30000);
+    }
+
+    if (!window.EventSource) {
+        start_polling();
+        return;
+    }
+
+    var source = new EventSource(stream_url);
+    source.addEventListener('summary', function (e) {
+        // 每次连接(包括自动重连)都会先收到完整的汇总数据
+        summary = JSON.parse(e.data);
+        show_summary();
+    });
+    source.addEventListener('delta', function (e) {
+        var delta = JSON.parse(e.data);
+        if (summary === null || delta.date < summary.date) {
+            return;
+        }
+        if (delta.date > summary.date) {
+            // 已跨日，今天的数据从0开始累加
+            summary = {'date': delta.date, 'speak_today_count': 0, 'sign_today_count': 0,
+                       'point_today_total': 0, 'score_today_total': 0};
+        }
+        summary.speak_today_count += delta.speak;
+        summary.sign_today_count += delta.sign;
+        summary.point_today_total += delta.point;
+        summary.score_today_total += delta.score;
+        show_summary();
+        if (delta.speak > 0 && dashboard_panels[delta.botid + '|' + delta.target]) {
+            dashboard_panels[delta.botid + '|' + delta.target]();
+        }
+    });
+    source.onerror = function () {
+        // 连接正常结束时浏览器自动重连，被拒绝(未开启推送或连接数已达上限)时不再重连
+        if (source.readyState === EventSource.CLOSED) {
+            start_polling();
+        }
+    };
+}
+
 function get_statistics_data(botid, target, url, type, days) {
     var targetid = target.replace('#', '_');
     $.ajax({
         url: url,
-        type: 'POST',
+        // 查询用GET，浏览器缓存响应并以ETag重新验证，数据未变化时服务器返回304
+        type: type === 3 ? 'POST' : 'GET',
         dataType: 'json',
         data: {"type": type, "botid": botid, "target": target, "days": days},
         success: function (data) {